@@ -1,5 +1,6 @@
 import os
 from pathlib import Path
+from typing import List, Optional
 
 import typer
 
@@ -10,6 +11,8 @@ PKGPATH = FILEPATH.parents[1]
 app = typer.Typer()
 docs_app = typer.Typer()
 app.add_typer(docs_app, name="docs")
+bench_app = typer.Typer()
+app.add_typer(bench_app, name="bench")
 
 
 @app.callback()
@@ -28,3 +31,96 @@ def build_docs() -> None:
 @docs_app.command("serve")
 def serve_docs() -> None:
     os.system("mkdocs serve")
+
+
+@app.command("serve")
+def serve(
+    model: str = typer.Option(None, help="exported model or Lightning checkpoint; defaults to config.MODELPATH"),
+    module: Optional[str] = typer.Option(None, help="LightningModule of a checkpoint, as package.module:ClassName"),
+    host: str = "127.0.0.1",
+    port: int = 8000,
+    socket: Optional[str] = typer.Option(None, help="serve on this Unix socket instead of host:port"),
+    max_batch_size: int = 32,
+    max_latency_ms: float = 5.0,
+    workers: int = 1,
+    mode: str = typer.Option("eager", help="execution mode of a checkpoint: eager, bf16, compile or compile-bf16"),
+) -> None:
+    """Serves the production model with dynamic micro-batching."""
+    from lab import config
+    from lab.components.inference.server import serve as serve_model
+
+    serve_model(model or config.MODELPATH, module, host, port, socket, max_batch_size, max_latency_ms, workers, mode)
+
+
+@app.command("loadgen")
+def loadgen(
+    shape: str = typer.Option("1,35", help="shape of every request input, batch first"),
+    inputs: int = typer.Option(1, help="number of model inputs, all of the same shape"),
+    dtype: str = "int64",
+    high: int = typer.Option(100, help="integer inputs are drawn from [0, high)"),
+    requests: int = 1000,
+    concurrency: int = 16,
+    host: str = "127.0.0.1",
+    port: int = 8000,
+    socket: Optional[str] = None,
+) -> None:
+    """Load-tests a local `lab serve` with random inputs and prints latency, throughput and batching metrics."""
+    import numpy as np
+
+    from lab.components.inference.server import load_test
+
+    size = tuple(int(dim) for dim in shape.split(","))
+    rng = np.random.default_rng()
+
+    def make_inputs():
+        if np.issubdtype(np.dtype(dtype), np.integer):
+            return [rng.integers(0, high, size, dtype=dtype) for _ in range(inputs)]
+        return [rng.standard_normal(size).astype(dtype) for _ in range(inputs)]
+
+    for key, value in load_test(make_inputs, requests, concurrency, host, port, socket).items():
+        typer.echo(f"{key}: {value:,.3f}")
+
+
+@bench_app.command("run")
+def bench_run(
+    only: Optional[List[str]] = typer.Option(None, help="run only these benchmarks; repeat the option for several"),
+    quick: bool = typer.Option(False, help="run the small cases only, e.g. as a smoke test"),
+    repeats: int = 5,
+    output: Optional[str] = typer.Option(None, help="results file; defaults to logs/bench/bench-<timestamp>.json"),
+    baseline: Optional[str] = typer.Option(None, help="results file to compare against"),
+    threshold: float = typer.Option(0.1, help="flag cases more than this fraction slower than the baseline"),
+) -> None:
+    """Runs the benchmark suite and saves the timings, with machine metadata, as JSON."""
+    from lab.components.bench.results import load_results, save_results
+    from lab.components.bench.suite import run_suite
+
+    results = run_suite(only, quick=quick, repeats=repeats, log=typer.echo)
+    typer.echo(f"saved {save_results(results, output)}")
+    if baseline is not None:
+        _report_regressions(results, load_results(baseline), threshold)
+
+
+@bench_app.command("compare")
+def bench_compare(
+    current: str,
+    baseline: str,
+    threshold: float = typer.Option(0.1, help="flag cases more than this fraction slower than the baseline"),
+) -> None:
+    """Compares two results files and exits with status 1 if any case regressed."""
+    from lab.components.bench.results import load_results
+
+    _report_regressions(load_results(current), load_results(baseline), threshold)
+
+
+def _report_regressions(current: dict, baseline: dict, threshold: float) -> None:
+    from lab.components.bench.results import compare
+
+    rows = compare(current, baseline, threshold)
+    for row in rows:
+        flag = "REGRESSION" if row["regression"] else "ok"
+        typer.echo(
+            f"{row['benchmark']} {row['case']}: {row['baseline']:.6g}s -> {row['current']:.6g}s "
+            f"({row['ratio']:.2f}x) {flag}"
+        )
+    if any(row["regression"] for row in rows):
+        raise typer.Exit(code=1)
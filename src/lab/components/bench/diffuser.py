@@ -0,0 +1,72 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""benchmarks for the few-step samplers of the diffusion demo in lab.models.diffuser"""
+
+import time
+from typing import Dict, Optional, Sequence
+
+import torch
+
+from lab.models.diffuser import DiffusionModel
+
+
+def fit_toy_model(image_size: int = 16, num_steps: int = 1000, schedule: str = "linear", epochs: int = 2000):
+    """Trains a small model on a two-mode toy distribution, so its samples have a known target."""
+    torch.manual_seed(0)
+    model = DiffusionModel(num_steps=num_steps, image_size=image_size, schedule=schedule)
+    optimizer = model.configure_optimizers()
+    modes = torch.stack([torch.linspace(-1, 1, image_size), torch.linspace(1, -1, image_size)])
+    for _ in range(epochs):
+        x = modes[torch.randint(0, 2, (256,))] + 0.05 * torch.randn(256, image_size)
+        optimizer.zero_grad()
+        model.loss(x).backward()
+        optimizer.step()
+    return model.eval(), modes
+
+
+def bench_sampling(
+    model: Optional[DiffusionModel] = None,
+    modes: Optional[torch.Tensor] = None,
+    steps: Sequence[int] = (1, 5, 10, 25, 50, 100, 250, 1000),
+    num_samples: int = 512,
+) -> Dict[int, Dict[str, float]]:
+    """Samples with a DDIM sampler at every step count and reports latency and quality.
+
+    Quality is the mean squared distance to the full-step trajectory started from the same noise and, with
+    ``modes``, to the nearest mode of the training distribution.
+    """
+    if model is None:
+        model, modes = fit_toy_model()
+    reference = model.sample(num_samples, steps=model.num_steps, generator=torch.Generator().manual_seed(0))
+    results = {}
+    for num_steps in steps:
+        model.sample(num_samples, steps=num_steps)  # warm up, and fill the coefficient cache
+        start = time.perf_counter()
+        samples = model.sample(num_samples, steps=num_steps, generator=torch.Generator().manual_seed(0))
+        seconds = time.perf_counter() - start
+        results[num_steps] = {
+            "seconds": seconds,
+            "samples_per_sec": num_samples / seconds,
+            "mse_to_full_steps": float(((samples - reference) ** 2).mean()),
+        }
+        if modes is not None:
+            results[num_steps]["mse_to_data"] = float(torch.cdist(samples, modes).min(dim=1).values.pow(2).mean())
+    return results
+
+
+if __name__ == "__main__":
+    for num_steps, stats in bench_sampling().items():
+        print(f"steps={num_steps:>5,}: " + ", ".join(f"{key}={value:,.6g}" for key, value in stats.items()))
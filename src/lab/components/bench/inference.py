@@ -0,0 +1,98 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""CPU latency and throughput of the exported demo models: eager PyTorch against ONNX Runtime and the fallback"""
+
+import os
+import tempfile
+import time
+from typing import Callable, Dict, Sequence
+
+import numpy as np
+import torch
+
+from lab.components.inference.export import StateSpaceExport, TransformerExport, export_statespace, export_transformer
+from lab.components.inference.runtime import OnnxSession, TorchSession
+from lab.models.statespace import StateSpaceModel
+from lab.models.transformer import Transformer
+
+
+def latency(fn: Callable[[], object], repeats: int = 20) -> Dict[str, float]:
+    """Returns the p50 and p99 seconds of ``fn`` after a warm-up call."""
+    fn()
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return {"p50": float(np.percentile(timings, 50)), "p99": float(np.percentile(timings, 99))}
+
+
+def bench_runtimes(
+    model: torch.nn.Module,
+    session_path: str,
+    make_inputs: Callable[[int], tuple],
+    batch_sizes: Sequence[int] = (1, 8, 32),
+    repeats: int = 20,
+) -> Dict[int, Dict[str, Dict[str, float]]]:
+    """Times eager PyTorch, ONNX Runtime with and without IO binding, and the PyTorch fallback at every batch size."""
+    runtimes = {
+        "eager": lambda *x: model(*x),
+        "onnxruntime": OnnxSession(session_path),
+        "onnxruntime_copy": OnnxSession(session_path, io_binding=False),
+        "fallback": TorchSession(session_path),
+    }
+    results = {}
+    model.eval()
+    for batch_size in batch_sizes:
+        inputs = make_inputs(batch_size)
+        results[batch_size] = {}
+        for name, run in runtimes.items():
+            with torch.no_grad():
+                stats = latency(lambda: run(*inputs), repeats)
+            results[batch_size][name] = {**stats, "samples_per_sec": batch_size / stats["p50"]}
+    return results
+
+
+def bench_transformer(seq_len: int = 35, **kwargs) -> Dict[int, Dict[str, Dict[str, float]]]:
+    model = Transformer().eval()
+    with tempfile.TemporaryDirectory() as tmp:
+        path, _ = export_transformer(model, os.path.join(tmp, "transformer.onnx"), seq_len=seq_len)
+
+        def make_inputs(batch_size):
+            return tuple(torch.randint(0, model.vocab_size, (batch_size, seq_len)) for _ in range(2))
+
+        return bench_runtimes(TransformerExport(model), path, make_inputs, **kwargs)
+
+
+def bench_statespace(steps: int = 256, **kwargs) -> Dict[int, Dict[str, Dict[str, float]]]:
+    model = StateSpaceModel(16, 4)
+    with tempfile.TemporaryDirectory() as tmp:
+        path, _ = export_statespace(model, os.path.join(tmp, "statespace.onnx"))
+
+        def make_inputs(batch_size):
+            return torch.randn(batch_size, 16), torch.randn(batch_size, steps, 16), torch.randn(batch_size, steps, 4)
+
+        return bench_runtimes(StateSpaceExport(model), path, make_inputs, **kwargs)
+
+
+if __name__ == "__main__":
+    for name, bench in (("transformer", bench_transformer), ("statespace", bench_statespace)):
+        for batch_size, runtimes in bench().items():
+            for runtime, stats in runtimes.items():
+                print(
+                    f"{name:>11} batch={batch_size:>3} {runtime:>16}: p50={stats['p50'] * 1e3:8.3f}ms "
+                    f"p99={stats['p99'] * 1e3:8.3f}ms samples/sec={stats['samples_per_sec']:,.1f}"
+                )
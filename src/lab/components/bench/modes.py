@@ -0,0 +1,197 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""throughput, memory and accuracy of every execution mode of the demo models, to pick the fastest safe mode"""
+
+import multiprocessing
+import resource
+import sys
+import time
+from typing import Any, Callable, Dict, Optional, Sequence
+
+import torch
+
+from lab.components.bench.suite import measure
+from lab.components.execution import modes
+
+Table = Dict[str, Dict[str, Dict[str, Any]]]
+
+
+def _transformer(batch_size: int = 20, seq_len: int = 35) -> Dict[str, Any]:
+    from lab.models.transformer import LightningTransformer
+
+    module = LightningTransformer()
+    batch = tuple(torch.randint(0, module.model.vocab_size, (batch_size, seq_len)) for _ in range(2))
+    return {
+        "module": module,
+        "infer": lambda: module(*batch)[:seq_len],
+        "train": lambda: module.training_step(batch, 0),
+        "samples": batch_size,
+    }
+
+
+def _diffuser(batch_size: int = 256) -> Dict[str, Any]:
+    from lab.models.diffuser import DiffusionModel
+
+    module = DiffusionModel()
+    x = torch.rand(batch_size, module.image_size)
+    t = torch.randint(0, module.num_steps, (batch_size,))
+    return {
+        "module": module,
+        "infer": lambda: module.predict_noise(x, t),
+        "train": lambda: module.loss(x),
+        "samples": batch_size,
+    }
+
+
+def _statespace(batch_size: int = 64, steps: int = 256) -> Dict[str, Any]:
+    from lab.models.statespace import StateSpaceModel
+
+    # without noise, rollouts are deterministic and comparable across modes; a stable transition keeps them finite
+    module = StateSpaceModel(
+        16, 4, (0.9 * torch.eye(16)).tolist(), process_noise_var=0.0, observation_noise_var=0.0
+    ).requires_grad_(False)
+    initial_state = torch.randn(batch_size, 16)
+    return {
+        "module": module,
+        "infer": lambda: module(initial_state, steps=steps, method="scan"),
+        "train": None,
+        "samples": batch_size,
+    }
+
+
+# every workload builds a module, an inference call whose output is compared across modes, and optionally a loss
+WORKLOADS: Dict[str, Callable[[], Dict[str, Any]]] = {
+    "transformer": _transformer,
+    "diffuser": _diffuser,
+    "statespace": _statespace,
+}
+
+
+def measure_mode(name: str, mode: str, backend: str = "inductor", repeats: int = 10) -> Dict[str, Any]:
+    """Runs workload ``name`` in ``mode`` in this process and returns its timings, peak memory and output.
+
+    ``first_call_seconds`` and ``first_step_seconds`` include compiling, or loading compiled graphs from the cache.
+    Throughput is the best of ``repeats`` calls after them. Peak memory is this process's resident set, so run every
+    mode in a fresh process, as ``compare_modes`` does.
+    """
+    torch.manual_seed(0)
+    workload = WORKLOADS[name]()
+    module = workload["module"]
+    counters = modes.compile_counters()
+    if modes.uses_compile(mode):
+        modes.compile_module(module, backend)
+
+    module.eval()
+    with torch.no_grad(), modes.autocast(mode):
+        start = time.perf_counter()
+        output = workload["infer"]().float()
+        results = {"first_call_seconds": time.perf_counter() - start}
+        stats = measure(workload["infer"], repeats, warmup=0)
+    results["infer_samples_per_sec"] = workload["samples"] / stats["min_seconds"]
+
+    if workload["train"] is not None:
+        module.train()
+        optimizer = torch.optim.SGD(module.parameters(), lr=1e-3)
+
+        def step():
+            optimizer.zero_grad(set_to_none=True)
+            with modes.autocast(mode):
+                loss = workload["train"]()
+            loss.backward()
+            optimizer.step()
+
+        start = time.perf_counter()
+        step()
+        results["first_step_seconds"] = time.perf_counter() - start
+        stats = measure(step, repeats, warmup=0)
+        results["train_samples_per_sec"] = workload["samples"] / stats["min_seconds"]
+
+    compiled = modes.counters_since(counters)
+    results.update(graphs=compiled["graphs"], graph_breaks=compiled["graph_breaks"])
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    results["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (
+        2**20 if sys.platform == "darwin" else 2**10
+    )
+    results["output"] = output.flatten()[:65536].numpy()
+    return results
+
+
+def compare_modes(
+    names: Sequence[str] = tuple(WORKLOADS),
+    execution_modes: Sequence[str] = modes.MODES,
+    backend: str = "inductor",
+    repeats: int = 10,
+) -> Table:
+    """Measures every workload in every execution mode, each in a fresh process, and compares them with eager.
+
+    Returns ``table[name][mode]`` with the throughput, first-call and peak memory figures of ``measure_mode``, the
+    graph and graph break counts of the compile modes, and ``max_error``: the largest absolute difference from the
+    eager outputs, relative to the largest eager output.
+    """
+    context = multiprocessing.get_context("spawn")
+    table: Table = {}
+    for name in names:
+        table[name] = {}
+        for mode in dict.fromkeys(("eager", *execution_modes)):
+            with context.Pool(1) as pool:
+                table[name][mode] = pool.apply(measure_mode, (name, mode, backend, repeats))
+        reference = table[name]["eager"]["output"]
+        scale = max(float(abs(reference).max()), 1e-12)
+        for mode, results in table[name].items():
+            results["max_error"] = float(abs(results.pop("output") - reference).max()) / scale
+        if "eager" not in execution_modes:
+            del table[name]["eager"]
+    return table
+
+
+def recommend(table: Table, tolerance: float = 0.05, metric: Optional[str] = None) -> Dict[str, str]:
+    """The fastest mode of every workload whose ``max_error`` is within ``tolerance``.
+
+    Speed is ``metric``, by default training throughput where the workload trains and inference throughput otherwise.
+    Eager always qualifies, so a workload falls back to it when no faster mode is accurate enough.
+    """
+    choices = {}
+    for name, results in table.items():
+        trains = all("train_samples_per_sec" in stats for stats in results.values())
+        key = metric or ("train_samples_per_sec" if trains else "infer_samples_per_sec")
+        safe = {mode: stats for mode, stats in results.items() if mode == "eager" or stats["max_error"] <= tolerance}
+        choices[name] = max(safe, key=lambda mode: safe[mode][key]) if safe else "eager"
+    return choices
+
+
+def format_table(table: Table) -> str:
+    columns = [
+        "infer_samples_per_sec",
+        "train_samples_per_sec",
+        "first_call_seconds",
+        "first_step_seconds",
+        "peak_rss_mb",
+        "graph_breaks",
+        "max_error",
+    ]
+    lines = [f"{'model':>12} {'mode':>13} " + " ".join(f"{column:>22}" for column in columns)]
+    for name, results in table.items():
+        for mode, stats in results.items():
+            cells = [f"{stats[column]:>22,.4g}" if column in stats else f"{'-':>22}" for column in columns]
+            lines.append(f"{name:>12} {mode:>13} " + " ".join(cells))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    table = compare_modes()
+    print(format_table(table))
+    for name, mode in recommend(table).items():
+        print(f"{name}: {mode}")
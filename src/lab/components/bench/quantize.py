@@ -0,0 +1,49 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""fp32 against int8 accuracy, latency and weight size of the demo models"""
+
+from typing import Dict
+
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+from lab.components.inference.quantize import quantization_report, quantize, quantize_static
+from lab.models.diffuser import DiffusionModel
+from lab.models.transformer import Transformer
+
+
+def bench_transformer(batch_size: int = 20, seq_len: int = 35, num_batches: int = 8) -> Dict[str, Dict[str, float]]:
+    """Dynamic quantization of the decoder and the embedding table; the encoder layers stay fp32."""
+    model = Transformer().eval()
+    batches = [
+        tuple(torch.randint(0, model.vocab_size, (batch_size, seq_len)) for _ in range(2)) for _ in range(num_batches)
+    ]
+    return quantization_report(model, quantize(model), batches)
+
+
+def bench_diffuser(batch_size: int = 64, num_batches: int = 8) -> Dict[str, Dict[str, float]]:
+    """Static quantization of the noise predictor, calibrated on the training loss of random images."""
+    model = DiffusionModel(image_size=784).eval()
+    loader = DataLoader(TensorDataset(torch.rand(batch_size * num_batches, 784)), batch_size=batch_size)
+    quantized = quantize_static(model, loader, ["encoder"], forward_fn=lambda m, batch: m.loss(batch[0]))
+    t = torch.randint(0, model.num_steps, (batch_size,))
+    batches = [(x, t) for (x,) in loader]
+    return quantization_report(model, quantized, batches, forward_fn=lambda m, batch: m.predict_noise(*batch))
+
+
+if __name__ == "__main__":
+    for name, bench in (("transformer", bench_transformer), ("diffuser", bench_diffuser)):
+        for precision, stats in bench().items():
+            print(f"{name:>11} {precision}: " + ", ".join(f"{key}={value:,.6g}" for key, value in stats.items()))
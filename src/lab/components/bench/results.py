@@ -0,0 +1,67 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""reading, writing and comparing `lab bench` results, without importing torch so `lab bench compare` starts fast"""
+
+import datetime
+import json
+import os
+from typing import Any, Dict, List, Optional
+
+from lab import config
+
+
+def save_results(results: Dict[str, Any], path: Optional[str] = None) -> str:
+    """Writes ``results`` as JSON, to a timestamped file under ``logs/bench`` by default, and returns the path."""
+    if path is None:
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        path = os.path.join(config.BENCHPATH, f"bench-{stamp}.json")
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+    return path
+
+
+def load_results(path: str) -> Dict[str, Any]:
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(
+    current: Dict[str, Any], baseline: Dict[str, Any], threshold: float = 0.1, metric: str = "min_seconds"
+) -> List[Dict[str, Any]]:
+    """Compares the timings of every case that both runs measured.
+
+    ``metric`` is "min_seconds", the best of the repeats, which is the least sensitive to noise from other processes,
+    or "seconds", the median. A case regresses when it is more than ``threshold`` slower than the baseline, i.e. when
+    ``current / baseline > 1 + threshold``. Returns one row per case, with the ratio and a ``regression`` flag.
+    """
+    rows = []
+    for name, cases in current["results"].items():
+        for case, stats in cases.items():
+            before = baseline["results"].get(name, {}).get(case)
+            if before is None:
+                continue
+            ratio = stats[metric] / before[metric]
+            rows.append(
+                {
+                    "benchmark": name,
+                    "case": case,
+                    "baseline": before[metric],
+                    "current": stats[metric],
+                    "ratio": ratio,
+                    "regression": ratio > 1 + threshold,
+                }
+            )
+    return rows
@@ -0,0 +1,115 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""CPU data-parallel scaling: training throughput with 1..N pinned DDP processes against a single process"""
+
+import tempfile
+import time
+from typing import Callable, Dict, Optional, Sequence
+
+import pytorch_lightning as pl
+import torch
+from pytorch_lightning.callbacks import Callback
+from pytorch_lightning.strategies import DDPStrategy
+
+from lab.trainer import LabTrainer
+
+
+class ThroughputMeter(Callback):
+    """Measures global training samples/sec after ``warmup`` steps, excluding process start-up and the first steps.
+
+    The result is stored in ``trainer.callback_metrics["scaling/samples_per_sec"]``, which spawned ranks send back
+    to the launching process.
+    """
+
+    def __init__(self, warmup: int = 5) -> None:
+        self.warmup = warmup
+        self._start: Optional[float] = None
+        self._samples = 0
+
+    def on_train_batch_start(
+        self, trainer: "pl.Trainer", pl_module: "pl.LightningModule", batch, batch_idx: int
+    ) -> None:
+        if trainer.global_step == self.warmup and self._start is None:
+            self._start = time.perf_counter()
+        if self._start is not None:
+            inputs = batch[0] if isinstance(batch, (tuple, list)) else batch
+            self._samples += len(inputs)
+
+    def on_train_end(self, trainer: "pl.Trainer", pl_module: "pl.LightningModule") -> None:
+        if self._start is None:
+            raise RuntimeError(f"Train for more than {self.warmup} warm-up steps to measure throughput")
+        elapsed = time.perf_counter() - self._start
+        samples_per_sec = self._samples * trainer.world_size / elapsed
+        trainer.callback_metrics["scaling/samples_per_sec"] = torch.tensor(samples_per_sec)
+
+
+def scaling_report(
+    make_model: Callable[[], pl.LightningModule],
+    make_datamodule: Callable[[], pl.LightningDataModule],
+    processes: Sequence[int] = (1, 2, 4),
+    max_steps: int = 50,
+    warmup: int = 5,
+    find_unused_parameters: bool = False,
+    **trainer_kwargs,
+) -> Dict[int, Dict[str, float]]:
+    """Trains ``max_steps`` steps with each number of ``processes`` and compares throughput to one process.
+
+    Every rank keeps the datamodule's batch size, so N processes train on N times the samples per step. Scaling
+    efficiency is ``samples_per_sec(N) / (N * samples_per_sec(1))``: 1.0 is perfectly linear. Ranks are spawned, so
+    ``make_model`` and ``make_datamodule`` must build picklable objects. Set ``find_unused_parameters`` for models
+    with parameters that do not contribute to the loss, which DDP otherwise rejects.
+    """
+    results = {}
+    for num_processes in processes:
+        strategy = "auto"
+        if num_processes > 1:
+            strategy = DDPStrategy(
+                process_group_backend="gloo", start_method="spawn", find_unused_parameters=find_unused_parameters
+            )
+        with tempfile.TemporaryDirectory() as tmp:
+            trainer = LabTrainer(
+                cpu_processes=num_processes,
+                strategy=strategy,
+                max_steps=max_steps,
+                callbacks=[ThroughputMeter(warmup)],
+                logger=False,
+                checkpoints_dir=tmp,
+                enable_progress_bar=False,
+                enable_model_summary=False,
+                **trainer_kwargs,
+            )
+            trainer.fit(make_model(), datamodule=make_datamodule())
+        results[num_processes] = {"samples_per_sec": float(trainer.callback_metrics["scaling/samples_per_sec"])}
+    base = results[processes[0]]["samples_per_sec"] / processes[0]
+    for num_processes, stats in results.items():
+        stats["speedup"] = stats["samples_per_sec"] / results[processes[0]]["samples_per_sec"]
+        stats["efficiency"] = stats["samples_per_sec"] / (num_processes * base)
+    return results
+
+
+if __name__ == "__main__":
+    from functools import partial
+
+    from lab.components.bench.suite import SyntheticDataset
+    from lab.components.callbacks.affinity import available_cpus
+    from lab.datamodule import LabDataModule
+    from lab.models.diffuser import DiffusionModel
+
+    make_datamodule = partial(LabDataModule, SyntheticDataset, batch_size=256, splits_dir=tempfile.mkdtemp())
+    processes = [n for n in (1, 2, 4, 8, 16) if n <= len(available_cpus())]
+    # the demo diffusion model never uses its decoder
+    report = scaling_report(DiffusionModel, make_datamodule, processes, find_unused_parameters=True)
+    for num_processes, stats in report.items():
+        print(f"processes={num_processes:>2}: " + ", ".join(f"{key}={value:,.3f}" for key, value in stats.items()))
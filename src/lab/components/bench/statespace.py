@@ -0,0 +1,62 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""benchmarks for the state space model demo in lab.models.statespace"""
+
+import time
+from typing import Dict, Optional, Sequence
+
+import torch
+
+from lab.models.statespace import StateSpaceModel
+
+
+def bench_forward(
+    steps: Sequence[int] = (10, 100, 1_000, 10_000, 100_000),
+    batch_size: int = 16,
+    state_dim: int = 4,
+    obs_dim: int = 2,
+    repeats: int = 3,
+) -> Dict[int, Dict[str, float]]:
+    """Times the sequential and scan forward passes and returns the best seconds per call for every step count."""
+    # a stable transition keeps the long scans finite
+    model = StateSpaceModel(state_dim, obs_dim, transition_matrix=(0.9 * torch.eye(state_dim)).tolist()).requires_grad_(
+        False
+    )
+    initial_state = torch.randn(batch_size, state_dim)
+    results = {}
+    for num_steps in steps:
+        results[num_steps] = {}
+        for method in ("sequential", "scan"):
+            model(initial_state, steps=num_steps, method=method)
+            timings = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                model(initial_state, steps=num_steps, method=method)
+                timings.append(time.perf_counter() - start)
+            results[num_steps][method] = min(timings)
+    return results
+
+
+def crossover(results: Dict[int, Dict[str, float]]) -> Optional[int]:
+    """Returns the smallest step count from which the scan is faster than the sequential loop."""
+    faster = [steps for steps, timing in sorted(results.items()) if timing["scan"] < timing["sequential"]]
+    return faster[0] if faster else None
+
+
+if __name__ == "__main__":
+    results = bench_forward()
+    for num_steps, timing in results.items():
+        print(f"steps={num_steps:>7,}: sequential={timing['sequential']:.4f}s scan={timing['scan']:.4f}s")
+    print(f"crossover: {crossover(results)}")
@@ -0,0 +1,226 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""the `lab bench` suite: timings of the data, training and inference hot paths, saved with machine metadata"""
+
+import datetime
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Sequence
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from lab import config
+
+# benchmark name -> (function, full cases, quick cases); every case is a dict of keyword arguments
+BENCHMARKS: Dict[str, Any] = {}
+
+
+def benchmark(name: str, cases: Sequence[Dict[str, Any]], quick: Sequence[Dict[str, Any]]) -> Callable:
+    """Registers ``fn(repeats, **case)`` as benchmark ``name``; it returns the seconds and throughput of a case."""
+
+    def register(fn: Callable[..., Dict[str, float]]) -> Callable[..., Dict[str, float]]:
+        BENCHMARKS[name] = (fn, list(cases), list(quick))
+        return fn
+
+    return register
+
+
+def measure(fn: Callable[[], object], repeats: int = 5, warmup: int = 1) -> Dict[str, float]:
+    """Returns the median and best seconds of ``repeats`` calls of ``fn``, after ``warmup`` calls."""
+    for _ in range(warmup):
+        fn()
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return {"seconds": float(np.median(timings)), "min_seconds": float(min(timings))}
+
+
+def case_name(case: Dict[str, Any]) -> str:
+    return ",".join(f"{key}={value}" for key, value in case.items())
+
+
+def machine_metadata() -> Dict[str, Any]:
+    """What a timing depends on besides the code: the machine, the interpreter and the library versions."""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=config.PROJECTPATH, capture_output=True, text=True, timeout=5
+        ).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        commit = ""
+    return {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "hostname": platform.node(),
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "affinity": len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count(),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "numpy": np.__version__,
+        "torch_threads": torch.get_num_threads(),
+        "commit": commit or None,
+    }
+
+
+def run_suite(
+    names: Optional[Sequence[str]] = None,
+    quick: bool = False,
+    repeats: int = 5,
+    log: Optional[Callable[[str], None]] = None,
+) -> Dict[str, Any]:
+    """Runs the ``names`` benchmarks, all by default, over their full or ``quick`` cases.
+
+    Returns ``{"metadata": ..., "results": {benchmark: {case: {"seconds": ..., ...}}}}``.
+    """
+    unknown = set(names or ()) - set(BENCHMARKS)
+    if unknown:
+        raise ValueError(f"Unknown benchmarks {sorted(unknown)}, expected some of {sorted(BENCHMARKS)}")
+    results: Dict[str, Dict[str, Dict[str, float]]] = {}
+    for name in names or BENCHMARKS:
+        fn, cases, quick_cases = BENCHMARKS[name]
+        results[name] = {}
+        for case in quick_cases if quick else cases:
+            results[name][case_name(case)] = stats = fn(repeats, **case)
+            if log is not None:
+                log(f"{name} {case_name(case)}: " + ", ".join(f"{key}={value:,.6g}" for key, value in stats.items()))
+    return {"metadata": {**machine_metadata(), "quick": quick, "repeats": repeats}, "results": results}
+
+
+def _corpus(path: Path, num_lines: int, vocab_size: int = 10_000, words_per_line: int = 20) -> Path:
+    # a synthetic, Zipf-distributed corpus, so the suite needs no download
+    if not path.exists():
+        rng = np.random.default_rng(0)
+        ids = np.minimum(rng.zipf(1.2, (num_lines, words_per_line)), vocab_size)
+        path.write_text("\n".join(" ".join(f"w{i}" for i in row) for row in ids) + "\n")
+    return path
+
+
+@benchmark("tokenize", [{"lines": 10_000}, {"lines": 100_000}], [{"lines": 2_000}])
+def bench_tokenize(repeats: int, lines: int) -> Dict[str, float]:
+    from lab.models.transformer import tokenize
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = _corpus(Path(tmp) / "corpus.txt", lines)
+        stats = measure(lambda: tokenize(path, num_workers=1), repeats)
+        num_tokens = len(tokenize(path, num_workers=1)[0])
+    return {**stats, "tokens_per_sec": num_tokens / stats["seconds"]}
+
+
+@benchmark("wikitext2_getitem", [{"block_size": 35}, {"block_size": 512}], [{"block_size": 35}])
+def bench_wikitext2_getitem(repeats: int, block_size: int, samples: int = 10_000) -> Dict[str, float]:
+    from lab.models.transformer import WikiText2
+
+    with tempfile.TemporaryDirectory() as tmp:
+        _corpus(Path(tmp) / "wikitext-2.txt", 20_000)
+        dataset = WikiText2(Path(tmp), block_size=block_size, download=False)
+        indices = np.random.default_rng(0).integers(0, len(dataset), samples).tolist()
+        stats = measure(lambda: [dataset[i] for i in indices], repeats)
+    return {**stats, "samples_per_sec": samples / stats["seconds"]}
+
+
+class SyntheticDataset(Dataset):
+    """Random feature vectors with the ``(data_dir, train, transform)`` signature ``LabDataModule`` builds with."""
+
+    def __init__(self, data_dir=None, train=True, transform=None, download=False, size=8192, features=784):
+        self.data = torch.randn(size, features)
+        self.targets = torch.randint(0, 10, (size,))
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        return self.data[index], self.targets[index]
+
+
+@benchmark(
+    "datamodule_loader",
+    [
+        {"batch_size": 32, "num_workers": 0},
+        {"batch_size": 256, "num_workers": 0},
+        {"batch_size": 256, "num_workers": 2},
+    ],
+    [{"batch_size": 64, "num_workers": 0}],
+)
+def bench_datamodule_loader(repeats: int, batch_size: int, num_workers: int) -> Dict[str, float]:
+    from lab.datamodule import LabDataModule
+
+    with tempfile.TemporaryDirectory() as tmp:
+        datamodule = LabDataModule(
+            SyntheticDataset, batch_size=batch_size, num_workers=num_workers, splits_dir=tmp, log_throughput=False
+        )
+        datamodule.setup("fit")
+        loader = datamodule.train_dataloader()
+        stats = measure(lambda: sum(len(x) for x, _ in loader), repeats)
+    return {**stats, "samples_per_sec": len(datamodule.train_data) / stats["seconds"]}
+
+
+@benchmark(
+    "transformer_training_step",
+    [{"batch_size": 8, "seq_len": 35}, {"batch_size": 32, "seq_len": 35}, {"batch_size": 8, "seq_len": 256}],
+    [{"batch_size": 4, "seq_len": 35}],
+)
+def bench_transformer_training_step(
+    repeats: int, batch_size: int, seq_len: int, vocab_size: int = 33278
+) -> Dict[str, float]:
+    """One optimization step: ``training_step``, the backward pass and the optimizer update."""
+    from lab.models.transformer import LightningTransformer
+
+    module = LightningTransformer(vocab_size=vocab_size).train()
+    optimizer = module.configure_optimizers()
+    batch = tuple(torch.randint(0, vocab_size, (batch_size, seq_len)) for _ in range(2))
+
+    def step():
+        optimizer.zero_grad(set_to_none=True)
+        module.training_step(batch, 0).backward()
+        optimizer.step()
+
+    stats = measure(step, repeats)
+    return {**stats, "tokens_per_sec": batch_size * seq_len / stats["seconds"]}
+
+
+@benchmark(
+    "statespace_forward",
+    [{"steps": steps, "method": method} for steps in (100, 10_000) for method in ("sequential", "scan")],
+    [{"steps": 100, "method": "scan"}],
+)
+def bench_statespace_forward(repeats: int, steps: int, method: str, batch_size: int = 16) -> Dict[str, float]:
+    from lab.models.statespace import StateSpaceModel
+
+    # a stable transition keeps long rollouts finite
+    model = StateSpaceModel(4, 2, transition_matrix=(0.9 * torch.eye(4)).tolist()).requires_grad_(False)
+    initial_state = torch.randn(batch_size, 4)
+    stats = measure(lambda: model(initial_state, steps=steps, method=method), repeats)
+    return {**stats, "steps_per_sec": batch_size * steps / stats["seconds"]}
+
+
+@benchmark(
+    "diffusion_sampling",
+    [{"num_samples": 64, "steps": 50}, {"num_samples": 512, "steps": 50}, {"num_samples": 64, "steps": 1000}],
+    [{"num_samples": 16, "steps": 10}],
+)
+def bench_diffusion_sampling(repeats: int, num_samples: int, steps: int) -> Dict[str, float]:
+    from lab.models.diffuser import DiffusionModel
+
+    model = DiffusionModel().eval()
+    stats = measure(lambda: model.sample(num_samples, steps=steps), repeats)
+    return {**stats, "samples_per_sec": num_samples / stats["seconds"]}
@@ -0,0 +1,164 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""micro-benchmarks for the transformer demo in lab.models.transformer"""
+
+import multiprocessing
+import resource
+import sys
+import time
+from typing import Callable, Dict, Sequence
+
+import torch
+from torch.profiler import ProfilerActivity, profile
+
+from lab.models.transformer import PositionalEncoding, Transformer
+
+
+def count_allocations(fn: Callable[[], object], steps: int = 10) -> Dict[str, float]:
+    """Profiles ``steps`` calls of ``fn`` and returns the tensor allocations and bytes allocated per call."""
+    fn()  # warm up caches
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        for _ in range(steps):
+            fn()
+    events = [e for e in prof.events() if e.name != "[memory]" and e.self_cpu_memory_usage > 0]
+    return {
+        "allocations_per_step": len(events) / steps,
+        "bytes_per_step": sum(e.self_cpu_memory_usage for e in events) / steps,
+    }
+
+
+def time_per_step(fn: Callable[[], object], steps: int = 100) -> float:
+    fn()
+    start = time.perf_counter()
+    for _ in range(steps):
+        fn()
+    return (time.perf_counter() - start) / steps
+
+
+def bench_masks_and_encodings(batch_size: int = 20, seq_len: int = 35, dim: int = 200) -> Dict[str, Dict[str, float]]:
+    """Compares rebuilding the causal mask every step against the cached mask and positional encoding."""
+    x = torch.randn(batch_size, seq_len, dim)
+    encoder = PositionalEncoding(dim, dropout=0.0)
+    model = Transformer(ninp=dim)
+    pe = encoder._init_pos_encoding(encoder.max_len, device=x.device, dtype=x.dtype)
+
+    def rebuilt() -> torch.Tensor:
+        # the per-step mask construction used before masks were cached
+        mask = torch.tril(torch.ones(seq_len, seq_len)) == 1
+        mask = mask.float().masked_fill(mask == 0, float("-inf")).masked_fill(mask == 1, 0.0)
+        return x + pe[:seq_len], mask
+
+    def cached() -> torch.Tensor:
+        mask = model.causal_masks.get(seq_len, device=x.device, dtype=x.dtype)[:seq_len, :seq_len]
+        return encoder(x), mask
+
+    results = {}
+    for name, fn in (("rebuilt", rebuilt), ("cached", cached)):
+        results[name] = {**count_allocations(fn), "seconds_per_step": time_per_step(fn)}
+    return results
+
+
+# the memory-saving options of `Transformer` compared by `peak_memory_by_length`
+MEMORY_CONFIGS: Dict[str, Dict[str, object]] = {
+    "default": {},
+    "sdpa": {"attention_dropout": 0.0},
+    "checkpoint": {"checkpoint_layers": True},
+    "sdpa+checkpoint": {"attention_dropout": 0.0, "checkpoint_layers": True},
+    "chunked-loss": {"loss_chunk_size": 512},
+    "adaptive": {"head": "adaptive"},
+    "all-chunked": {"attention_dropout": 0.0, "checkpoint_layers": True, "loss_chunk_size": 512},
+    "all-adaptive": {"attention_dropout": 0.0, "checkpoint_layers": True, "head": "adaptive"},
+}
+
+
+def zipf_probs(vocab_size: int, exponent: float = 1.1) -> torch.Tensor:
+    """Token probabilities falling off as a power of the id, roughly like the word frequencies of natural text."""
+    probs = torch.arange(1, vocab_size + 1, dtype=torch.float64) ** -exponent
+    return probs / probs.sum()
+
+
+def _rss_mb(usage: resource.struct_rusage) -> float:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return usage.ru_maxrss / (2**20 if sys.platform == "darwin" else 2**10)
+
+
+def training_step_memory(
+    seq_len: int, batch_size: int = 1, vocab_size: int = 33278, **model_kwargs
+) -> Dict[str, float]:
+    """The peak resident memory of one forward and backward pass over ``batch_size`` sequences of ``seq_len``.
+
+    Tokens are drawn from ``zipf_probs``, whose expected counts also cluster the adaptive head. ``peak_rss_mb`` is
+    the process's peak, so call this in a fresh process; ``step_mb`` is how far the step raised it above the memory
+    held once the model and its inputs are built, i.e. the activations and gradients.
+    """
+    torch.manual_seed(0)
+    probs = zipf_probs(vocab_size)
+    if model_kwargs.get("head") == "adaptive":
+        model_kwargs.setdefault("token_counts", (probs * 1e9).long().tolist())
+    model = Transformer(vocab_size=vocab_size, **model_kwargs).train()
+    inputs, target = (torch.multinomial(probs, batch_size * seq_len, True).view(batch_size, seq_len) for _ in range(2))
+    before = _rss_mb(resource.getrusage(resource.RUSAGE_SELF))
+    start = time.perf_counter()
+    model.loss(inputs, target).backward()
+    seconds = time.perf_counter() - start
+    peak = _rss_mb(resource.getrusage(resource.RUSAGE_SELF))
+    return {"peak_rss_mb": peak, "step_mb": peak - before, "seconds": seconds}
+
+
+def peak_memory_by_length(
+    seq_lens: Sequence[int] = (128, 256, 512, 1024, 2048, 4096),
+    configs: Sequence[str] = tuple(MEMORY_CONFIGS),
+    batch_size: int = 1,
+    vocab_size: int = 33278,
+) -> Dict[str, Dict[int, Dict[str, float]]]:
+    """Measures ``training_step_memory`` for every memory-saving config and sequence length, each in a new process.
+
+    Returns ``report[config][seq_len]``; see ``MEMORY_CONFIGS`` for the configs.
+    """
+    context = multiprocessing.get_context("spawn")
+    report: Dict[str, Dict[int, Dict[str, float]]] = {}
+    for config in configs:
+        report[config] = {}
+        for seq_len in seq_lens:
+            with context.Pool(1) as pool:
+                report[config][seq_len] = pool.apply(
+                    training_step_memory, (seq_len, batch_size, vocab_size), MEMORY_CONFIGS[config]
+                )
+    return report
+
+
+def bench_topk(num_positions: int = 256, k: int = 10, vocab_size: int = 33278, dim: int = 200) -> Dict[str, float]:
+    """Seconds per top-``k`` query over ``num_positions`` hidden states: the dense head against the adaptive head.
+
+    The models are untrained, so the adaptive head rarely prunes a tail cluster; trained heads prune more.
+    """
+    counts = (zipf_probs(vocab_size) * 1e9).long().tolist()
+    dense = Transformer(vocab_size=vocab_size, ninp=dim).eval()
+    adaptive = Transformer(vocab_size=vocab_size, ninp=dim, head="adaptive", token_counts=counts).eval()
+    hidden = torch.randn(num_positions, dim)
+    with torch.no_grad():
+        return {
+            "dense": time_per_step(lambda: dense.topk(hidden, k), steps=20),
+            "adaptive": time_per_step(lambda: adaptive.topk(hidden, k), steps=20),
+        }
+
+
+if __name__ == "__main__":
+    for name, stats in bench_masks_and_encodings().items():
+        print(f"{name:>8}: " + ", ".join(f"{key}={value:,.6g}" for key, value in stats.items()))
+    print("top-k seconds: " + ", ".join(f"{head}={seconds:,.6g}" for head, seconds in bench_topk().items()))
+    for config, by_length in peak_memory_by_length().items():
+        for seq_len, stats in by_length.items():
+            print(f"{config:>15} seq_len={seq_len:>5}: " + ", ".join(f"{k}={v:,.1f}" for k, v in stats.items()))
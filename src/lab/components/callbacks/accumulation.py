@@ -0,0 +1,57 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""gradient accumulation sized by a target number of tokens per optimizer update"""
+
+import math
+from typing import Any, Optional
+
+import pytorch_lightning as pl
+import torch
+from pytorch_lightning.callbacks import Callback
+
+
+def count_tokens(batch: Any) -> int:
+    """The tokens in a batch of token ids, or in the first element of a tuple of them.
+
+    Packed batches, ``(inputs, targets, segment_ids)`` as built by ``PackingCollate``, count only non-padding tokens.
+    """
+    if isinstance(batch, (tuple, list)):
+        if len(batch) == 3 and isinstance(batch[2], torch.Tensor):
+            return int((batch[2] > 0).sum())
+        batch = batch[0]
+    return batch.numel()
+
+
+class TokensPerUpdate(Callback):
+    """Accumulates gradients over as many batches as it takes to reach ``tokens_per_update`` tokens per update.
+
+    The number of batches is set from the tokens in the first training batch, summed over all ranks so that every
+    rank derives the same number, and rounded up, so longer sequences or larger batches accumulate over fewer of
+    them and every update sees about the same number of tokens. It overrides the trainer's
+    ``accumulate_grad_batches``, and is kept in ``accumulate_grad_batches`` here.
+    """
+
+    def __init__(self, tokens_per_update: int) -> None:
+        self.tokens_per_update = tokens_per_update
+        self.accumulate_grad_batches: Optional[int] = None
+
+    def on_train_batch_start(self, trainer: "pl.Trainer", pl_module: "pl.LightningModule", batch, batch_idx) -> None:
+        if self.accumulate_grad_batches is None:
+            # every rank must accumulate over the same number of batches, or DDP's gradient syncs fall out of step
+            local = torch.tensor(float(count_tokens(batch)), device=pl_module.device)
+            tokens = float(trainer.strategy.reduce(local, reduce_op="sum"))
+            self.accumulate_grad_batches = max(1, math.ceil(self.tokens_per_update / tokens))
+        trainer.accumulate_grad_batches = self.accumulate_grad_batches
@@ -0,0 +1,85 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""pins every rank of a CPU run, and its dataloader workers, to their own cores so ranks do not oversubscribe"""
+
+import os
+from typing import List, Optional, Sequence, Tuple
+
+import pytorch_lightning as pl
+import torch
+from lightning_fabric.utilities.seed import pl_worker_init_function
+from pytorch_lightning.callbacks import Callback
+
+CoreSet = Tuple[List[int], List[int]]
+
+
+def available_cpus() -> List[int]:
+    """The CPUs this process may run on, from its affinity mask where the platform has one."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def core_sets(num_ranks: int, workers_per_rank: int = 0, cpus: Optional[Sequence[int]] = None) -> List[CoreSet]:
+    """Splits ``cpus`` into one contiguous, disjoint block per rank, and every block into compute and worker cores.
+
+    A rank's intra-op threads run on its compute cores and its ``workers_per_rank`` dataloader workers share its
+    worker cores, which take at most half of the block. With fewer CPUs than ranks, ranks share CPUs round-robin.
+    Returns a ``(compute_cores, worker_cores)`` pair per rank; ``worker_cores`` is empty without workers.
+    """
+    cpus = list(cpus) if cpus is not None else available_cpus()
+    if len(cpus) < num_ranks:
+        return [([cpus[rank % len(cpus)]], []) for rank in range(num_ranks)]
+    size, extra = divmod(len(cpus), num_ranks)
+    sets = []
+    start = 0
+    for rank in range(num_ranks):
+        block = cpus[start : start + size + (rank < extra)]
+        start += len(block)
+        num_worker_cores = min(workers_per_rank, len(block) // 2)
+        sets.append((block[: len(block) - num_worker_cores], block[len(block) - num_worker_cores :]))
+    return sets
+
+
+class CPUAffinity(Callback):
+    """Pins this rank to its block of ``core_sets`` and sizes its intra-op thread pool to match.
+
+    Ranks are numbered by ``trainer.local_rank`` among the ``trainer.num_devices`` processes of the node. When the
+    datamodule splits its workers per rank, as ``LabDataModule`` does, the workers are pinned to the rank's worker
+    cores through ``worker_cpus``. Pinning needs ``os.sched_setaffinity``; elsewhere only the thread count is set.
+
+    Args:
+        cpus: the CPUs to divide between the node's ranks; defaults to those this process may run on.
+    """
+
+    def __init__(self, cpus: Optional[Sequence[int]] = None) -> None:
+        self.cpus = cpus
+
+    def setup(self, trainer: "pl.Trainer", pl_module: "pl.LightningModule", stage: str) -> None:
+        datamodule = getattr(trainer, "datamodule", None)
+        workers = datamodule.workers_per_rank() if hasattr(datamodule, "workers_per_rank") else 0
+        compute, worker_cpus = core_sets(trainer.num_devices, workers, self.cpus)[trainer.local_rank]
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, compute)
+            if datamodule is not None and worker_cpus:
+                datamodule.worker_cpus = worker_cpus
+        torch.set_num_threads(len(compute))
+
+
+def pin_worker(worker_id: int, cpus: Sequence[int], rank: int = 0) -> None:
+    """A ``worker_init_fn`` that pins a dataloader worker to ``cpus``, then seeds it as Lightning would."""
+    os.sched_setaffinity(0, cpus)
+    if int(os.environ.get("PL_SEED_WORKERS", 0)):
+        pl_worker_init_function(worker_id, rank)
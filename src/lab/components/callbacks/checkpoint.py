@@ -0,0 +1,202 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""non-blocking checkpointing: snapshot to host memory, write on a background thread, fsync and rename into place"""
+
+import hashlib
+import os
+import queue
+import shutil
+import threading
+from typing import Any, Dict, Optional, Set, Type
+
+import pytorch_lightning as pl
+import torch
+from lightning_utilities.core.apply_func import apply_to_collection
+from pytorch_lightning.callbacks import Callback
+from pytorch_lightning.plugins import TorchCheckpointIO
+
+from lab.components.io import atomic_write
+
+_FROZEN_KEY = "frozen_parameters"
+
+
+class AsyncCheckpointIO(TorchCheckpointIO):
+    """Saves checkpoints without stalling training.
+
+    ``save_checkpoint`` only copies the checkpoint's tensors to CPU memory; a background thread serializes the copy
+    to a temporary file, fsyncs it and renames it over the target, so a checkpoint on disk is always complete.
+    Removals go through the same queue, so ``ModelCheckpoint`` can rotate its top-k files as usual: an old file is
+    only removed once the checkpoint replacing it has been written. Loading waits for pending writes.
+
+    With ``incremental`` and the ``FrozenParameters`` callback, frozen parameters that have not changed since the
+    previous save are neither copied nor written again. They are stored once, and every checkpoint gets a hard link
+    to them named ``<checkpoint>.frozen``; ``load_module`` and this plugin's ``load_checkpoint`` merge them back.
+
+    Args:
+        max_pending: snapshots queued for the background thread before a save waits for it, which bounds the host
+            memory held by snapshots.
+        incremental: skip unchanged frozen parameters.
+    """
+
+    def __init__(self, max_pending: int = 2, incremental: bool = False) -> None:
+        super().__init__()
+        self.max_pending = max_pending
+        self.incremental = incremental
+        self._queue: Optional[queue.Queue] = None
+        self._thread: Optional[threading.Thread] = None
+        self._error: Optional[BaseException] = None
+        # the fingerprint and names of the last frozen parameters queued, and the file the writer stored them in
+        self._frozen: Optional[str] = None
+        self._frozen_names: Set[str] = set()
+        self._frozen_path: Optional[str] = None
+
+    def save_checkpoint(self, checkpoint: Dict[str, Any], path: Any, storage_options: Optional[Any] = None) -> None:
+        if storage_options is not None:
+            raise TypeError(f"`storage_options` is not supported by `{type(self).__name__}`")
+        self._raise_error()
+        frozen = checkpoint.get(_FROZEN_KEY) if self.incremental else None
+        state_dict = checkpoint.get("state_dict", {})
+        frozen_state = None
+        if frozen is not None and frozen["names"]:
+            names = set(frozen["names"]) & set(state_dict)
+            if frozen["fingerprint"] != self._frozen or names != self._frozen_names:
+                frozen_state = _snapshot({name: state_dict[name] for name in names})
+                self._frozen, self._frozen_names = frozen["fingerprint"], names
+            checkpoint = {**checkpoint, "state_dict": {k: v for k, v in state_dict.items() if k not in names}}
+        else:
+            frozen = None
+        # the copy is taken on the training thread so later optimizer steps cannot leak into the file
+        snapshot = _snapshot(checkpoint)
+        self._submit(("save", str(path), snapshot, frozen is not None, frozen_state, self._frozen))
+
+    def load_checkpoint(self, path: Any, map_location: Optional[Any] = None, weights_only: Optional[bool] = None):
+        self.wait()
+        checkpoint = super().load_checkpoint(path, map_location=map_location, weights_only=weights_only)
+        frozen_path = f"{path}.frozen"
+        if os.path.exists(frozen_path):
+            checkpoint["state_dict"].update(torch.load(frozen_path, map_location=map_location, weights_only=True))
+        return checkpoint
+
+    def remove_checkpoint(self, path: Any) -> None:
+        self._submit(("remove", str(path)))
+
+    def wait(self) -> None:
+        """Blocks until every queued save and removal is on disk."""
+        if self._queue is not None:
+            self._queue.join()
+        self._raise_error()
+
+    def teardown(self) -> None:
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._queue, self._thread = None, None
+        self._raise_error()
+
+    def _submit(self, task: tuple) -> None:
+        if self._thread is None:
+            # started lazily, since teardown stops the thread after every fit, validate or test call
+            self._queue = queue.Queue(maxsize=self.max_pending)
+            self._thread = threading.Thread(target=self._drain, name="checkpoint-writer", daemon=True)
+            self._thread.start()
+        self._queue.put(task)
+
+    def _drain(self) -> None:
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:
+                    return
+                if self._error is None:
+                    self._run(*task)
+            except BaseException as error:  # surfaced on the training thread by the next call
+                self._error = error
+            finally:
+                self._queue.task_done()
+
+    def _run(
+        self,
+        action: str,
+        path: str,
+        snapshot: Any = None,
+        incremental: bool = False,
+        frozen_state: Any = None,
+        fingerprint: Optional[str] = None,
+    ) -> None:
+        if action == "remove":
+            for stale in (path, f"{path}.frozen"):
+                if os.path.exists(stale):
+                    os.remove(stale)
+            return
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        if frozen_state is not None:
+            # a new version of the frozen parameters: write it once, later checkpoints link to it
+            frozen_path = os.path.join(os.path.dirname(path), f".frozen-{fingerprint}.pt")
+            atomic_write(frozen_path, lambda f: torch.save(frozen_state, f))
+            if self._frozen_path is not None and self._frozen_path != frozen_path and os.path.exists(self._frozen_path):
+                os.remove(self._frozen_path)
+            self._frozen_path = frozen_path
+        atomic_write(path, lambda f: torch.save(snapshot, f))
+        if incremental:
+            _link(self._frozen_path, f"{path}.frozen")
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+
+class FrozenParameters(Callback):
+    """Records which parameters are frozen in every checkpoint, so ``AsyncCheckpointIO(incremental=True)`` can skip
+    them while they are unchanged.
+
+    A parameter counts as unchanged while its storage and its version counter, which every in-place update such as
+    ``load_state_dict`` or an optimizer step bumps, stay the same. Writes through ``param.data`` bypass the counter;
+    unfreeze the parameter while changing it that way.
+    """
+
+    def on_save_checkpoint(
+        self, trainer: "pl.Trainer", pl_module: "pl.LightningModule", checkpoint: Dict[str, Any]
+    ) -> None:
+        frozen = [(name, p) for name, p in pl_module.named_parameters() if not p.requires_grad]
+        digest = hashlib.sha256()
+        for name, param in frozen:
+            digest.update(f"{name}:{tuple(param.shape)}:{param.data_ptr()}:{param._version};".encode())
+        checkpoint[_FROZEN_KEY] = {"names": [name for name, _ in frozen], "fingerprint": digest.hexdigest()[:16]}
+
+
+def load_module(cls: Type[pl.LightningModule], path: str, map_location: Any = "cpu", **kwargs) -> pl.LightningModule:
+    """``cls.load_from_checkpoint(path)``, completed with the frozen parameters of an incremental checkpoint."""
+    frozen_path = f"{path}.frozen"
+    if not os.path.exists(frozen_path):
+        return cls.load_from_checkpoint(path, map_location=map_location, **kwargs)
+    model = cls.load_from_checkpoint(path, map_location=map_location, strict=False, **kwargs)
+    frozen_state = torch.load(frozen_path, map_location=map_location, weights_only=True)
+    model.load_state_dict({**model.state_dict(), **frozen_state})
+    return model
+
+
+def _snapshot(obj: Any) -> Any:
+    return apply_to_collection(obj, torch.Tensor, lambda t: t.detach().to("cpu", copy=True))
+
+
+def _link(source: str, target: str) -> None:
+    tmp_path = f"{target}.{os.getpid()}.tmp"
+    try:
+        os.link(source, tmp_path)
+    except OSError:
+        # file systems without hard links get a copy
+        shutil.copyfile(source, tmp_path)
+    os.replace(tmp_path, target)
@@ -0,0 +1,60 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""compiles the networks of a LightningModule with torch.compile before training or inference starts"""
+
+from typing import Any, Dict, List, Optional
+
+import pytorch_lightning as pl
+from pytorch_lightning.callbacks import Callback
+
+from lab.components.execution.modes import compile_counters, compile_module, counters_since
+
+
+class CompileModules(Callback):
+    """Compiles the networks of the LightningModule in place in ``setup`` (see ``compile_module``).
+
+    The module is compiled on every rank, and because compiling in place keeps parameter names, its checkpoints load
+    into eager modules unchanged. Once the first training step has compiled,
+    the graphs and graph breaks it produced are logged as ``compile/graphs`` and ``compile/graph_breaks`` and kept,
+    with the reason of every break, in ``report``; a model that compiles without breaks runs as whole graphs.
+
+    Args:
+        backend: the ``torch.compile`` backend, e.g. "inductor", "aot_eager" or "eager".
+        compile_mode: the ``torch.compile`` mode, e.g. "reduce-overhead" or "max-autotune".
+        dynamic: compile for dynamic shapes up front instead of after the first shape change.
+    """
+
+    def __init__(self, backend: str = "inductor", compile_mode: Optional[str] = None, dynamic: Optional[bool] = None):
+        self.backend = backend
+        self.compile_mode = compile_mode
+        self.dynamic = dynamic
+        self.compiled: List[str] = []
+        self.report: Optional[Dict[str, Any]] = None
+        self._counters: Optional[Dict[str, Any]] = None
+
+    def setup(self, trainer: "pl.Trainer", pl_module: "pl.LightningModule", stage: str) -> None:
+        self.compiled = compile_module(pl_module, self.backend, self.compile_mode, self.dynamic)
+
+    def on_train_start(self, trainer: "pl.Trainer", pl_module: "pl.LightningModule") -> None:
+        self._counters = compile_counters()
+
+    def on_train_batch_end(self, trainer: "pl.Trainer", pl_module: "pl.LightningModule", outputs, batch, batch_idx):
+        if self._counters is None or self.report is not None:
+            return
+        self.report = counters_since(self._counters)
+        pl_module.log_dict(
+            {"compile/graphs": float(self.report["graphs"]), "compile/graph_breaks": float(self.report["graph_breaks"])}
+        )
@@ -0,0 +1,212 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""low-overhead timing of the training hot path, and a windowed PyTorch profiler for deeper dives"""
+
+import glob
+import os
+import resource
+import sys
+import time
+from typing import Any, Dict, Iterator, Optional
+
+import pytorch_lightning as pl
+import torch
+from pytorch_lightning.callbacks import Callback
+from pytorch_lightning.profilers import PyTorchProfiler
+
+from lab import config
+
+_PHASES = ("data_wait", "forward", "backward", "optimizer", "step")
+
+
+class StepInstrumentation(Callback):
+    """Splits the wall time of every training step into dataloader wait, forward, backward and optimizer.
+
+    Every ``trainer.log_every_n_steps`` steps, the mean milliseconds of each phase since the last log are sent to the
+    trainer's logger under ``perf/``, with samples/sec, tokens/sec, the peak resident memory of the main process and
+    of the dataloader workers, and how many batches the workers have in flight. Timing is a ``perf_counter`` call per
+    hook, so it is cheap enough to leave on in every run.
+
+    The forward phase is ``training_step`` including the loss, and the optimizer phase ends with the step, so time
+    spent between hooks, e.g. in other callbacks, lands in the phase it interrupts. Tokens are counted as the
+    elements of the first 2-D integer tensor of a batch, e.g. the (batch, sequence) inputs of a language model.
+
+    Args:
+        synchronize: wait for the accelerator at every phase boundary, so timings measure kernels rather than
+            launches; this costs overlap, so it is off by default.
+    """
+
+    def __init__(self, synchronize: bool = False) -> None:
+        self.synchronize = synchronize
+        self._last: Dict[str, float] = {}
+        self._totals: Dict[str, float] = dict.fromkeys(_PHASES, 0.0)
+        self._steps = 0
+        self._samples = 0
+        self._tokens = 0
+        self._logged_step = -1
+
+    def on_train_epoch_start(self, trainer: "pl.Trainer", pl_module: "pl.LightningModule") -> None:
+        self._last = {"batch_end": self._now(pl_module)}
+
+    def on_train_batch_start(
+        self, trainer: "pl.Trainer", pl_module: "pl.LightningModule", batch: Any, batch_idx: int
+    ) -> None:
+        now = self._now(pl_module)
+        self._last = {"batch_end": self._last.get("batch_end", now), "batch_start": now}
+        self._samples += _batch_size(batch)
+        self._tokens += _num_tokens(batch)
+
+    def on_before_backward(self, trainer: "pl.Trainer", pl_module: "pl.LightningModule", loss: torch.Tensor) -> None:
+        self._last["before_backward"] = self._now(pl_module)
+
+    def on_after_backward(self, trainer: "pl.Trainer", pl_module: "pl.LightningModule") -> None:
+        self._last["after_backward"] = self._now(pl_module)
+
+    def on_before_optimizer_step(self, trainer: "pl.Trainer", pl_module: "pl.LightningModule", optimizer) -> None:
+        self._last["before_optimizer"] = self._now(pl_module)
+
+    def on_train_batch_end(
+        self, trainer: "pl.Trainer", pl_module: "pl.LightningModule", outputs: Any, batch: Any, batch_idx: int
+    ) -> None:
+        now = self._now(pl_module)
+        last = self._last
+        if "batch_start" not in last:
+            return
+        start = last["batch_start"]
+        forward_end = last.get("before_backward", now)
+        backward_end = last.get("after_backward", forward_end)
+        self._totals["data_wait"] += start - last["batch_end"]
+        self._totals["forward"] += forward_end - start
+        self._totals["backward"] += backward_end - forward_end
+        self._totals["optimizer"] += now - last["before_optimizer"] if "before_optimizer" in last else 0.0
+        self._totals["step"] += now - last["batch_end"]
+        self._steps += 1
+        self._last = {"batch_end": now}
+        # with gradient accumulation several batches share a global step, so log once per step
+        if (trainer.global_step + 1) % trainer.log_every_n_steps == 0 and trainer.global_step != self._logged_step:
+            self._logged_step = trainer.global_step
+            self._log(trainer)
+
+    def _log(self, trainer: "pl.Trainer") -> None:
+        if trainer.logger is None or not self._steps:
+            return
+        elapsed = self._totals["step"]
+        metrics = {f"perf/{phase}_ms": 1000 * total / self._steps for phase, total in self._totals.items()}
+        metrics["perf/samples_per_sec"] = self._samples / elapsed if elapsed else 0.0
+        if self._tokens:
+            metrics["perf/tokens_per_sec"] = self._tokens / elapsed if elapsed else 0.0
+        metrics.update(peak_rss_mb())
+        depth = worker_queue_depth(trainer)
+        if depth is not None:
+            metrics["perf/worker_queue_depth"] = depth
+        trainer.logger.log_metrics(metrics, step=trainer.global_step)
+        self._totals = dict.fromkeys(_PHASES, 0.0)
+        self._steps = self._samples = self._tokens = 0
+
+    def _now(self, pl_module: "pl.LightningModule") -> float:
+        if self.synchronize and pl_module.device.type == "cuda":
+            torch.cuda.synchronize(pl_module.device)
+        return time.perf_counter()
+
+
+def peak_rss_mb() -> Dict[str, float]:
+    """The peak resident memory of this process and of its largest child, in MB.
+
+    Children that are still running, like dataloader workers, are read from ``/proc`` where it exists; elsewhere only
+    children that have finished and been waited for are counted.
+    """
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 2**20 if sys.platform == "darwin" else 2**10
+    children = max([resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, *_live_children_peak_mb()])
+    return {
+        "perf/peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+        "perf/peak_rss_children_mb": children,
+    }
+
+
+def _live_children_peak_mb() -> Iterator[float]:
+    # every thread lists the children it started, so dataloader workers show up under whichever thread forked them
+    for children in glob.glob(f"/proc/{os.getpid()}/task/*/children"):
+        try:
+            with open(children) as f:
+                pids = f.read().split()
+        except OSError:
+            continue
+        for pid in pids:
+            try:
+                with open(f"/proc/{pid}/status") as f:
+                    for line in f:
+                        if line.startswith("VmHWM:"):
+                            # reported in kB
+                            yield int(line.split()[1]) / 2**10
+                            break
+            except OSError:
+                # the child exited in the meantime
+                continue
+
+
+def worker_queue_depth(trainer: "pl.Trainer") -> Optional[int]:
+    """How many batches the training dataloader's workers have been asked for and not yet handed over.
+
+    A depth near ``num_workers * prefetch_factor`` means the workers keep up; a depth near zero means training waits
+    on them. Returns None without worker processes.
+    """
+    fetcher = getattr(trainer.fit_loop, "_data_fetcher", None)
+    depths = [it._tasks_outstanding for it in _iterators(getattr(fetcher, "iterator", None))]
+    return sum(depths) if depths else None
+
+
+def _iterators(obj: Any, depth: int = 0) -> Iterator[Any]:
+    # Lightning nests the DataLoader iterators in a CombinedLoader and its mode iterator
+    if obj is None or depth > 4:
+        return
+    if hasattr(obj, "_tasks_outstanding"):
+        yield obj
+        return
+    for child in getattr(obj, "iterators", None) or ():
+        yield from _iterators(child, depth + 1)
+    yield from _iterators(getattr(obj, "_iterator", None), depth + 1)
+
+
+def _batch_size(batch: Any) -> int:
+    if isinstance(batch, torch.Tensor):
+        return len(batch) if batch.dim() else 1
+    if isinstance(batch, (tuple, list)) and batch:
+        return _batch_size(batch[0])
+    if isinstance(batch, dict) and batch:
+        return _batch_size(next(iter(batch.values())))
+    return 0
+
+
+def _num_tokens(batch: Any) -> int:
+    tensors = batch.values() if isinstance(batch, dict) else batch if isinstance(batch, (tuple, list)) else [batch]
+    for tensor in tensors:
+        if isinstance(tensor, torch.Tensor) and tensor.dim() == 2 and not tensor.is_floating_point():
+            return tensor.numel()
+    return 0
+
+
+def window_profiler(
+    start: int = 100, end: int = 120, dirpath: str = config.TORCHPROFILERPATH, filename: str = "profiler", **kwargs
+) -> PyTorchProfiler:
+    """A ``PyTorchProfiler`` that only records training steps ``start`` to ``end``, after one warm-up step.
+
+    Profiling every step slows training down and fills ``logs/torch_profiler`` with traces, so pass this to the
+    trainer for a short, representative window instead.
+    """
+    if not 0 < start < end:
+        raise ValueError(f"The profiled window must satisfy 0 < start < end, got {start} and {end}")
+    schedule = torch.profiler.schedule(skip_first=start - 1, wait=0, warmup=1, active=end - start, repeat=1)
+    return PyTorchProfiler(dirpath=dirpath, filename=filename, schedule=schedule, **kwargs)
@@ -0,0 +1,223 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""streams predictions to sharded, memory-mappable files as they are produced"""
+
+import glob
+import json
+import os
+import queue
+import threading
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Sequence, Union
+
+import numpy as np
+import pytorch_lightning as pl
+import torch
+from pytorch_lightning.callbacks import BasePredictionWriter
+
+from lab.components.io import atomic_write
+
+Arrays = Dict[str, np.ndarray]
+
+
+class ShardedPredictionWriter(BasePredictionWriter):
+    """Writes predictions batch by batch to ``.npy`` shards of ``shard_size`` rows, so memory stays flat.
+
+    Every rank writes its own shards, ``rank{r}-dl{d}-shard{n}.{field}.npy``, and an index,
+    ``rank{r}-dl{d}-index.json``, listing them; ``PredictionReader`` stitches them back together. Predictions may
+    be tensors, or tuples or dicts of tensors, with the batch as their first dimension. The sample indices of every
+    row are stored as the "index" field when the dataloader reports them.
+
+    Run the trainer's ``predict`` with ``return_predictions=False`` so the outputs are not also kept in memory.
+
+    Args:
+        output_dir: the directory of the shards.
+        shard_size: the rows of every shard.
+        background: serialize shards on a background thread so prediction does not wait for the disk.
+        max_pending: the shards queued for the background thread before prediction waits for it.
+    """
+
+    def __init__(
+        self, output_dir: str, shard_size: int = 65_536, background: bool = True, max_pending: int = 4
+    ) -> None:
+        super().__init__(write_interval="batch")
+        self.output_dir = str(output_dir)
+        self.shard_size = shard_size
+        self.background = background
+        self.max_pending = max_pending
+        self._buffers: Dict[int, List[Arrays]] = defaultdict(list)
+        self._buffered_rows: Dict[int, int] = defaultdict(int)
+        self._shards: Dict[int, List[Dict[str, Any]]] = defaultdict(list)
+        self._queue: Optional[queue.Queue] = None
+        self._thread: Optional[threading.Thread] = None
+        self._error: Optional[BaseException] = None
+        self._rank = 0
+
+    def on_predict_start(self, trainer: "pl.Trainer", pl_module: "pl.LightningModule") -> None:
+        os.makedirs(self.output_dir, exist_ok=True)
+        self._rank = trainer.global_rank
+        # start from a clean slate for this rank, other ranks own their own files
+        for path in glob.glob(os.path.join(self.output_dir, f"rank{self._rank}-*")):
+            os.remove(path)
+        self._buffers.clear()
+        self._buffered_rows.clear()
+        self._shards.clear()
+        if self.background:
+            self._queue = queue.Queue(maxsize=self.max_pending)
+            self._thread = threading.Thread(target=self._drain, name="prediction-writer", daemon=True)
+            self._thread.start()
+
+    def write_on_batch_end(
+        self,
+        trainer: "pl.Trainer",
+        pl_module: "pl.LightningModule",
+        prediction: Any,
+        batch_indices: Optional[Sequence[int]],
+        batch: Any,
+        batch_idx: int,
+        dataloader_idx: int,
+    ) -> None:
+        arrays = _to_arrays(prediction)
+        rows = len(next(iter(arrays.values())))
+        if batch_indices is not None and len(batch_indices) == rows:
+            arrays["index"] = np.asarray(batch_indices, dtype=np.int64)
+        self._buffers[dataloader_idx].append(arrays)
+        self._buffered_rows[dataloader_idx] += rows
+        while self._buffered_rows[dataloader_idx] >= self.shard_size:
+            self._flush(dataloader_idx, self.shard_size)
+
+    def on_predict_end(self, trainer: "pl.Trainer", pl_module: "pl.LightningModule") -> None:
+        for dataloader_idx in list(self._buffers):
+            if self._buffered_rows[dataloader_idx]:
+                self._flush(dataloader_idx, self._buffered_rows[dataloader_idx])
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            raise self._error
+        for dataloader_idx, shards in self._shards.items():
+            index = {"rank": self._rank, "dataloader_idx": dataloader_idx, "shards": shards}
+            atomic_write(self._prefix(dataloader_idx, "index.json"), lambda f: f.write(json.dumps(index).encode()))
+
+    def _flush(self, dataloader_idx: int, rows: int) -> None:
+        # cut exactly `rows` rows from the front of the buffer, keeping the remainder for the next shard
+        batches = self._buffers[dataloader_idx]
+        fields = {name: np.concatenate([batch[name] for batch in batches]) for name in batches[0]}
+        shard = {name: array[:rows] for name, array in fields.items()}
+        rest = {name: array[rows:] for name, array in fields.items()}
+        self._buffers[dataloader_idx] = [rest] if len(next(iter(rest.values()))) else []
+        self._buffered_rows[dataloader_idx] -= rows
+
+        shards = self._shards[dataloader_idx]
+        prefix = self._prefix(dataloader_idx, f"shard{len(shards):05d}")
+        shards.append({"prefix": os.path.basename(prefix), "rows": rows, "fields": sorted(shard)})
+        if self._queue is None:
+            _save_shard(prefix, shard)
+            return
+        if self._error is not None:
+            raise self._error
+        self._queue.put((prefix, shard))
+
+    def _drain(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._error is None:
+                try:
+                    _save_shard(*item)
+                except BaseException as error:  # surfaced on the prediction thread
+                    self._error = error
+
+    def _prefix(self, dataloader_idx: int, name: str) -> str:
+        return os.path.join(self.output_dir, f"rank{self._rank}-dl{dataloader_idx}-{name}")
+
+
+class PredictionReader:
+    """Lazily reads the predictions written by ``ShardedPredictionWriter``, in rank and shard order.
+
+    Indexing with an integer or a slice only memory-maps the shards it touches, e.g. ``reader[1000:2000]`` returns a
+    dict of arrays with 1000 rows per field.
+
+    Args:
+        output_dir: the directory of the shards.
+        dataloader_idx: which predict dataloader to read.
+    """
+
+    def __init__(self, output_dir: str, dataloader_idx: int = 0) -> None:
+        self.output_dir = str(output_dir)
+        self.shards: List[Dict[str, Any]] = []
+        for path in sorted(glob.glob(os.path.join(self.output_dir, f"rank*-dl{dataloader_idx}-index.json"))):
+            with open(path) as f:
+                self.shards.extend(json.load(f)["shards"])
+        self.offsets = np.concatenate([[0], np.cumsum([shard["rows"] for shard in self.shards])]).astype(np.int64)
+        self.fields = self.shards[0]["fields"] if self.shards else []
+
+    def __len__(self) -> int:
+        return int(self.offsets[-1])
+
+    def shard(self, i: int) -> Arrays:
+        """The arrays of shard ``i``, memory-mapped."""
+        prefix = os.path.join(self.output_dir, self.shards[i]["prefix"])
+        return {name: np.load(f"{prefix}.{name}.npy", mmap_mode="r") for name in self.fields}
+
+    def __getitem__(self, index: Union[int, slice]) -> Arrays:
+        if isinstance(index, int):
+            index = index + len(self) if index < 0 else index
+            if not 0 <= index < len(self):
+                raise IndexError(f"index {index} is out of range for {len(self)} predictions")
+            return {name: array[0] for name, array in self[index : index + 1].items()}
+        start, stop, step = index.indices(len(self))
+        if step < 0:
+            raise ValueError("Slices of predictions must have a positive step")
+        first = int(np.searchsorted(self.offsets, start, side="right")) - 1
+        last = int(np.searchsorted(self.offsets, max(stop, start), side="left"))
+        parts = defaultdict(list)
+        for i in range(max(first, 0), min(last, len(self.shards))):
+            lo, hi = max(start - self.offsets[i], 0), min(stop, self.offsets[i + 1]) - self.offsets[i]
+            for name, array in self.shard(i).items():
+                parts[name].append(array[lo:hi])
+        if not parts:
+            return {name: np.empty((0,)) for name in self.fields}
+        return {name: np.concatenate(arrays)[::step] for name, arrays in parts.items()}
+
+    def read(self) -> Arrays:
+        """Every prediction, in dataset order when the sample indices were recorded."""
+        arrays = self[:]
+        if "index" in arrays:
+            order = np.argsort(arrays["index"], kind="stable")
+            arrays = {name: array[order] for name, array in arrays.items()}
+        return arrays
+
+
+def _to_arrays(prediction: Any) -> Arrays:
+    if isinstance(prediction, torch.Tensor):
+        return {"predictions": prediction.detach().cpu().numpy()}
+    if isinstance(prediction, dict):
+        return {str(name): _to_numpy(value) for name, value in prediction.items()}
+    if isinstance(prediction, (tuple, list)):
+        return {f"field{i}": _to_numpy(value) for i, value in enumerate(prediction)}
+    raise TypeError(f"Cannot write predictions of type {type(prediction).__name__}")
+
+
+def _to_numpy(value: Any) -> np.ndarray:
+    return value.detach().cpu().numpy() if isinstance(value, torch.Tensor) else np.asarray(value)
+
+
+def _save_shard(prefix: str, shard: Arrays) -> None:
+    for name, array in shard.items():
+        atomic_write(f"{prefix}.{name}.npy", lambda f: np.save(f, np.ascontiguousarray(array)))
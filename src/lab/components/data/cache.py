@@ -0,0 +1,231 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import hashlib
+import json
+import os
+import shutil
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from lab import config
+
+Arrays = Dict[str, np.ndarray]
+
+_META = "meta.json"
+
+
+def cache_key(*parts: Any) -> str:
+    """A content address for ``parts``, e.g. a dataset fingerprint, a preprocessing config and hyperparameters.
+
+    Parts are serialized as sorted JSON, falling back to ``str`` for other objects, so equal configs map to the same
+    key in every process.
+    """
+    payload = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+
+def directory_fingerprint(path: Union[str, os.PathLike], exclude: Tuple[Union[str, os.PathLike], ...] = ()) -> str:
+    """Identifies the files under ``path`` by their relative paths, sizes and modification times.
+
+    Only ``stat`` is called, so this is cheap even for large datasets, and it changes whenever a file is added,
+    removed or rewritten. Directories in ``exclude``, e.g. caches kept under ``path``, are skipped.
+    """
+    excluded = {os.path.abspath(directory) for directory in exclude}
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if os.path.abspath(os.path.join(root, d)) not in excluded)
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            stat = os.stat(file_path)
+            digest.update(f"{os.path.relpath(file_path, path)}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()[:16]
+
+
+class ArtifactCache:
+    """A directory of content-addressed entries of named arrays, shared by every process that opens it.
+
+    Every entry is a directory of ``.npy`` files named by its key. Entries are written to a private directory and
+    renamed into place, so concurrent trials that build the same entry never see a partial one, and are read back
+    memory-mapped copy-on-write, so trials share the pages of one copy through the page cache.
+
+    With ``max_bytes``, the least recently used entries are evicted after every write until the cache fits.
+
+    Args:
+        root: the cache directory.
+        max_bytes: the size limit of all entries together; unlimited by default.
+    """
+
+    def __init__(self, root: str = config.CACHEPATH, max_bytes: Optional[int] = None) -> None:
+        self.root = str(root)
+        self.max_bytes = max_bytes
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    def __contains__(self, key: str) -> bool:
+        return os.path.exists(os.path.join(self.path(key), _META))
+
+    def get(self, key: str) -> Optional[Arrays]:
+        """The arrays of entry ``key``, memory-mapped, or None if the entry does not exist."""
+        path = self.path(key)
+        try:
+            with open(os.path.join(path, _META)) as f:
+                names = json.load(f)["arrays"]
+            arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="c") for name in names}
+        except FileNotFoundError:
+            # missing, or evicted by another process in the meantime
+            return None
+        _touch(path)
+        return arrays
+
+    def put(self, key: str, arrays: Arrays, metadata: Optional[Dict[str, Any]] = None) -> Arrays:
+        """Stores ``arrays`` as entry ``key`` and returns them memory-mapped from the files written."""
+        path = self.path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        os.makedirs(tmp_path, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, f"{name}.npy"), np.asarray(array))
+        with open(os.path.join(tmp_path, _META), "w") as f:
+            json.dump({"arrays": list(arrays), "created": time.time(), **(metadata or {})}, f)
+        # map the files just written rather than looking the entry up again, which another process may have evicted by
+        # then; the maps outlive the rename, and the removal below, on POSIX
+        stored = {name: np.load(os.path.join(tmp_path, f"{name}.npy"), mmap_mode="c") for name in arrays}
+        try:
+            # entries are directories, renamed into place whole; their files are written by this process alone
+            os.replace(tmp_path, path)
+        except OSError:
+            # another process stored the same entry first; both are built from the same content
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        self.evict(keep=key)
+        return stored
+
+    def get_or_create(self, key: str, build: Callable[[], Arrays], metadata: Optional[Dict[str, Any]] = None) -> Arrays:
+        """Returns entry ``key``, building and storing it with ``build`` on a miss."""
+        arrays = self.get(key)
+        return self.put(key, build(), metadata) if arrays is None else arrays
+
+    def entries(self) -> List[Tuple[str, int, float]]:
+        """The (key, bytes, last used) of every entry, least recently used first."""
+        entries = []
+        for key in os.listdir(self.root) if os.path.isdir(self.root) else []:
+            if key in self:
+                path = self.path(key)
+                size = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+                entries.append((key, size, os.path.getmtime(path)))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def evict(self, keep: Optional[str] = None) -> List[str]:
+        """Removes the least recently used entries, except ``keep``, until the cache fits in ``max_bytes``."""
+        if self.max_bytes is None:
+            return []
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        evicted = []
+        for key, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            # rename first so readers never open a half-deleted entry; open memory maps stay valid on POSIX
+            doomed = f"{self.path(key)}.{os.getpid()}.evicted"
+            try:
+                os.rename(self.path(key), doomed)
+            except OSError:
+                continue
+            shutil.rmtree(doomed, ignore_errors=True)
+            total -= size
+            evicted.append(key)
+        return evicted
+
+
+class CachedDataset(Dataset):
+    """A dataset materialized into an ``ArtifactCache``: every sample is read back from memory-mapped arrays.
+
+    Samples are tuples of tensors, or of numbers, whose first dimension may vary from sample to sample; field ``i`` is
+    stored as the concatenation of its values and the offsets of every sample.
+
+    Args:
+        dataset: the dataset to materialize, with any transforms applied, or a function that builds it, which is only
+            called on a cache miss.
+        key: the cache key of the materialized samples, see ``cache_key``.
+        cache: the cache that holds them.
+    """
+
+    def __init__(self, dataset: Union[Dataset, Callable[[], Dataset]], key: str, cache: Optional[ArtifactCache] = None):
+        self.key = key
+        self.cache = cache or ArtifactCache()
+        build = dataset if callable(dataset) and not isinstance(dataset, Dataset) else lambda: dataset
+        arrays = self.cache.get_or_create(key, lambda: materialize(build()))
+        self.single = bool(arrays["single"])
+        self.num_fields = len([name for name in arrays if name.endswith(".values")])
+        self.values = [torch.from_numpy(arrays[f"field{i}.values"]) for i in range(self.num_fields)]
+        self.offsets = [arrays[f"field{i}.offsets"] for i in range(self.num_fields)]
+        self.scalar = arrays["scalar"]
+
+    @property
+    def fingerprint(self) -> str:
+        return self.key
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets[0])
+
+    def __len__(self) -> int:
+        return len(self.offsets[0]) - 1
+
+    def __getitem__(self, index: int):
+        fields = []
+        for values, offsets, scalar in zip(self.values, self.offsets, self.scalar):
+            start, end = offsets[index], offsets[index + 1]
+            fields.append(values[start] if scalar else values[start:end])
+        return fields[0] if self.single else tuple(fields)
+
+
+def materialize(dataset: Dataset) -> Arrays:
+    """Flattens the samples of ``dataset`` into the arrays read by ``CachedDataset``."""
+    fields: Optional[List[List[np.ndarray]]] = None
+    single = False
+    for sample in _samples(dataset):
+        single = not isinstance(sample, (tuple, list))
+        sample = (sample,) if single else sample
+        if fields is None:
+            fields = [[] for _ in sample]
+        for values, value in zip(fields, sample):
+            values.append(np.asarray(value))
+    if fields is None:
+        raise ValueError("Cannot materialize an empty dataset")
+    arrays: Arrays = {"single": np.asarray(single), "scalar": np.asarray([values[0].ndim == 0 for values in fields])}
+    for i, values in enumerate(fields):
+        shaped = [value.reshape(1) if value.ndim == 0 else value for value in values]
+        arrays[f"field{i}.values"] = np.concatenate(shaped)
+        arrays[f"field{i}.offsets"] = np.concatenate([[0], np.cumsum([len(value) for value in shaped])])
+    return arrays
+
+
+def _samples(dataset: Dataset) -> Iterator[Any]:
+    for index in range(len(dataset)):
+        yield dataset[index]
+
+
+def _touch(path: str) -> None:
+    try:
+        os.utime(path)
+    except OSError:
+        pass
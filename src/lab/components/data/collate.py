@@ -0,0 +1,67 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import List, Optional, Sequence, Tuple
+
+import torch
+from torch import Tensor
+
+
+class PackingCollate:
+    """Collates variable-length ``(inputs, targets)`` sequence pairs into padded, optionally packed, rows.
+
+    With ``max_tokens`` set, samples are packed first-fit-decreasing into rows of at most ``max_tokens`` tokens, so
+    short samples share a row instead of each being padded to the longest one. A sample longer than ``max_tokens``
+    gets a row of its own. Without ``max_tokens`` every sample gets its own row.
+
+    Returns:
+        ``(inputs, targets, segment_ids)``, where ``segment_ids`` numbers the samples in each row from 1 and is 0 on
+        padding, so models can keep packed samples from attending to one another.
+    """
+
+    def __init__(self, max_tokens: Optional[int] = None, pad_value: int = 0) -> None:
+        self.max_tokens = max_tokens
+        self.pad_value = pad_value
+
+    def __call__(self, samples: Sequence[Tuple[Tensor, Tensor]]) -> Tuple[Tensor, Tensor, Tensor]:
+        rows = self._pack(samples) if self.max_tokens else [[sample] for sample in samples]
+        width = max(sum(len(inputs) for inputs, _ in row) for row in rows)
+        first_inputs, first_targets = samples[0]
+        inputs = first_inputs.new_full((len(rows), width), self.pad_value)
+        targets = first_targets.new_full((len(rows), width), self.pad_value)
+        segment_ids = torch.zeros(len(rows), width, dtype=torch.long)
+        for i, row in enumerate(rows):
+            start = 0
+            for segment, (sample_inputs, sample_targets) in enumerate(row, start=1):
+                end = start + len(sample_inputs)
+                inputs[i, start:end] = sample_inputs
+                targets[i, start:end] = sample_targets
+                segment_ids[i, start:end] = segment
+                start = end
+        return inputs, targets, segment_ids
+
+    def _pack(self, samples: Sequence[Tuple[Tensor, Tensor]]) -> List[List[Tuple[Tensor, Tensor]]]:
+        rows: List[List[Tuple[Tensor, Tensor]]] = []
+        room: List[int] = []
+        for sample in sorted(samples, key=lambda sample: len(sample[0]), reverse=True):
+            length = len(sample[0])
+            for i, free in enumerate(room):
+                if length <= free:
+                    rows[i].append(sample)
+                    room[i] -= length
+                    break
+            else:
+                rows.append([sample])
+                room.append(self.max_tokens - length)
+        return rows
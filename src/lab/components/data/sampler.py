@@ -0,0 +1,80 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from itertools import islice
+from typing import Iterator, List, Sequence
+
+import torch
+from torch.utils.data import BatchSampler, Dataset, Sampler, Subset
+
+
+class BucketBatchSampler(BatchSampler):
+    """Groups samples of similar length into the same batch.
+
+    Indices are drawn from ``sampler`` in windows of ``batch_size * bucket_size``; each window is sorted by length,
+    cut into batches, and the batches of the window are shuffled. Because the wrapped sampler is a regular
+    ``sampler`` argument, Lightning can swap it for a ``DistributedSampler`` under DDP.
+
+    Args:
+        sampler: the sampler that yields dataset indices.
+        batch_size: samples per batch.
+        drop_last: drop batches with fewer than ``batch_size`` samples.
+        lengths: the length of every sample in the dataset, indexed by dataset index.
+        bucket_size: the number of batches sorted together.
+        shuffle: shuffle the order of batches within a window.
+    """
+
+    def __init__(
+        self,
+        sampler: Sampler[int],
+        batch_size: int,
+        drop_last: bool = False,
+        lengths: Sequence[int] = (),
+        bucket_size: int = 100,
+        shuffle: bool = True,
+    ) -> None:
+        super().__init__(sampler, batch_size, drop_last)
+        self.lengths = lengths
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+
+    def __iter__(self) -> Iterator[List[int]]:
+        indices = iter(self.sampler)
+        while window := list(islice(indices, self.batch_size * self.bucket_size)):
+            window.sort(key=self.lengths.__getitem__)
+            batches = [window[i : i + self.batch_size] for i in range(0, len(window), self.batch_size)]
+            if self.drop_last and len(batches[-1]) < self.batch_size:
+                batches.pop()
+            order = torch.randperm(len(batches)).tolist() if self.shuffle else range(len(batches))
+            yield from (batches[i] for i in order)
+
+    def __len__(self) -> int:
+        window = self.batch_size * self.bucket_size
+        full_windows, remainder = divmod(len(self.sampler), window)
+        if self.drop_last:
+            return full_windows * self.bucket_size + remainder // self.batch_size
+        return full_windows * self.bucket_size + -(-remainder // self.batch_size)
+
+
+def sequence_lengths(dataset: Dataset) -> Sequence[int]:
+    """Returns the length of the input sequence of every sample.
+
+    Datasets can expose a ``lengths`` attribute to avoid a pass over every sample.
+    """
+    if isinstance(dataset, Subset):
+        lengths = sequence_lengths(dataset.dataset)
+        return [lengths[i] for i in dataset.indices]
+    if hasattr(dataset, "lengths"):
+        return dataset.lengths
+    return [len(dataset[i][0]) for i in range(len(dataset))]
@@ -0,0 +1,110 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import os
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+from torch.utils.data import Dataset
+
+from lab import config
+from lab.components.io import atomic_write
+
+
+def dataset_fingerprint(dataset: Dataset) -> str:
+    """Identifies a dataset for caching.
+
+    Datasets should expose a ``fingerprint`` attribute that changes with their content; otherwise the class, the
+    length and the data directory stand in for it.
+    """
+    if hasattr(dataset, "fingerprint"):
+        return str(dataset.fingerprint)
+    cls = type(dataset)
+    root = getattr(dataset, "data_dir", getattr(dataset, "root", ""))
+    return f"{cls.__module__}.{cls.__qualname__}:{len(dataset)}:{root}"
+
+
+def load_or_create_split(
+    dataset: Dataset,
+    train_size: float,
+    seed: int = 42,
+    splits_dir: str = config.SPLITSPATH,
+    stratify: bool = False,
+    num_folds: Optional[int] = None,
+    fold: int = 0,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns train and validation indices for ``dataset``, computing them only on the first call.
+
+    Splits are stored as int64 ``.npy`` index arrays under ``splits_dir``, keyed by the dataset fingerprint,
+    ``train_size``, ``seed`` and mode, and are memory-mapped on later calls, so every trial and every rank reads the
+    same partition without recomputing it.
+
+    Args:
+        dataset: the dataset to split.
+        train_size: the fraction of samples used for training; ignored with ``num_folds``.
+        seed: the seed of the permutation.
+        splits_dir: where the index arrays are stored.
+        stratify: keep the label proportions of every split equal to those of the dataset.
+        num_folds: split into ``num_folds`` folds for cross validation and use fold ``fold`` for validation.
+        fold: the validation fold, with ``num_folds``.
+    """
+    if num_folds is not None and num_folds < 2:
+        # a single fold would validate on every sample and leave nothing to train on
+        raise ValueError(f"num_folds must be at least 2, got {num_folds}")
+    if num_folds is not None and not 0 <= fold < num_folds:
+        raise ValueError(f"fold must be in [0, {num_folds}), got {fold}")
+    mode = f"{'stratified' if stratify else 'random'}-{f'{num_folds}fold' if num_folds else train_size}"
+    key = hashlib.sha256(f"{dataset_fingerprint(dataset)}-{mode}-{seed}".encode()).hexdigest()[:16]
+    suffix = f"-fold{fold}" if num_folds else ""
+    train_path = os.path.join(splits_dir, f"{key}{suffix}-train.npy")
+    val_path = os.path.join(splits_dir, f"{key}{suffix}-val.npy")
+
+    if not (os.path.exists(train_path) and os.path.exists(val_path)):
+        labels = _labels(dataset) if stratify else np.zeros(len(dataset), dtype=np.int64)
+        folds = _assign_folds(labels, num_folds or 0, train_size, np.random.default_rng(seed))
+        os.makedirs(splits_dir, exist_ok=True)
+        for k in range(num_folds or 1):
+            val_fold = k if num_folds else 0
+            name = f"{key}-fold{k}" if num_folds else key
+            _save(os.path.join(splits_dir, f"{name}-train.npy"), np.flatnonzero(folds != val_fold))
+            _save(os.path.join(splits_dir, f"{name}-val.npy"), np.flatnonzero(folds == val_fold))
+
+    return np.load(train_path, mmap_mode="r"), np.load(val_path, mmap_mode="r")
+
+
+def _assign_folds(labels: np.ndarray, num_folds: int, train_size: float, rng: np.random.Generator) -> np.ndarray:
+    folds = np.empty(len(labels), dtype=np.int64)
+    for label in np.unique(labels):
+        members = rng.permutation(np.flatnonzero(labels == label))
+        if num_folds:
+            folds[members] = np.arange(len(members)) % num_folds
+        else:
+            # a single split marks training samples -1 and validation samples 0
+            num_train = int(len(members) * train_size)
+            folds[members[:num_train]] = -1
+            folds[members[num_train:]] = 0
+    return folds
+
+
+def _labels(dataset: Dataset) -> np.ndarray:
+    for attr in ("targets", "labels"):
+        if hasattr(dataset, attr):
+            return np.asarray(getattr(dataset, attr))
+    return np.asarray([int(dataset[i][1]) for i in range(len(dataset))])
+
+
+def _save(path: str, indices: Sequence[int]) -> None:
+    # ranks may race to write the same split; they write identical arrays, so the last rename wins harmlessly
+    atomic_write(path, lambda f: np.save(f, np.asarray(indices, dtype=np.int64)))
@@ -0,0 +1,172 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""execution modes for training and inference: eager fp32, CPU bf16 autocast and torch.compile, and their checks"""
+
+import contextlib
+import os
+from typing import Any, Callable, ContextManager, Dict, List, Optional
+
+import torch
+from torch import nn
+
+from lab import config
+
+# "compile-bf16" compiles the model and runs it under bf16 autocast
+MODES = ("eager", "bf16", "compile", "compile-bf16")
+
+
+def check_mode(mode: str) -> str:
+    if mode not in MODES:
+        raise ValueError(f"Unknown execution mode {mode!r}, expected one of {MODES}")
+    return mode
+
+
+def uses_bf16(mode: str) -> bool:
+    return check_mode(mode).endswith("bf16")
+
+
+def uses_compile(mode: str) -> bool:
+    return check_mode(mode).startswith("compile")
+
+
+def configure_compile_cache(cache_dir: str = config.COMPILECACHEPATH) -> str:
+    """Keeps Inductor's compiled graphs and kernels in ``cache_dir`` so later runs and processes reuse them.
+
+    Inductor caches FX graphs, and AOTAutograd their forward and backward graphs, on disk by content; pointing every
+    run at the same directory under ``data/cache`` means a short job only pays for tracing, not for code generation.
+    An explicit ``TORCHINDUCTOR_CACHE_DIR`` in the environment takes precedence. Returns the directory in use.
+    """
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", str(cache_dir))
+    os.makedirs(os.environ["TORCHINDUCTOR_CACHE_DIR"], exist_ok=True)
+    import torch._functorch.config
+    import torch._inductor.config
+
+    torch._inductor.config.fx_graph_cache = True
+    torch._functorch.config.enable_autograd_cache = True
+    return os.environ["TORCHINDUCTOR_CACHE_DIR"]
+
+
+def compile_module(
+    module: nn.Module, backend: str = "inductor", compile_mode: Optional[str] = None, dynamic: Optional[bool] = None
+) -> List[str]:
+    """Compiles ``module`` in place with ``torch.compile`` and returns the names of the compiled modules.
+
+    Compiling in place with ``nn.Module.compile`` keeps parameter names, so checkpoints and state dicts are the same
+    as in eager mode. A LightningModule's own hooks such as ``training_step`` are not compiled; its child networks
+    are, e.g. ``model`` of ``LightningTransformer`` or ``encoder`` and ``decoder`` of ``DiffusionModel``. Any other
+    module is compiled whole, and modules that are already compiled are left alone. ``backend`` is any
+    ``torch.compile`` backend, e.g. "inductor", "aot_eager" or "eager".
+    """
+    from pytorch_lightning import LightningModule
+
+    if backend == "inductor":
+        configure_compile_cache()
+    kwargs = dict(backend=backend, mode=compile_mode, dynamic=dynamic)
+    if isinstance(module, LightningModule):
+        targets = [(name, child) for name, child in module.named_children() if any(True for _ in child.parameters())]
+    else:
+        targets = [("", module)]
+    for _, target in targets:
+        # compiling twice, e.g. on every `setup`, would throw away the graphs traced so far
+        if getattr(target, "_compiled_call_impl", None) is None:
+            target.compile(**kwargs)
+    return [name for name, _ in targets]
+
+
+def autocast(mode: str, device_type: str = "cpu") -> ContextManager:
+    """bf16 autocast for the bf16 modes, a no-op otherwise."""
+    if not uses_bf16(mode):
+        return contextlib.nullcontext()
+    return torch.autocast(device_type, dtype=torch.bfloat16)
+
+
+def apply_mode(module: nn.Module, mode: str, backend: str = "inductor") -> Callable[..., Any]:
+    """Prepares ``module`` for inference in ``mode`` and returns a function running it without autograd.
+
+    Outputs computed under autocast are cast back to float32, so callers see the same dtypes in every mode.
+    """
+    if uses_compile(mode):
+        compile_module(module, backend)
+    module.eval()
+
+    @torch.no_grad()
+    def run(*args: Any, **kwargs: Any) -> Any:
+        with autocast(mode):
+            outputs = module(*args, **kwargs)
+        return _to_float32(outputs) if uses_bf16(mode) else outputs
+
+    return run
+
+
+def trainer_precision(mode: str) -> Optional[str]:
+    """The Lightning ``precision`` of a mode: bf16 modes train with mixed bf16 autocast."""
+    return "bf16-mixed" if uses_bf16(mode) else None
+
+
+def graph_break_report(fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Dict[str, Any]:
+    """Traces ``fn(*args, **kwargs)`` with dynamo and reports where and why the graph is split.
+
+    Every break falls back to Python between two compiled graphs, so a model that compiles to one graph with no
+    breaks gets the most out of ``torch.compile``. Returns the graph and break counts and the distinct reasons,
+    each with the innermost user frame that caused it.
+    """
+    torch._dynamo.reset()
+    explanation = torch._dynamo.explain(fn)(*args, **kwargs)
+    reasons = []
+    for reason in explanation.break_reasons:
+        frame = reason.user_stack[-1] if reason.user_stack else None
+        where = f"{frame.filename}:{frame.lineno}" if frame is not None else "unknown"
+        if (reason.reason, where) not in reasons:
+            reasons.append((reason.reason, where))
+    return {
+        "graphs": explanation.graph_count,
+        "graph_breaks": explanation.graph_break_count,
+        "ops": explanation.op_count,
+        "reasons": [{"reason": reason, "where": where} for reason, where in reasons],
+    }
+
+
+def compile_counters() -> Dict[str, Any]:
+    """Dynamo's running totals in this process: graphs compiled, and graph breaks with their reasons.
+
+    Unlike ``graph_break_report``, this reads what compiling has already recorded, without tracing again; subtract
+    two snapshots with ``counters_since`` to attribute them to a stretch of code.
+    """
+    from torch._dynamo.utils import counters
+
+    return {"graphs": counters["stats"]["unique_graphs"], "graph_breaks": dict(counters["graph_break"])}
+
+
+def counters_since(before: Dict[str, Any]) -> Dict[str, Any]:
+    """The graphs and graph breaks recorded since the ``compile_counters`` snapshot ``before``."""
+    now = compile_counters()
+    breaks = {
+        reason: count - before["graph_breaks"].get(reason, 0)
+        for reason, count in now["graph_breaks"].items()
+        if count > before["graph_breaks"].get(reason, 0)
+    }
+    return {
+        "graphs": now["graphs"] - before["graphs"],
+        "graph_breaks": sum(breaks.values()),
+        "reasons": [{"reason": reason, "count": count} for reason, count in breaks.items()],
+    }
+
+
+def _to_float32(outputs: Any) -> Any:
+    if isinstance(outputs, torch.Tensor):
+        return outputs.float() if outputs.dtype == torch.bfloat16 else outputs
+    if isinstance(outputs, (tuple, list)):
+        return type(outputs)(_to_float32(output) for output in outputs)
+    return outputs
@@ -0,0 +1,148 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""runs a sweep's trials concurrently across a local process pool"""
+
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, Optional
+
+from lab import config
+from lab.components.hpo.sweep import _OPTUNA_AVAILABLE, load_study
+
+if _OPTUNA_AVAILABLE:
+    import optuna
+
+log = logging.getLogger(__name__)
+
+Objective = Callable[["optuna.Trial"], float]
+
+
+def run_sweep(
+    objective: Objective,
+    study_name: str,
+    n_trials: int,
+    concurrent_trials: Optional[int] = None,
+    threads_per_trial: int = 1,
+    direction: str = "minimize",
+    pruner: str = "median",
+    storage_dir: str = config.OPTUNAPATH,
+    timeout: Optional[float] = None,
+    seed: Optional[int] = None,
+    **pruner_kwargs: Any,
+) -> "optuna.Study":
+    """Runs ``objective`` until the study holds ``n_trials`` finished trials and returns the study.
+
+    Trials run ``concurrent_trials`` at a time, by default as many as fit in the machine's cores at
+    ``threads_per_trial`` threads each, in worker processes that share the study through its SQLite file under
+    ``storage_dir``. Completed and pruned trials count towards ``n_trials``, so calling ``run_sweep`` again after an
+    interruption only runs the trials that are missing.
+
+    ``objective`` must be picklable, i.e. defined at module level, because workers are spawned. Report intermediate
+    values from it to enable pruning, e.g. with ``lab.components.hpo.sweep.trial_trainer``.
+
+    Args:
+        objective: trains one configuration sampled from the trial and returns the metric to optimize.
+        study_name: names the study and its database file.
+        n_trials: the number of finished trials to reach.
+        concurrent_trials: the number of trials running at once.
+        threads_per_trial: the intra-op threads of every trial.
+        direction: "minimize" or "maximize".
+        pruner: "median", "successive_halving", "hyperband" or "none"; ``pruner_kwargs`` configure it.
+        storage_dir: where the study database lives.
+        timeout: stop starting new trials after this many seconds.
+        seed: seeds the sampler of every worker, offset by the worker index.
+    """
+    if concurrent_trials is None:
+        concurrent_trials = max(1, (os.cpu_count() or 1) // threads_per_trial)
+    study = load_study(study_name, direction, pruner, storage_dir, seed=seed, **pruner_kwargs)
+    remaining = n_trials - _finished_trials(study)
+    if remaining <= 0:
+        log.info(f"Study {study_name!r} already has {n_trials} finished trials")
+        return study
+    log.info(f"Running {remaining} trials of study {study_name!r}, {concurrent_trials} at a time")
+
+    worker_args = (objective, study_name, n_trials, direction, pruner, storage_dir, timeout, pruner_kwargs)
+    if concurrent_trials == 1:
+        with _thread_limit(threads_per_trial):
+            _optimize(*worker_args, seed)
+    else:
+        # spawned workers start without the parent's threads, locks and database connections
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(
+            min(concurrent_trials, remaining),
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(threads_per_trial,),
+        ) as pool:
+            futures = [
+                pool.submit(_optimize, *worker_args, None if seed is None else seed + worker)
+                for worker in range(min(concurrent_trials, remaining))
+            ]
+            for future in futures:
+                future.result()
+    return load_study(study_name, direction, pruner, storage_dir, **pruner_kwargs)
+
+
+def _init_worker(threads_per_trial: int) -> None:
+    # torch, and with it the OpenMP and MKL runtimes, is loaded by now, so OMP_NUM_THREADS would come too late
+    import torch
+
+    torch.set_num_threads(threads_per_trial)
+    torch.set_num_interop_threads(threads_per_trial)
+
+
+@contextmanager
+def _thread_limit(threads_per_trial: int) -> Iterator[None]:
+    """Limits the caller's intra-op threads like a worker's for the duration of the block, then restores them.
+
+    The inter-op pool cannot be resized once it has started, so it is left as it is.
+    """
+    import torch
+
+    threads = torch.get_num_threads()
+    torch.set_num_threads(threads_per_trial)
+    try:
+        yield
+    finally:
+        torch.set_num_threads(threads)
+
+
+def _optimize(
+    objective: Objective,
+    study_name: str,
+    n_trials: int,
+    direction: str,
+    pruner: str,
+    storage_dir: str,
+    timeout: Optional[float],
+    pruner_kwargs: dict,
+    seed: Optional[int],
+) -> None:
+    study = load_study(study_name, direction, pruner, storage_dir, seed=seed, **pruner_kwargs)
+    # every worker keeps pulling trials until the study as a whole has enough of them
+    max_trials = optuna.study.MaxTrialsCallback(
+        n_trials, states=(optuna.trial.TrialState.COMPLETE, optuna.trial.TrialState.PRUNED)
+    )
+    if _finished_trials(study) < n_trials:
+        study.optimize(objective, timeout=timeout, callbacks=[max_trials])
+
+
+def _finished_trials(study: "optuna.Study") -> int:
+    states = (optuna.trial.TrialState.COMPLETE, optuna.trial.TrialState.PRUNED)
+    return len(study.get_trials(deepcopy=False, states=states))
@@ -0,0 +1,130 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""optuna studies persisted to SQLite, pruners, and the trial-side hooks of a sweep"""
+
+import os
+from typing import Any, Optional
+
+from lightning_utilities.core.imports import RequirementCache
+from pytorch_lightning import Callback, LightningModule, Trainer
+from pytorch_lightning.loggers import TensorBoardLogger
+
+from lab import config
+from lab.trainer import LabTrainer
+
+_OPTUNA_AVAILABLE = RequirementCache("optuna")
+if _OPTUNA_AVAILABLE:
+    import optuna
+
+PRUNERS = ("median", "successive_halving", "hyperband", "none")
+
+
+def make_pruner(name: str = "median", **kwargs: Any) -> "optuna.pruners.BasePruner":
+    """Builds a pruner by name: "median", "successive_halving", "hyperband" or "none".
+
+    ``kwargs`` are passed to the optuna pruner, e.g. ``n_warmup_steps`` for "median" or ``max_resource`` for
+    "hyperband".
+    """
+    if not _OPTUNA_AVAILABLE:
+        raise ModuleNotFoundError(str(_OPTUNA_AVAILABLE))
+    pruners = {
+        "median": optuna.pruners.MedianPruner,
+        "successive_halving": optuna.pruners.SuccessiveHalvingPruner,
+        "hyperband": optuna.pruners.HyperbandPruner,
+        "none": optuna.pruners.NopPruner,
+    }
+    if name not in pruners:
+        raise ValueError(f"Unknown pruner {name!r}, expected one of {PRUNERS}")
+    return pruners[name](**kwargs)
+
+
+def storage_url(study_name: str, storage_dir: str = config.OPTUNAPATH) -> str:
+    """The SQLite database that holds the study, one file per study under ``storage_dir``."""
+    os.makedirs(storage_dir, exist_ok=True)
+    return f"sqlite:///{os.path.join(storage_dir, study_name)}.db"
+
+
+def load_study(
+    study_name: str,
+    direction: str = "minimize",
+    pruner: str = "median",
+    storage_dir: str = config.OPTUNAPATH,
+    seed: Optional[int] = None,
+    heartbeat_interval: int = 60,
+    **pruner_kwargs: Any,
+) -> "optuna.Study":
+    """Creates the study, or loads it if an earlier, possibly interrupted, sweep already created it.
+
+    Running trials send a heartbeat every ``heartbeat_interval`` seconds; the trials of a sweep that was killed stop
+    beating, are marked as failed when the sweep is resumed, and are retried once with the same parameters.
+    """
+    if not _OPTUNA_AVAILABLE:
+        raise ModuleNotFoundError(str(_OPTUNA_AVAILABLE))
+    if hasattr(optuna.storages, "RetryHeartbeatStaleTrialCallback"):
+        retry = {"heartbeat_stale_trial_callback": optuna.storages.RetryHeartbeatStaleTrialCallback(max_retry=1)}
+    else:
+        retry = {"failed_trial_callback": optuna.storages.RetryFailedTrialCallback(max_retry=1)}
+    storage = optuna.storages.RDBStorage(
+        storage_url(study_name, storage_dir),
+        # concurrent trials write to the same file, so wait for the lock instead of failing
+        engine_kwargs={"connect_args": {"timeout": 60}},
+        heartbeat_interval=heartbeat_interval,
+        grace_period=2 * heartbeat_interval,
+        **retry,
+    )
+    return optuna.create_study(
+        study_name=study_name,
+        storage=storage,
+        direction=direction,
+        sampler=optuna.samplers.TPESampler(seed=seed),
+        pruner=make_pruner(pruner, **pruner_kwargs),
+        load_if_exists=True,
+    )
+
+
+class PruningCallback(Callback):
+    """Reports ``monitor`` to the trial after every validation epoch and stops the trial when the pruner says so.
+
+    Args:
+        trial: the trial being trained.
+        monitor: the logged validation metric that the study optimizes.
+    """
+
+    def __init__(self, trial: "optuna.Trial", monitor: str = "val_loss") -> None:
+        self.trial = trial
+        self.monitor = monitor
+
+    def on_validation_end(self, trainer: Trainer, pl_module: LightningModule) -> None:
+        if trainer.sanity_checking or self.monitor not in trainer.callback_metrics:
+            return
+        epoch = trainer.current_epoch
+        self.trial.report(float(trainer.callback_metrics[self.monitor]), step=epoch)
+        if self.trial.should_prune():
+            raise optuna.TrialPruned(f"Trial was pruned at epoch {epoch}.")
+
+
+def trial_trainer(trial: "optuna.Trial", monitor: str = "val_loss", **trainer_kwargs: Any) -> LabTrainer:
+    """A ``LabTrainer`` for one trial, with its own logs and checkpoints so concurrent trials do not collide.
+
+    Raising ``optuna.TrialPruned`` from ``fit`` marks the trial as pruned, so objectives can simply call
+    ``trial_trainer(trial).fit(model, datamodule)`` and return the monitored metric.
+    """
+    study_name, version = trial.study.study_name, f"trial-{trial.number}"
+    trainer_kwargs.setdefault("logger", TensorBoardLogger(config.OPTUNAPATH, name=study_name, version=version))
+    trainer_kwargs.setdefault("enable_progress_bar", False)
+    trainer_kwargs.setdefault("checkpoints_dir", os.path.join(config.CHKPTSPATH, study_name, version))
+    callbacks = trainer_kwargs.pop("callbacks", [])
+    return LabTrainer(callbacks=callbacks + [PruningCallback(trial, monitor)], **trainer_kwargs)
@@ -0,0 +1,194 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""exports models to ONNX, with a PyTorch fallback artifact, and checks the exported graph against eager PyTorch"""
+
+import logging
+import os
+from typing import Dict, Optional, Sequence, Tuple
+
+import torch
+from lightning_utilities.core.imports import RequirementCache
+from torch import Tensor, nn
+
+from lab import config
+from lab.models.statespace import StateSpaceModel
+from lab.models.transformer import Transformer
+
+_ONNX_AVAILABLE = RequirementCache("onnx")
+_ONNXSCRIPT_AVAILABLE = RequirementCache("onnxscript")
+
+log = logging.getLogger(__name__)
+
+DynamicAxes = Dict[str, Dict[int, str]]
+
+
+class TransformerExport(nn.Module):
+    """Exposes the demo ``Transformer`` as (inputs, target) -> next-token log probabilities of shape (B, T, V)."""
+
+    def __init__(self, model: Transformer) -> None:
+        super().__init__()
+        self.model = model
+
+    def forward(self, inputs: Tensor, target: Tensor) -> Tensor:
+        return self.model(inputs, target).view(inputs.size(0), inputs.size(1), -1)
+
+
+class StateSpaceExport(nn.Module):
+    """Exposes ``StateSpaceModel`` as a deterministic rollout of given noise, so the number of steps is an input axis.
+
+    ``forward(initial_state, process_noise, observation_noise)`` takes tensors of shape (B, state_dim),
+    (B, T, state_dim) and (B, T, obs_dim) and returns the (B, T, obs_dim) observations. The loop is scripted, so it
+    exports as an ONNX loop over the sequence axis instead of being unrolled.
+    """
+
+    def __init__(self, model: StateSpaceModel) -> None:
+        super().__init__()
+        self.A = model.A
+        self.C = model.C
+
+    def forward(self, initial_state: Tensor, process_noise: Tensor, observation_noise: Tensor) -> Tensor:
+        state = initial_state
+        states = []
+        for t in range(process_noise.size(1)):
+            state = state @ self.A.T + process_noise[:, t]
+            states.append(state)
+        return torch.stack(states, 1) @ self.C.T + observation_noise
+
+
+def export_onnx(
+    model: nn.Module,
+    example_inputs: Tuple[Tensor, ...],
+    path: str = config.MODELPATH,
+    input_names: Optional[Sequence[str]] = None,
+    output_names: Optional[Sequence[str]] = None,
+    dynamic_axes: Optional[DynamicAxes] = None,
+    fallback: bool = True,
+) -> str:
+    """Exports ``model`` to ONNX at ``path`` and returns the path.
+
+    Modules are captured with ``torch.export``; ``torch.jit.ScriptModule`` s, whose scripted control flow
+    ``torch.export`` cannot capture with dynamic bounds, go through the TorchScript exporter instead. With
+    ``fallback``, the captured program is also saved next to the ONNX file, as ``.pt2`` (``torch.export``) or ``.pt``
+    (TorchScript), for ``TorchSession`` on machines without ONNX Runtime.
+
+    Args:
+        model: the module to export, in eval mode.
+        example_inputs: inputs to trace with; dynamic axes must not have size 0 or 1 in them.
+        path: where the ONNX file is written.
+        input_names: names of the graph inputs, ``input0``... by default.
+        output_names: names of the graph outputs, ``output0``... by default.
+        dynamic_axes: for every input name, the axes whose size varies, e.g. ``{"inputs": {0: "batch"}}``; axes with
+            the same name have the same size. By default axis 0 of every input is "batch".
+            The TorchScript exporter also needs the dynamic axes of the outputs; ``torch.export`` infers them.
+        fallback: also save the PyTorch program for ``TorchSession``.
+    """
+    if not _ONNX_AVAILABLE:
+        raise ModuleNotFoundError(str(_ONNX_AVAILABLE))
+    input_names = list(input_names or [f"input{i}" for i in range(len(example_inputs))])
+    output_names = list(output_names or ["output0"])
+    if dynamic_axes is None:
+        dynamic_axes = {name: {0: "batch"} for name in input_names}
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    model.eval()
+
+    with torch.no_grad():
+        if isinstance(model, torch.jit.ScriptModule):
+            torch.onnx.export(
+                model,
+                tuple(example_inputs),
+                path,
+                input_names=input_names,
+                output_names=output_names,
+                dynamic_axes=dynamic_axes,
+                opset_version=17,
+                dynamo=False,
+            )
+            if fallback:
+                torch.jit.save(model, fallback_path(path, scripted=True))
+        else:
+            if not _ONNXSCRIPT_AVAILABLE:
+                raise ModuleNotFoundError(str(_ONNXSCRIPT_AVAILABLE))
+            dims: Dict[str, torch.export.Dim] = {}
+            dynamic_shapes = tuple(
+                {axis: dims.setdefault(name, torch.export.Dim(name)) for axis, name in dynamic_axes.get(x, {}).items()}
+                for x in input_names
+            )
+            program = torch.onnx.export(
+                model,
+                tuple(example_inputs),
+                input_names=input_names,
+                output_names=output_names,
+                dynamic_shapes=dynamic_shapes,
+            )
+            program.save(path)
+            if fallback:
+                torch.export.save(program.exported_program, fallback_path(path, scripted=False))
+    log.info(f"Exported {type(model).__name__} to {path}")
+    return path
+
+
+def fallback_path(path: str, scripted: bool) -> str:
+    """The PyTorch program saved next to the ONNX file at ``path``."""
+    return os.path.splitext(path)[0] + (".pt" if scripted else ".pt2")
+
+
+def check_parity(
+    model: nn.Module, session, inputs: Tuple[Tensor, ...], rtol: float = 1e-3, atol: float = 1e-4
+) -> float:
+    """Compares ``session`` (see ``lab.components.inference.runtime``) against eager ``model`` on ``inputs``.
+
+    Returns the largest absolute difference over all outputs and raises ``ValueError`` if any output differs by more
+    than ``atol + rtol * |expected|``.
+    """
+    with torch.no_grad():
+        expected = model.eval()(*inputs)
+    expected = [expected] if isinstance(expected, Tensor) else list(expected)
+    actual = session.run(*inputs)
+    error = 0.0
+    for want, got in zip(expected, actual):
+        error = max(error, float((want - got).abs().max()))
+        if not torch.allclose(got, want, rtol=rtol, atol=atol):
+            raise ValueError(f"The exported model differs from PyTorch by up to {error:.3g}")
+    return error
+
+
+def export_transformer(
+    model: Transformer, path: str = config.MODELPATH, batch_size: int = 2, seq_len: int = 35
+) -> Tuple[str, Tuple[Tensor, Tensor]]:
+    """Exports the demo ``Transformer`` with dynamic batch and sequence axes; returns the path and example inputs."""
+    inputs = torch.randint(0, model.vocab_size, (batch_size, seq_len))
+    target = torch.randint(0, model.vocab_size, (batch_size, seq_len))
+    names = ["inputs", "target"]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in names}
+    path = export_onnx(TransformerExport(model), (inputs, target), path, names, ["log_probs"], dynamic_axes)
+    return path, (inputs, target)
+
+
+def export_statespace(
+    model: StateSpaceModel, path: str = config.MODELPATH, batch_size: int = 2, steps: int = 16
+) -> Tuple[str, Tuple[Tensor, Tensor, Tensor]]:
+    """Exports a ``StateSpaceExport`` rollout with dynamic batch and step axes; returns the path and example inputs."""
+    dtype = model.A.dtype
+    inputs = (
+        torch.randn(batch_size, model.state_dim, dtype=dtype),
+        torch.randn(batch_size, steps, model.state_dim, dtype=dtype),
+        torch.randn(batch_size, steps, model.obs_dim, dtype=dtype),
+    )
+    names = ["initial_state", "process_noise", "observation_noise", "observations"]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in names[1:]}
+    dynamic_axes["initial_state"] = {0: "batch"}
+    scripted = torch.jit.script(StateSpaceExport(model))
+    return export_onnx(scripted, inputs, path, names[:3], names[3:], dynamic_axes), inputs
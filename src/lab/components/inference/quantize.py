@@ -0,0 +1,198 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""post-training int8 quantization for CPU inference, and a report comparing it against fp32"""
+
+import copy
+import io
+import os
+import time
+from itertools import islice
+from typing import Any, Callable, Dict, Iterable, Optional, Sequence
+
+import numpy as np
+import torch
+from torch import Tensor, nn
+from torch.ao.quantization import default_dynamic_qconfig, float_qparams_weight_only_qconfig, quantize_dynamic
+
+from lab import config
+from lab.components.io import atomic_write
+
+ForwardFn = Callable[[nn.Module, Any], Any]
+
+# nn.Transformer layers read the weights of their Linear submodules directly on the fused fast path, and
+# MultiheadAttention its in/out projections, so only Linear layers outside of them can be swapped for int8 modules
+_FUSED_LAYERS = (nn.TransformerEncoderLayer, nn.TransformerDecoderLayer, nn.MultiheadAttention)
+
+
+def default_forward(model: nn.Module, batch: Any) -> Any:
+    """Calls the model on a batch, unpacking tuples and lists into positional arguments."""
+    return model(*batch) if isinstance(batch, (tuple, list)) else model(batch)
+
+
+def quantizable_layers(model: nn.Module, embeddings: bool = True) -> Dict[str, Any]:
+    """The qconfig of every layer ``quantize`` swaps: ``nn.Linear`` layers, and ``nn.Embedding`` tables with
+    ``embeddings``, outside of fused transformer layers."""
+    fused = [name for name, module in model.named_modules() if isinstance(module, _FUSED_LAYERS)]
+    qconfigs = {}
+    for name, module in model.named_modules():
+        if any(name.startswith(f"{prefix}.") for prefix in fused):
+            continue
+        if type(module) is nn.Linear:
+            qconfigs[name] = default_dynamic_qconfig
+        elif embeddings and type(module) is nn.Embedding:
+            qconfigs[name] = float_qparams_weight_only_qconfig
+    return qconfigs
+
+
+def quantize(model: nn.Module, embeddings: bool = True) -> nn.Module:
+    """Dynamic int8 quantization: weights are stored in int8, activations are quantized on the fly per batch.
+
+    Returns a quantized copy of ``model``; see ``quantizable_layers`` for the layers that are swapped.
+    """
+    model = copy.deepcopy(model).eval()
+    return quantize_dynamic(model, quantizable_layers(model, embeddings), dtype=torch.qint8)
+
+
+@torch.no_grad()
+def quantize_static(
+    model: nn.Module,
+    calibration_data: Iterable[Any],
+    submodules: Optional[Sequence[str]] = None,
+    forward_fn: ForwardFn = default_forward,
+    num_batches: int = 32,
+    backend: str = "x86",
+) -> nn.Module:
+    """Static int8 quantization: activation ranges are calibrated once, on ``num_batches`` batches of
+    ``calibration_data``, e.g. ``LabDataModule.val_dataloader()``, so layers run entirely in int8.
+
+    Returns a quantized copy of ``model``. Modules are captured with FX graph mode quantization, which needs a
+    symbolically traceable module; for models that are not, such as the demo ``Transformer``, name traceable
+    ``submodules`` to quantize, e.g. ``["encoder"]`` of ``DiffusionModel``. Calibration runs the whole model with
+    ``forward_fn(model, batch)``, e.g. ``lambda model, batch: model.loss(batch[0])`` for a ``DiffusionModel``.
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    model = copy.deepcopy(model).eval()
+    batches = list(islice(iter(calibration_data), num_batches))
+    if not batches:
+        raise ValueError("Static quantization needs at least one calibration batch")
+    qconfig_mapping = get_default_qconfig_mapping(backend)
+    if not submodules:
+        prepared = prepare_fx(model, qconfig_mapping, _example_args(batches[0]))
+        for batch in batches:
+            forward_fn(prepared, batch)
+        return convert_fx(prepared)
+
+    # record one call of every submodule to trace it with, then swap in the observed versions and calibrate
+    example_args = {}
+    hooks = [
+        model.get_submodule(name).register_forward_pre_hook(
+            lambda module, args, name=name: example_args.setdefault(name, args)
+        )
+        for name in submodules
+    ]
+    forward_fn(model, batches[0])
+    for hook in hooks:
+        hook.remove()
+    for name in submodules:
+        _set_submodule(model, name, prepare_fx(model.get_submodule(name), qconfig_mapping, example_args[name]))
+    for batch in batches:
+        forward_fn(model, batch)
+    for name in submodules:
+        _set_submodule(model, name, convert_fx(model.get_submodule(name)))
+    return model
+
+
+def save_quantized(model: nn.Module, path: Optional[str] = None, mode: str = "dynamic") -> str:
+    """Saves the quantized module next to the production model, as ``model.int8-<mode>.pt`` by default."""
+    path = path or quantized_path(config.MODELPATH, mode)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    atomic_write(path, lambda f: torch.save(model, f))
+    return path
+
+
+def load_quantized(path: str) -> nn.Module:
+    # the whole module is pickled, since quantized modules cannot be rebuilt from a float state dict
+    return torch.load(path, weights_only=False).eval()
+
+
+def quantized_path(model_path: str, mode: str) -> str:
+    return f"{os.path.splitext(model_path)[0]}.int8-{mode}.pt"
+
+
+@torch.no_grad()
+def quantization_report(
+    model: nn.Module,
+    quantized: nn.Module,
+    batches: Sequence[Any],
+    forward_fn: ForwardFn = default_forward,
+    metric: Optional[Callable[[Any, Any], Tensor]] = None,
+    repeats: int = 5,
+) -> Dict[str, Dict[str, float]]:
+    """Compares fp32 and quantized accuracy, latency and memory on ``batches``.
+
+    Accuracy is the largest and mean absolute difference of the outputs, how often their argmax over the last
+    dimension agrees and, with ``metric(output, batch)``, the mean metric of both models. Latency is the median
+    seconds per batch and memory the size of the serialized weights.
+    """
+    results = {}
+    outputs = {}
+    for name, candidate in (("fp32", model.eval()), ("int8", quantized.eval())):
+        outputs[name] = [forward_fn(candidate, batch) for batch in batches]
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            for batch in batches:
+                forward_fn(candidate, batch)
+            timings.append((time.perf_counter() - start) / len(batches))
+        results[name] = {
+            "seconds_per_batch": float(np.median(timings)),
+            "weights_mb": _weights_bytes(candidate) / 2**20,
+        }
+        if metric is not None:
+            values = [float(metric(output, batch)) for output, batch in zip(outputs[name], batches)]
+            results[name]["metric"] = float(np.mean(values))
+
+    expected, actual = (torch.cat([_tensor(x).flatten(0, -2) for x in outputs[name]]) for name in ("fp32", "int8"))
+    error = (expected - actual).abs()
+    results["int8"].update(
+        max_abs_error=float(error.max()),
+        mean_abs_error=float(error.mean()),
+        argmax_agreement=float((expected.argmax(-1) == actual.argmax(-1)).float().mean()),
+        speedup=results["fp32"]["seconds_per_batch"] / results["int8"]["seconds_per_batch"],
+        compression=results["fp32"]["weights_mb"] / results["int8"]["weights_mb"],
+    )
+    return results
+
+
+def _example_args(batch: Any) -> tuple:
+    return tuple(batch) if isinstance(batch, (tuple, list)) else (batch,)
+
+
+def _set_submodule(model: nn.Module, name: str, module: nn.Module) -> None:
+    parent, _, child = name.rpartition(".")
+    setattr(model.get_submodule(parent) if parent else model, child, module)
+
+
+def _tensor(output: Any) -> Tensor:
+    output = output[0] if isinstance(output, (tuple, list)) else output
+    return output if output.dim() > 1 else output.unsqueeze(-1)
+
+
+def _weights_bytes(model: nn.Module) -> int:
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
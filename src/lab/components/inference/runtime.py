@@ -0,0 +1,124 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""reusable CPU inference sessions for exported models: ONNX Runtime, or the PyTorch program as a fallback"""
+
+import os
+from typing import List, Optional, Union
+
+import numpy as np
+import torch
+from lightning_utilities.core.imports import RequirementCache
+from torch import Tensor
+
+from lab import config
+from lab.components.inference.export import fallback_path
+
+_ONNXRUNTIME_AVAILABLE = RequirementCache("onnxruntime")
+
+Array = Union[Tensor, np.ndarray]
+
+
+class OnnxSession:
+    """An ONNX Runtime session on CPU, built once and reused for every call.
+
+    Inputs are bound in place with IO binding, so contiguous tensors reach the runtime without a copy; outputs are
+    allocated by the runtime and returned as tensors.
+
+    Args:
+        path: the ONNX file.
+        intra_op_threads: threads used within an operator, all cores by default.
+        inter_op_threads: threads running independent operators concurrently.
+        io_binding: bind inputs in place instead of copying them into the runtime.
+    """
+
+    def __init__(
+        self,
+        path: str = config.MODELPATH,
+        intra_op_threads: Optional[int] = None,
+        inter_op_threads: int = 1,
+        io_binding: bool = True,
+    ) -> None:
+        if not _ONNXRUNTIME_AVAILABLE:
+            raise ModuleNotFoundError(str(_ONNXRUNTIME_AVAILABLE))
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads or os.cpu_count() or 1
+        options.inter_op_num_threads = inter_op_threads
+        options.execution_mode = (
+            ort.ExecutionMode.ORT_PARALLEL if inter_op_threads > 1 else ort.ExecutionMode.ORT_SEQUENTIAL
+        )
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.path = path
+        self.io_binding = io_binding
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_names = [x.name for x in self.session.get_inputs()]
+        self.output_names = [x.name for x in self.session.get_outputs()]
+
+    def run(self, *inputs: Array) -> List[Tensor]:
+        arrays = [_to_numpy(x) for x in inputs]
+        if not self.io_binding:
+            outputs = self.session.run(self.output_names, dict(zip(self.input_names, arrays)))
+            return [torch.from_numpy(x) for x in outputs]
+        binding = self.session.io_binding()
+        for name, array in zip(self.input_names, arrays):
+            binding.bind_input(name, "cpu", 0, array.dtype, array.shape, array.ctypes.data)
+        for name in self.output_names:
+            binding.bind_output(name, "cpu")
+        self.session.run_with_iobinding(binding)
+        return [torch.from_numpy(x.numpy()) for x in binding.get_outputs()]
+
+    __call__ = run
+
+
+class TorchSession:
+    """Runs the PyTorch program saved by ``export_onnx`` next to the ONNX file, for machines without ONNX Runtime.
+
+    Args:
+        path: the ONNX file, or the ``.pt2``/``.pt`` program itself.
+        intra_op_threads: threads used within an operator; leaves torch's setting alone by default.
+    """
+
+    def __init__(self, path: str = config.MODELPATH, intra_op_threads: Optional[int] = None) -> None:
+        if intra_op_threads:
+            torch.set_num_threads(intra_op_threads)
+        candidates = [path] if not path.endswith(".onnx") else [fallback_path(path, False), fallback_path(path, True)]
+        path = next((candidate for candidate in candidates if os.path.exists(candidate)), candidates[0])
+        self.path = path
+        if path.endswith(".pt2"):
+            self.module = torch.export.load(path).module()
+        else:
+            self.module = torch.jit.load(path).eval()
+
+    @torch.no_grad()
+    def run(self, *inputs: Array) -> List[Tensor]:
+        outputs = self.module(*[torch.as_tensor(x) for x in inputs])
+        return [outputs] if isinstance(outputs, Tensor) else list(outputs)
+
+    __call__ = run
+
+
+def load_session(path: str = config.MODELPATH, **kwargs) -> Union[OnnxSession, TorchSession]:
+    """An ``OnnxSession`` when ONNX Runtime is installed and ``path`` exists, a ``TorchSession`` otherwise."""
+    if _ONNXRUNTIME_AVAILABLE and os.path.exists(path):
+        return OnnxSession(path, **kwargs)
+    return TorchSession(path, intra_op_threads=kwargs.get("intra_op_threads"))
+
+
+def _to_numpy(x: Array) -> np.ndarray:
+    # the runtime reads the buffer in place, so it must be contiguous
+    array = x.detach().cpu().numpy() if isinstance(x, Tensor) else x
+    return np.ascontiguousarray(array)
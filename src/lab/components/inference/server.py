@@ -0,0 +1,443 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""a local inference server that merges concurrent requests into dynamic micro-batches"""
+
+import http.client
+import importlib
+import io
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Deque, Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from lab import config
+
+log = logging.getLogger(__name__)
+
+Inputs = Tuple[np.ndarray, ...]
+RunBatch = Callable[..., Sequence[Any]]
+
+NPZ = "application/x-npz"
+
+_POLL_INTERVAL = 5e-4
+
+
+class LatencyMetrics:
+    """Rolling request latencies and batch fill, over the last ``window`` requests and batches."""
+
+    def __init__(self, max_batch_size: int, window: int = 10_000) -> None:
+        self.max_batch_size = max_batch_size
+        self.latencies: Deque[float] = deque(maxlen=window)
+        self.fills: Deque[float] = deque(maxlen=window)
+        self.requests = 0
+        self.batches = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def record_batch(self, rows: int, latencies: Sequence[float]) -> None:
+        with self._lock:
+            self.batches += 1
+            self.requests += len(latencies)
+            self.fills.append(rows / self.max_batch_size)
+            self.latencies.extend(latencies)
+
+    def record_error(self, requests: int) -> None:
+        with self._lock:
+            self.errors += requests
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            latencies, fills = np.asarray(self.latencies), np.asarray(self.fills)
+            return {
+                "requests": self.requests,
+                "batches": self.batches,
+                "errors": self.errors,
+                "p50_ms": float(np.percentile(latencies, 50) * 1e3) if len(latencies) else 0.0,
+                "p99_ms": float(np.percentile(latencies, 99) * 1e3) if len(latencies) else 0.0,
+                "batch_fill": float(fills.mean()) if len(fills) else 0.0,
+                "requests_per_batch": self.requests / self.batches if self.batches else 0.0,
+            }
+
+
+class MicroBatcher:
+    """Merges concurrent requests into batches and runs them on a pool of worker threads.
+
+    A batch is sent to the workers as soon as it holds ``max_batch_size`` rows or ``max_latency_ms`` after its first
+    request arrived, whichever comes first; if every worker is still busy at the deadline, the batch keeps filling
+    until one is free, since it could not start earlier anyway. Requests are concatenated along axis 0, so only
+    requests whose inputs have the same trailing shapes and dtypes share a batch; others wait for the next one.
+
+    Args:
+        run_batch: runs the model on the concatenated inputs and returns its outputs, batch first.
+        max_batch_size: the most rows in a batch.
+        max_latency_ms: how long the first request of a batch waits for others to join it.
+        num_workers: batches run concurrently.
+    """
+
+    def __init__(
+        self, run_batch: RunBatch, max_batch_size: int = 32, max_latency_ms: float = 5.0, num_workers: int = 1
+    ) -> None:
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1e3
+        self.metrics = LatencyMetrics(max_batch_size)
+        self._requests: "queue.Queue[Optional[Tuple[Inputs, Future, float]]]" = queue.Queue()
+        self._pool = ThreadPoolExecutor(num_workers, thread_name_prefix="lab-serve-worker")
+        self._free_workers = threading.Semaphore(num_workers)
+        self._closed = False
+        self._collector = threading.Thread(target=self._collect, name="lab-serve-batcher", daemon=True)
+        self._collector.start()
+
+    def submit(self, *inputs: np.ndarray) -> Future:
+        """Queues one request, a batch of one or more rows, and returns a future of its outputs."""
+        if self._closed:
+            raise RuntimeError("The batcher is closed")
+        future: Future = Future()
+        self._requests.put((tuple(inputs), future, time.perf_counter()))
+        return future
+
+    def close(self) -> None:
+        self._closed = True
+        self._requests.put(None)
+        self._collector.join()
+        self._pool.shutdown(wait=True)
+
+    def _collect(self) -> None:
+        carried: List[Tuple[Inputs, Future, float]] = []
+        while True:
+            first = carried.pop(0) if carried else self._requests.get()
+            if first is None:
+                return
+            batch, rows = [first], _rows(first[0])
+            deadline = first[2] + self.max_latency
+            signature = _signature(first[0])
+            # requests carried over from the last batch get the first chance to join
+            pending, carried = carried, []
+            worker = False
+            while rows < self.max_batch_size:
+                if pending:
+                    request = pending.pop(0)
+                else:
+                    timeout = deadline - time.perf_counter()
+                    if timeout <= 0:
+                        # past the deadline, keep filling the batch only while every worker is busy
+                        worker = self._free_workers.acquire(blocking=False)
+                        if worker:
+                            break
+                        timeout = _POLL_INTERVAL
+                    try:
+                        request = self._requests.get(timeout=timeout)
+                    except queue.Empty:
+                        continue
+                if request is None:
+                    self._requests.put(None)  # finish this batch, then stop
+                    break
+                if _signature(request[0]) != signature or rows + _rows(request[0]) > self.max_batch_size:
+                    carried.append(request)
+                    continue
+                batch.append(request)
+                rows += _rows(request[0])
+            carried = pending + carried
+            if not worker:
+                self._free_workers.acquire()
+            self._pool.submit(self._run, batch, rows)
+
+    def _run(self, batch: List[Tuple[Inputs, Future, float]], rows: int) -> None:
+        try:
+            self._run_batch(batch, rows)
+        finally:
+            self._free_workers.release()
+
+    def _run_batch(self, batch: List[Tuple[Inputs, Future, float]], rows: int) -> None:
+        try:
+            inputs = [np.concatenate(arrays) for arrays in zip(*(request[0] for request in batch))]
+            outputs = [_to_numpy(output) for output in self.run_batch(*inputs)]
+        except Exception as error:
+            self.metrics.record_error(len(batch))
+            for _, future, _ in batch:
+                future.set_exception(error)
+            return
+        start, done, latencies = 0, time.perf_counter(), []
+        for request_inputs, future, arrived in batch:
+            end = start + _rows(request_inputs)
+            future.set_result([output[start:end] for output in outputs])
+            latencies.append(done - arrived)
+            start = end
+        self.metrics.record_batch(rows, latencies)
+
+
+def load_model(
+    path: str = config.MODELPATH, module: Optional[str] = None, threads: Optional[int] = None, mode: str = "eager"
+) -> RunBatch:
+    """Loads the model to serve once and returns a function running it on a batch of arrays.
+
+    ``path`` is an exported model (see ``lab.components.inference.runtime.load_session``) or a Lightning checkpoint,
+    whose class is given by ``module`` as ``"package.module:ClassName"``. A checkpoint runs in the execution ``mode``
+    of ``lab.components.execution.modes``, e.g. "bf16" or "compile"; exported models only run as exported.
+    """
+    import torch
+
+    if path.endswith(".ckpt"):
+        if module is None:
+            raise ValueError("Serving a checkpoint needs its LightningModule class, e.g. 'lab.models.diffuser:Model'")
+        module_name, class_name = module.split(":")
+        from lab.components.callbacks.checkpoint import load_module
+        from lab.components.execution.modes import apply_mode
+
+        model = apply_mode(load_module(getattr(importlib.import_module(module_name), class_name), path), mode)
+        if threads:
+            torch.set_num_threads(threads)
+
+        def run(*inputs: np.ndarray) -> List[torch.Tensor]:
+            outputs = model(*[torch.from_numpy(x) for x in inputs])
+            return [outputs] if isinstance(outputs, torch.Tensor) else list(outputs)
+
+        return run
+
+    if mode != "eager":
+        raise ValueError(f"Execution mode {mode!r} needs a Lightning checkpoint, not an exported model")
+    from lab.components.inference.runtime import load_session
+
+    return load_session(path, intra_op_threads=threads)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: "_Server"
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self) -> None:
+        if self.path == "/metrics":
+            self._reply(200, self.server.batcher.metrics.snapshot())
+        elif self.path == "/health":
+            self._reply(200, {"status": "ok"})
+        else:
+            self._reply(404, {"error": f"unknown path {self.path}"})
+
+    def do_POST(self) -> None:
+        if self.path != "/predict":
+            return self._reply(404, {"error": f"unknown path {self.path}"})
+        binary = self.headers.get("Content-Type") == NPZ
+        try:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            inputs = _load_npz(body) if binary else [_from_json(x) for x in json.loads(body)["inputs"]]
+        except (ValueError, KeyError, TypeError, OSError) as error:
+            return self._reply(400, {"error": f"bad request: {error}"})
+        try:
+            outputs = self.server.batcher.submit(*inputs).result()
+        except Exception as error:
+            return self._reply(500, {"error": str(error)})
+        if binary:
+            return self._reply(200, _dump_npz(outputs), NPZ)
+        self._reply(200, {"outputs": [output.tolist() for output in outputs]})
+
+    def _reply(self, status: int, body: Union[Dict[str, Any], bytes], content_type: str = "application/json") -> None:
+        payload = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def address_string(self) -> str:
+        # Unix socket clients have no host and port
+        return str(self.client_address[0]) if self.client_address else "unix"
+
+    def log_message(self, format: str, *args: Any) -> None:
+        log.debug(format, *args)
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    batcher: MicroBatcher
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    batcher: MicroBatcher
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ("unix", 0)
+
+
+def make_server(
+    batcher: MicroBatcher, host: str = "127.0.0.1", port: int = 8000, unix_socket: Optional[str] = None
+) -> socketserver.BaseServer:
+    """An HTTP server on ``host:port``, or on the Unix socket ``unix_socket``, for a ``MicroBatcher``.
+
+    ``POST /predict`` takes a JSON body ``{"inputs": [...]}``, one nested list per model input with the batch first,
+    and answers ``{"outputs": [...]}``; with the content type ``application/x-npz`` both bodies are instead ``.npz``
+    archives of the arrays in order, which skips JSON encoding of large tensors. ``GET /metrics`` reports latency and
+    batching metrics and ``GET /health`` answers when the server is up.
+    """
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = _UnixServer(unix_socket, _Handler)
+    else:
+        server = _Server((host, port), _Handler)
+    server.batcher = batcher
+    return server
+
+
+def serve(
+    path: str = config.MODELPATH,
+    module: Optional[str] = None,
+    host: str = "127.0.0.1",
+    port: int = 8000,
+    unix_socket: Optional[str] = None,
+    max_batch_size: int = 32,
+    max_latency_ms: float = 5.0,
+    num_workers: int = 1,
+    mode: str = "eager",
+) -> None:
+    """Loads the model once and serves it until interrupted; the cores are split evenly between the workers."""
+    threads = max(1, (os.cpu_count() or 1) // num_workers)
+    batcher = MicroBatcher(load_model(path, module, threads, mode), max_batch_size, max_latency_ms, num_workers)
+    server = make_server(batcher, host, port, unix_socket)
+    log.info(f"Serving {path} on {unix_socket or f'http://{host}:{port}'}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+
+
+class _UnixConnection(http.client.HTTPConnection):
+    def __init__(self, path: str, timeout: float = 60.0) -> None:
+        super().__init__("localhost", timeout=timeout)
+        self.unix_path = path
+
+    def connect(self) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_path)
+
+
+def connect(host: str = "127.0.0.1", port: int = 8000, unix_socket: Optional[str] = None) -> http.client.HTTPConnection:
+    """A keep-alive connection to a server started by ``serve``."""
+    return _UnixConnection(unix_socket) if unix_socket else http.client.HTTPConnection(host, port, timeout=60)
+
+
+def request(connection: http.client.HTTPConnection, method: str, path: str, body: Optional[dict] = None) -> dict:
+    """Sends a JSON request and returns the decoded JSON reply."""
+    payload = json.dumps(body).encode() if body is not None else None
+    headers = {"Content-Type": "application/json"} if payload is not None else {}
+    connection.request(method, path, body=payload, headers=headers)
+    response = connection.getresponse()
+    reply = json.loads(response.read())
+    if response.status != 200:
+        raise RuntimeError(f"{method} {path} failed with {response.status}: {reply.get('error')}")
+    return reply
+
+
+def predict(connection: http.client.HTTPConnection, *inputs: np.ndarray) -> List[np.ndarray]:
+    """Runs the served model on ``inputs``, sent and received as binary ``.npz`` archives."""
+    connection.request("POST", "/predict", body=_dump_npz(inputs), headers={"Content-Type": NPZ})
+    response = connection.getresponse()
+    reply = response.read()
+    if response.status != 200:
+        raise RuntimeError(f"POST /predict failed with {response.status}: {json.loads(reply).get('error')}")
+    return _load_npz(reply)
+
+
+def load_test(
+    make_inputs: Callable[[], Sequence[np.ndarray]],
+    num_requests: int = 1000,
+    concurrency: int = 16,
+    host: str = "127.0.0.1",
+    port: int = 8000,
+    unix_socket: Optional[str] = None,
+) -> Dict[str, float]:
+    """Sends ``num_requests`` requests from ``concurrency`` keep-alive clients and reports client-side latency and
+    throughput next to the server's own metrics."""
+    latencies: List[float] = []
+    lock = threading.Lock()
+    counter = iter(range(num_requests))
+
+    def client() -> None:
+        connection = connect(host, port, unix_socket)
+        try:
+            while True:
+                with lock:
+                    if next(counter, None) is None:
+                        return
+                inputs = [np.asarray(x) for x in make_inputs()]
+                start = time.perf_counter()
+                predict(connection, *inputs)
+                with lock:
+                    latencies.append(time.perf_counter() - start)
+        finally:
+            connection.close()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    connection = connect(host, port, unix_socket)
+    server = request(connection, "GET", "/metrics")
+    connection.close()
+    return {
+        "requests_per_sec": len(latencies) / elapsed,
+        "client_p50_ms": float(np.percentile(latencies, 50) * 1e3),
+        "client_p99_ms": float(np.percentile(latencies, 99) * 1e3),
+        **{f"server_{key}": value for key, value in server.items()},
+    }
+
+
+def _rows(inputs: Inputs) -> int:
+    return len(inputs[0])
+
+
+def _signature(inputs: Inputs) -> Tuple:
+    return tuple((x.shape[1:], x.dtype) for x in inputs)
+
+
+def _dump_npz(arrays: Sequence[np.ndarray]) -> bytes:
+    buffer = io.BytesIO()
+    np.savez(buffer, *arrays)
+    return buffer.getvalue()
+
+
+def _load_npz(payload: bytes) -> List[np.ndarray]:
+    with np.load(io.BytesIO(payload), allow_pickle=False) as archive:
+        return [archive[f"arr_{i}"] for i in range(len(archive.files))]
+
+
+def _from_json(value: Any) -> np.ndarray:
+    array = np.asarray(value)
+    # JSON numbers decode as float64, models take float32
+    return array.astype(np.float32) if array.dtype == np.float64 else array
+
+
+def _to_numpy(x: Any) -> np.ndarray:
+    # tensors are converted without importing torch, which clients of the server never need
+    return x.detach().cpu().numpy() if hasattr(x, "detach") else np.asarray(x)
@@ -0,0 +1,60 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""atomic file writes shared by checkpoints, predictions, splits, caches and exported models"""
+
+import os
+import threading
+from typing import Any, BinaryIO, Callable, Union
+
+
+def atomic_write(path: Union[str, os.PathLike], writer: Callable[[BinaryIO], Any], fsync: bool = True) -> None:
+    """Writes ``path`` all at once: ``writer`` fills a private temporary file, which is then renamed over ``path``.
+
+    Readers never see a partial file, and processes racing to write the same file each rename a complete one into
+    place. With ``fsync`` the contents and the rename are flushed to disk before returning, so the file also survives
+    a crash; files that can be rebuilt, like caches, may skip it.
+
+    Args:
+        path: the file to write.
+        writer: writes the contents to the binary file object it is given.
+        fsync: whether to flush the file and its directory to disk.
+    """
+    # private to this thread, since the checkpoint and prediction writers run on threads of the same process
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            writer(f)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    if fsync:
+        fsync_directory(os.path.dirname(path) or ".")
+
+
+def fsync_directory(path: str) -> None:
+    """Flushes the entries of directory ``path``, e.g. a rename into it, to disk where the platform allows it."""
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -1,15 +1,20 @@
 import os
 from pathlib import Path
 
+GLOBALSEED = 42
+
 # SET PATHS
 filepath = Path(__file__)
-PROJECTPATH = filepath.parents[1]
+PROJECTPATH = filepath.parents[2]
 LOGSPATH = os.path.join(PROJECTPATH, "logs")
 TORCHPROFILERPATH = os.path.join(LOGSPATH, "torch_profiler")
 SIMPLEPROFILERPATH = os.path.join(LOGSPATH, "simple_profiler")
+BENCHPATH = os.path.join(LOGSPATH, "bench")
 CHKPTSPATH = os.path.join(PROJECTPATH, "checkpoints", "trials")
 MODELPATH = os.path.join(PROJECTPATH, "checkpoints", "production", "model.onnx")
-PREDSPATH = os.path.join(PROJECTPATH, "data", "predictions", "predictions.pt")
+PREDICTIONSPATH = os.path.join(PROJECTPATH, "data", "predictions")
+CACHEPATH = os.path.join(PROJECTPATH, "data", "cache")
+COMPILECACHEPATH = os.path.join(PROJECTPATH, "data", "cache", "inductor")
 SPLITSPATH = os.path.join(PROJECTPATH, "data", "training_split")
 WANDBPATH = os.path.join(PROJECTPATH, "logs", "wandb_logs")
 OPTUNAPATH = os.path.join(PROJECTPATH, "logs", "optuna")
@@ -1,55 +1,304 @@
-import multiprocessing
 import os
+import time
+from functools import partial
 from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional
 
+import torch
 from pytorch_lightning import LightningDataModule
-from torch.utils.data import DataLoader, Dataset, random_split
+from torch.utils.data import DataLoader, Dataset, IterableDataset, RandomSampler, SequentialSampler, Subset
 
-from lab.pipeline.dataset import LabDataset
+from lab import config
+from lab.components.callbacks.affinity import pin_worker
+from lab.components.data.cache import ArtifactCache, CachedDataset, cache_key, directory_fingerprint
+from lab.components.data.collate import PackingCollate
+from lab.components.data.sampler import BucketBatchSampler, sequence_lengths
+from lab.components.data.splits import load_or_create_split
+from lab.dataset import LabDataset
 
 filepath = Path(__file__)
 PROJECTPATH = os.getcwd()
-NUMWORKERS = int(multiprocessing.cpu_count() // 2)
 
 
 class LabDataModule(LightningDataModule):
+    """a custom PyTorch Lightning LightningDataModule
+
+    Passing an ``IterableDataset`` class such as ``LabStreamingDataset`` as ``dataset`` selects streaming mode: the
+    dataset is built for the "train", "val" and "test" splits instead of being split by index, and the position
+    within the training stream is saved in checkpoints so an interrupted epoch resumes where it stopped.
+
+    Args:
+        num_workers: dataloader worker processes per node, split evenly between the node's ranks; defaults to half
+            of the CPUs this process may run on.
+        batch_size: samples per batch.
+        bucket_size: group samples of similar length, sorting ``batch_size * bucket_size`` samples at a time.
+        max_tokens: pack the samples of a batch into rows of at most ``max_tokens`` tokens.
+        pad_value: the value used to pad variable-length sequences.
+        pin_memory: pin host memory for faster transfers; defaults to whether CUDA is available.
+        persistent_workers: keep workers alive between epochs instead of respawning them.
+        prefetch_factor: batches loaded in advance by each worker.
+        log_throughput: log samples/sec, and the padding ratio of padded batches, to the trainer's logger.
+        split_seed: the seed of the train/val split, which is persisted under ``splits_dir`` and reused.
+        stratify: keep the label proportions of the train and val splits equal.
+        num_folds: split into ``num_folds`` cross-validation folds and validate on fold ``fold``.
+        fold: the validation fold, with ``num_folds``.
+        splits_dir: where splits are persisted.
+        cache_preprocessed: materialize the transformed datasets once into ``cache_dir`` and memory-map them in every
+            later run, trial and rank instead of rebuilding them.
+        preprocessing_config: identifies the preprocessing in the cache key; defaults to ``repr(transforms)``, which
+            must then not contain memory addresses, as the reprs of functions and most objects do. The key also
+            covers the sizes and modification times of the files under ``data_dir``, so changed data is rebuilt.
+        cache_dir: the content-addressed cache of preprocessed datasets.
+        cache_max_bytes: evict the least recently used entries of ``cache_dir`` beyond this size.
+    """
+
     def __init__(
         self,
         dataset: Dataset = LabDataset,
         data_dir: str = "data",
         split: bool = True,
         train_size: float = 0.8,
-        num_workers: int = NUMWORKERS,
+        num_workers: Optional[int] = None,
         transforms=None,
+        batch_size: int = 32,
+        bucket_size: Optional[int] = None,
+        max_tokens: Optional[int] = None,
+        pad_value: int = 0,
+        pin_memory: Optional[bool] = None,
+        persistent_workers: bool = True,
+        prefetch_factor: int = 2,
+        log_throughput: bool = True,
+        split_seed: int = 42,
+        stratify: bool = False,
+        num_folds: Optional[int] = None,
+        fold: int = 0,
+        splits_dir: str = config.SPLITSPATH,
+        cache_preprocessed: bool = False,
+        preprocessing_config: Optional[Dict[str, Any]] = None,
+        cache_dir: str = config.CACHEPATH,
+        cache_max_bytes: Optional[int] = None,
     ):
         super().__init__()
         self.data_dir = os.path.join(PROJECTPATH, data_dir, "cache")
         self.dataset = dataset
         self.split = split
         self.train_size = train_size
-        self.num_workers = num_workers
+        self.num_workers = default_num_workers() if num_workers is None else num_workers
         self.transforms = transforms
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.max_tokens = max_tokens
+        self.pad_value = pad_value
+        self.pin_memory = pin_memory
+        self.persistent_workers = persistent_workers
+        self.prefetch_factor = prefetch_factor
+        self.log_throughput = log_throughput
+        self.split_seed = split_seed
+        self.stratify = stratify
+        self.num_folds = num_folds
+        self.fold = fold
+        self.splits_dir = splits_dir
+        self.cache_preprocessed = cache_preprocessed
+        self.preprocessing_config = preprocessing_config
+        if cache_preprocessed and preprocessing_config is None and " at 0x" in repr(transforms):
+            # addresses differ between processes, so no other run or trial would ever hit the cache
+            raise ValueError(
+                f"Pass a `preprocessing_config` to cache {transforms!r}: its repr differs in every process"
+            )
+        self.cache = ArtifactCache(cache_dir, cache_max_bytes)
+        self._window_start: Optional[float] = None
+        self._window_samples = 0
+        self._epoch = 0
+        self._samples_seen = 0
+        self._stream_state: Optional[Dict[str, int]] = None
+        # set by the `CPUAffinity` callback to pin this rank's workers to their own cores
+        self.worker_cpus: Optional[List[int]] = None
 
     def prepare_data(self):
+        if self.cache_preprocessed and all(self._cache_key(train) in self.cache for train in (True, False)):
+            return
         self.dataset(self.data_dir, download=True)
 
+    @property
+    def streaming(self) -> bool:
+        return isinstance(self.dataset, type) and issubclass(self.dataset, IterableDataset)
+
     def setup(self, stage=None):
+        if self.streaming:
+            return self._setup_streaming(stage)
         if stage == "fit" or stage is None:
-            full_dataset = self.dataset(self.data_dir, train=True, transform=self.transforms)
-            train_size = int(len(full_dataset) * self.train_size)
-            test_size = len(full_dataset) - train_size
-            self.train_data, self.val_data = random_split(full_dataset, lengths=[train_size, test_size])
+            full_dataset = self._build_dataset(train=True)
+            train_indices, val_indices = load_or_create_split(
+                full_dataset,
+                self.train_size,
+                seed=self.split_seed,
+                splits_dir=self.splits_dir,
+                stratify=self.stratify,
+                num_folds=self.num_folds,
+                fold=self.fold,
+            )
+            self.train_data, self.val_data = Subset(full_dataset, train_indices), Subset(full_dataset, val_indices)
         if stage == "test" or stage is None:
-            self.test_data = self.dataset(self.data_dir, train=False, transform=self.transforms)
+            self.test_data = self._build_dataset(train=False)
+
+    def _build_dataset(self, train: bool) -> Dataset:
+        if not self.cache_preprocessed:
+            return self.dataset(self.data_dir, train=train, transform=self.transforms)
+        build = partial(self.dataset, self.data_dir, train=train, transform=self.transforms)
+        return CachedDataset(build, self._cache_key(train), self.cache)
+
+    def _cache_key(self, train: bool) -> str:
+        dataset = f"{self.dataset.__module__}.{self.dataset.__qualname__}"
+        files = directory_fingerprint(self.data_dir, exclude=(self.cache.root, config.COMPILECACHEPATH))
+        return cache_key(dataset, self.data_dir, files, train, self.preprocessing_config or repr(self.transforms))
+
+    def _setup_streaming(self, stage=None):
+        if stage == "fit" or stage is None:
+            self.train_data = self.dataset(self.data_dir, split="train", transform=self.transforms)
+            self.val_data = self.dataset(self.data_dir, split="val", transform=self.transforms)
+            if self._stream_state is not None:
+                self.train_data.load_state_dict(self._stream_state)
+        if stage == "test" or stage is None:
+            self.test_data = self.dataset(self.data_dir, split="test", transform=self.transforms)
+
+    def state_dict(self) -> Dict[str, Any]:
+        if not self.streaming:
+            return {}
+        return {"stream": {"epoch": self._epoch, "samples_seen": self._samples_seen, "batch_size": self.batch_size}}
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        if "stream" not in state_dict:
+            return
+        self._stream_state = state_dict["stream"]
+        self._epoch, self._samples_seen = self._stream_state["epoch"], self._stream_state["samples_seen"]
+        if hasattr(self, "train_data"):
+            self.train_data.load_state_dict(self._stream_state)
 
     # def teardown(self):
     #     pass
 
     def train_dataloader(self):
-        return DataLoader(self.train_data, num_workers=self.num_workers)
+        return self._dataloader(self.train_data, shuffle=True)
 
     def test_dataloader(self):
-        return DataLoader(self.test_data, num_workers=self.num_workers)
+        return self._dataloader(self.test_data)
 
     def val_dataloader(self):
-        return DataLoader(self.val_data, num_workers=self.num_workers)
+        return self._dataloader(self.val_data)
+
+    def workers_per_rank(self) -> int:
+        """This rank's share of ``num_workers``, among the trainer's processes on this node."""
+        ranks = self.trainer.num_devices if self.trainer is not None else 1
+        return self.num_workers // max(ranks, 1)
+
+    def _dataloader(self, dataset: Dataset, shuffle: bool = False) -> DataLoader:
+        num_workers = self.workers_per_rank()
+        loader_kwargs = dict(
+            num_workers=num_workers,
+            pin_memory=torch.cuda.is_available() if self.pin_memory is None else self.pin_memory,
+            persistent_workers=self.persistent_workers and num_workers > 0,
+            prefetch_factor=self.prefetch_factor if num_workers > 0 else None,
+        )
+        if num_workers > 0 and self.worker_cpus:
+            rank = self.trainer.global_rank if self.trainer is not None else 0
+            loader_kwargs["worker_init_fn"] = partial(pin_worker, cpus=self.worker_cpus, rank=rank)
+        if isinstance(dataset, IterableDataset):
+            # streams are shuffled and sharded by the dataset itself, so only batching and collation apply
+            collate_fn = PackingCollate(self.max_tokens, self.pad_value) if self._packs(dataset) else None
+            return _StreamLoader(
+                dataset, self._current_epoch, batch_size=self.batch_size, collate_fn=collate_fn, **loader_kwargs
+            )
+
+        sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+        if not self._packs(dataset):
+            return DataLoader(dataset, batch_size=self.batch_size, sampler=sampler, **loader_kwargs)
+
+        batch_sampler = BucketBatchSampler(
+            sampler,
+            batch_size=self.batch_size,
+            lengths=sequence_lengths(dataset),
+            bucket_size=self.bucket_size or 1,
+            shuffle=shuffle,
+        )
+        collate_fn = PackingCollate(max_tokens=self.max_tokens, pad_value=self.pad_value)
+        return DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=collate_fn, **loader_kwargs)
+
+    def _current_epoch(self) -> int:
+        return self.trainer.current_epoch if self.trainer is not None else 0
+
+    def _packs(self, dataset: Dataset) -> bool:
+        """Whether the loader of ``dataset`` packs with ``PackingCollate`` into (inputs, targets, segment_ids).
+
+        Map-style datasets are packed when bucketed or given ``max_tokens``; streams, which are not bucketed, only with
+        ``max_tokens``.
+        """
+        if isinstance(dataset, IterableDataset):
+            return self.max_tokens is not None
+        return self.bucket_size is not None or self.max_tokens is not None
+
+    def on_after_batch_transfer(self, batch: Any, dataloader_idx: int) -> Any:
+        if self.trainer is not None and self.trainer.training:
+            packed = self._packs(self.train_data) and isinstance(batch, (tuple, list))
+            if packed:
+                # packed rows hold several samples, numbered from 1 in segment_ids
+                num_samples = int(batch[2].max(dim=1).values.sum())
+            else:
+                num_samples = _num_samples(batch)
+                if num_samples is None:
+                    return batch
+            if self._epoch != self.trainer.current_epoch:
+                self._epoch, self._samples_seen = self.trainer.current_epoch, 0
+            self._samples_seen += num_samples
+            if self.log_throughput:
+                self._log_throughput(num_samples, batch[2] if packed else None)
+        return batch
+
+    def _log_throughput(self, num_samples: int, segment_ids: Optional[torch.Tensor]) -> None:
+        now = time.perf_counter()
+        if self._window_start is None:
+            self._window_start, self._window_samples = now, 0
+            return
+
+        self._window_samples += num_samples
+        if self.trainer.logger is None or (self.trainer.global_step + 1) % self.trainer.log_every_n_steps:
+            return
+        metrics = {"data/samples_per_sec": self._window_samples / (now - self._window_start)}
+        if segment_ids is not None:
+            metrics["data/padding_ratio"] = float((segment_ids == 0).float().mean())
+        self.trainer.logger.log_metrics(metrics, step=self.trainer.global_step)
+        self._window_start, self._window_samples = now, 0
+
+
+class _StreamLoader(DataLoader):
+    """Starts every pass over a stream at the trainer's epoch.
+
+    Workers iterate copies of the dataset, so the epoch a stream advances after a pass is lost with them unless they
+    persist, and every epoch would repeat the first one's shard order and shuffle. Nothing in Lightning calls
+    ``set_epoch`` on an iterable dataset, so the loader does it as each pass starts.
+    """
+
+    def __init__(self, dataset: IterableDataset, epoch: Callable[[], int], *args: Any, **kwargs: Any) -> None:
+        super().__init__(dataset, *args, **kwargs)
+        self.epoch = epoch
+
+    def __iter__(self) -> Iterator[Any]:
+        if hasattr(self.dataset, "set_epoch"):
+            self.dataset.set_epoch(self.epoch())
+        return super().__iter__()
+
+
+def default_num_workers() -> int:
+    """Half of the CPUs available to this process, respecting its CPU affinity where the platform exposes it."""
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+    return cpus // 2
+
+
+def _num_samples(batch: Any) -> Optional[int]:
+    """The samples in a tensor, a tuple or list led by one, or a dict of tensors; None for other batches."""
+    if isinstance(batch, torch.Tensor):
+        return len(batch) if batch.dim() else None
+    if isinstance(batch, dict):
+        batch = [value for value in batch.values() if isinstance(value, torch.Tensor)]
+    if isinstance(batch, (tuple, list)) and batch and isinstance(batch[0], torch.Tensor) and batch[0].dim():
+        return len(batch[0])
+    return None
@@ -1,3 +1,17 @@
+import hashlib
+import os
+from itertools import islice
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import torch
+from lightning_utilities.core.imports import RequirementCache
+from torch.utils.data import IterableDataset, get_worker_info
+
+_PANDAS_AVAILABLE = RequirementCache("pandas")
+_PYARROW_AVAILABLE = RequirementCache("pyarrow")
+
+
 class LabDataset:
     """
     Note:
@@ -21,3 +35,186 @@ class LabDataset:
             return torch.tensor(x, dtype=torch.float32), torch.tensor(y, dtype=torch.float32)
     ```
     """
+
+
+class LabStreamingDataset(IterableDataset):
+    """Streams samples from local shard files without loading them into memory.
+
+    Shards are the ``.csv``, ``.parquet``, ``.arrow``/``.feather`` and ``.npy`` files in ``data_dir/<split>`` and are
+    read ``chunk_size`` rows at a time. Every DataLoader worker on every DDP rank is a separate consumer: shards are
+    dealt out to consumers round-robin, or, when there are fewer shards than consumers, every consumer reads every
+    shard and keeps every ``num_consumers``-th row, so no sample is read twice. Under DDP every consumer stops after
+    as many samples as the smallest one holds, so all ranks take the same number of batches and none is left waiting
+    in a collective; the few samples past that count are dropped for the pass.
+
+    Samples are shuffled through a buffer of ``shuffle_buffer`` samples, seeded by ``seed``, the pass number and the
+    consumer. The pass number advances after every full pass, so keep ``persistent_workers`` on when streaming with
+    workers. ``load_state_dict`` restores a mid-epoch cursor saved by ``LabDataModule.state_dict``; on resume each
+    consumer replays its stream up to the cursor without yielding the skipped samples.
+
+    Args:
+        data_dir: the directory that holds a folder of shards per split.
+        train: read the "train" split, else the "test" split; ignored if ``split`` is given.
+        transform: applied to the features of every sample.
+        split: the folder of shards to read.
+        label_columns: the columns returned as labels, by name for tables and by index for ``.npy`` shards.
+        chunk_size: rows read per chunk.
+        shuffle_buffer: the number of samples shuffled together; 0 keeps file order.
+        seed: the shuffle seed.
+        download: unused; accepted for the ``LabDataModule`` interface.
+    """
+
+    extensions = (".csv", ".parquet", ".arrow", ".feather", ".npy")
+
+    def __init__(
+        self,
+        data_dir: str,
+        train: bool = True,
+        transform: Optional[Callable] = None,
+        split: Optional[str] = None,
+        label_columns: Sequence[Union[str, int]] = (),
+        chunk_size: int = 10_000,
+        shuffle_buffer: int = 0,
+        seed: int = 42,
+        download: bool = False,
+    ) -> None:
+        super().__init__()
+        self.data_dir = data_dir
+        self.split = split or ("train" if train else "test")
+        self.transform = transform
+        self.label_columns = list(label_columns)
+        self.chunk_size = chunk_size
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        split_dir = os.path.join(data_dir, self.split)
+        names = sorted(os.listdir(split_dir)) if os.path.isdir(split_dir) else []
+        self.shards = [os.path.join(split_dir, name) for name in names if name.endswith(self.extensions)]
+        self.rank, self.world_size = _distributed_rank()
+        self.epoch = 0
+        self._resume: Optional[Dict[str, int]] = None
+        self._row_counts: Optional[Dict[str, int]] = None
+
+    @property
+    def fingerprint(self) -> str:
+        stats = [(path, os.path.getsize(path), os.path.getmtime(path)) for path in self.shards]
+        return hashlib.sha256(repr(stats).encode()).hexdigest()[:16]
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def load_state_dict(self, state_dict: Dict[str, int]) -> None:
+        """Resumes pass ``epoch`` after ``samples_seen`` samples were handed out in batches of ``batch_size``."""
+        self.epoch = state_dict["epoch"]
+        self._resume = dict(state_dict)
+
+    def __iter__(self) -> Iterator[Any]:
+        worker = get_worker_info()
+        num_workers, worker_id = (worker.num_workers, worker.id) if worker is not None else (1, 0)
+        num_consumers = self.world_size * num_workers
+        consumer = self.rank * num_workers + worker_id
+
+        # every consumer must agree on the shard order, so it depends on the epoch only
+        order = [self.shards[i] for i in np.random.default_rng([self.seed, self.epoch]).permutation(len(self.shards))]
+        if len(order) >= num_consumers:
+            shards, row_stride, row_offset = order[consumer::num_consumers], 1, 0
+        else:
+            shards, row_stride, row_offset = order, num_consumers, consumer
+
+        samples = self._read(shards, row_stride, row_offset)
+        if self.shuffle_buffer > 1:
+            samples = _shuffle(samples, self.shuffle_buffer, np.random.default_rng([self.seed, self.epoch, consumer]))
+        skip, self._resume = self._skip(num_workers, worker_id), None
+        limit = self._balanced_length(order, num_consumers) if self.world_size > 1 else None
+        yield from islice(samples, skip, limit)
+        self.epoch += 1
+
+    def _balanced_length(self, shards: List[str], num_consumers: int) -> int:
+        """The sample count of the consumer with the fewest samples, given the epoch's shard order."""
+        if self._row_counts is None:
+            self._row_counts = {path: _count_rows(path) for path in self.shards}
+        counts = [self._row_counts[path] for path in shards]
+        if len(shards) >= num_consumers:
+            return min(sum(counts[consumer::num_consumers]) for consumer in range(num_consumers))
+        return min(sum(len(range(consumer, n, num_consumers)) for n in counts) for consumer in range(num_consumers))
+
+    def _skip(self, num_workers: int, worker_id: int) -> int:
+        if self._resume is None or self._resume["epoch"] != self.epoch:
+            return 0
+        # the DataLoader takes whole batches from its workers in turn, starting with worker 0
+        batch_size = self._resume["batch_size"]
+        batches_seen = self._resume["samples_seen"] // batch_size
+        return (batches_seen - worker_id + num_workers - 1) // num_workers * batch_size
+
+    def _read(self, shards: List[str], row_stride: int, row_offset: int) -> Iterator[Any]:
+        for path in shards:
+            row = 0
+            for columns, chunk in _read_chunks(path, self.chunk_size):
+                first = (row_offset - row) % row_stride
+                row += len(chunk)
+                chunk = chunk[first::row_stride]
+                label_idx = [columns.index(column) for column in self.label_columns]
+                feature_idx = [i for i in range(len(columns)) if i not in label_idx]
+                features = torch.as_tensor(np.asarray(chunk[:, feature_idx], dtype=np.float32))
+                labels = torch.as_tensor(np.asarray(chunk[:, label_idx], dtype=np.float32)) if label_idx else None
+                for i in range(len(features)):
+                    x = self.transform(features[i]) if self.transform is not None else features[i]
+                    yield (x, labels[i]) if labels is not None else x
+
+
+def _read_chunks(path: str, chunk_size: int) -> Iterator[Tuple[List[Union[str, int]], np.ndarray]]:
+    """Yields ``(column names, rows)`` chunks of a shard file."""
+    if path.endswith(".npy"):
+        array = np.load(path, mmap_mode="r")
+        array = array.reshape(len(array), -1)
+        for start in range(0, len(array), chunk_size):
+            yield list(range(array.shape[1])), np.asarray(array[start : start + chunk_size])
+    elif path.endswith(".csv"):
+        if not _PANDAS_AVAILABLE:
+            raise ModuleNotFoundError(str(_PANDAS_AVAILABLE))
+        import pandas as pd
+
+        for frame in pd.read_csv(path, chunksize=chunk_size):
+            yield list(frame.columns), frame.to_numpy()
+    else:
+        if not _PYARROW_AVAILABLE:
+            raise ModuleNotFoundError(str(_PYARROW_AVAILABLE))
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if path.endswith(".parquet"):
+            batches = pq.ParquetFile(path).iter_batches(batch_size=chunk_size)
+        else:
+            reader = pa.ipc.open_file(pa.memory_map(path))
+            batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+        for batch in batches:
+            columns = [column.to_numpy(zero_copy_only=False) for column in batch.columns]
+            yield batch.schema.names, np.column_stack(columns)
+
+
+def _count_rows(path: str) -> int:
+    """The number of rows of a shard file, read from its metadata where the format keeps one."""
+    if path.endswith(".npy"):
+        return len(np.load(path, mmap_mode="r"))
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        return pq.ParquetFile(path).metadata.num_rows
+    return sum(len(chunk) for _, chunk in _read_chunks(path, 100_000))
+
+
+def _shuffle(samples: Iterator[Any], buffer_size: int, rng: np.random.Generator) -> Iterator[Any]:
+    buffer = []
+    for sample in samples:
+        if len(buffer) < buffer_size:
+            buffer.append(sample)
+            continue
+        i = rng.integers(buffer_size)
+        yield buffer[i]
+        buffer[i] = sample
+    yield from (buffer[i] for i in rng.permutation(len(buffer)))
+
+
+def _distributed_rank() -> Tuple[int, int]:
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        return torch.distributed.get_rank(), torch.distributed.get_world_size()
+    return 0, 1
@@ -5,78 +5,231 @@
 # and also
 # https://github.com/labmlai/annotated_deep_learning_paper_implementations/tree/master/labml_nn/diffusion/ddpm
 
+import math
+from functools import lru_cache
+from typing import Dict, Optional
+
 import torch
+import torch.nn.functional as F
+from pytorch_lightning import LightningModule
+from torch import Tensor
+
 
 # Define the model architecture
-class DiffusionModel:
-  def __init__(self, num_steps, beta_schedule, image_size):
-    self.num_steps = num_steps
-    self.beta_schedule = beta_schedule
-    self.image_size = image_size
-    self.encoder = Encoder(image_size)  # Encoder network
-    self.decoder = Decoder(image_size)  # Decoder network
-
-  def forward(self, x):
-    # Forward process
-    x_noisy = x
-    for i in range(self.num_steps):
-      beta = self.beta_schedule[i]
-      eps = torch.randn_like(x_noisy)  # Sample noise
-      x_noisy = x_noisy + beta * eps
-    return x_noisy
-
-  def reverse(self, x_noisy):
-    # Reverse process
-    x_recon = x_noisy
-    for i in range(self.num_steps - 1, -1, -1):
-      beta = self.beta_schedule[i]
-      eps_recon = self.encoder(x_recon)
-      x_recon = (x_recon - beta * eps_recon) / (1 - beta**2)
-    return x_recon
-
-  def loss(self, x, x_noisy):
-    # Loss function
-    x_recon = self.reverse(x_noisy)
-    return torch.mean((x - x_recon)**2)
-
-  def train_step(self, x):
-    # Training step
-    x_noisy = self.forward(x)
-    loss = self.loss(x, x_noisy)
-    optimizer = torch.optim.Adam(self.parameters(), lr=0.001)
-    optimizer.zero_grad()
-    loss.backward()
-    optimizer.step()
-    return loss
+class DiffusionModel(LightningModule):
+    """A DDPM-style diffusion model whose encoder learns to predict the noise added to a sample.
+
+    Noising is done in closed form, x_t = sqrt(alpha_bar_t) x_0 + sqrt(1 - alpha_bar_t) eps, and every training
+    step draws one timestep per sample, so a step costs a single network call regardless of ``num_steps``.
+
+    ``schedule`` names the beta schedule (see ``beta_schedule``); an explicit ``beta_schedule`` tensor overrides it.
+    """
+
+    def __init__(
+        self,
+        num_steps: int = 1000,
+        beta_schedule: Optional[Tensor] = None,
+        image_size: int = 784,
+        lr=0.001,
+        schedule: str = "linear",
+    ):
+        super().__init__()
+        self.save_hyperparameters(ignore=["beta_schedule"])
+        self.num_steps = num_steps
+        self.image_size = image_size
+        self.lr = lr
+        self.schedule = schedule if beta_schedule is None else None
+        self.encoder = Encoder(image_size)  # Encoder network
+        self.decoder = Decoder(image_size)  # Decoder network
+
+        betas = _named_beta_schedule(num_steps, schedule) if beta_schedule is None else torch.as_tensor(beta_schedule)
+        alphas_cumprod = torch.cumprod(1 - betas, dim=0)
+        # derived from the schedule, so they follow the module across devices but stay out of checkpoints
+        self.register_buffer("betas", betas, persistent=False)
+        self.register_buffer("alphas_cumprod", alphas_cumprod, persistent=False)
+        self.register_buffer("sqrt_alphas_cumprod", alphas_cumprod.sqrt(), persistent=False)
+        self.register_buffer("sqrt_one_minus_alphas_cumprod", (1 - alphas_cumprod).sqrt(), persistent=False)
+
+    def forward(self, x: Tensor, t: Optional[Tensor] = None) -> Tensor:
+        # Forward process: noise x to timestep t, the last timestep by default
+        if t is None:
+            t = torch.full((x.size(0),), self.num_steps - 1, device=x.device)
+        return self.q_sample(x, t, torch.randn_like(x))
+
+    def q_sample(self, x: Tensor, t: Tensor, noise: Tensor) -> Tensor:
+        """Samples x_t ~ q(x_t | x_0) in one shot from the cumulative product of the alphas."""
+        return self.sqrt_alphas_cumprod[t, None] * x + self.sqrt_one_minus_alphas_cumprod[t, None] * noise
+
+    def predict_noise(self, x_noisy: Tensor, t: Tensor) -> Tensor:
+        return self.encoder(x_noisy, t.float() / self.num_steps)
+
+    @torch.no_grad()
+    def reverse(self, x_noisy: Tensor) -> Tensor:
+        # Reverse process: ancestral sampling through every timestep
+        x_recon = x_noisy
+        for i in range(self.num_steps - 1, -1, -1):
+            t = torch.full((x_recon.size(0),), i, device=x_recon.device)
+            beta = self.betas[i]
+            eps_recon = self.predict_noise(x_recon, t)
+            x_recon = (x_recon - beta / self.sqrt_one_minus_alphas_cumprod[i] * eps_recon) / (1 - beta).sqrt()
+            if i > 0:
+                x_recon = x_recon + beta.sqrt() * torch.randn_like(x_recon)
+        return x_recon
+
+    @torch.no_grad()
+    def sample(
+        self,
+        num_samples: int,
+        steps: int = 50,
+        eta: float = 0.0,
+        batch_size: Optional[int] = None,
+        generator: Optional[torch.Generator] = None,
+    ) -> Tensor:
+        """Draws ``num_samples`` samples with a DDIM sampler that visits ``steps`` of the ``num_steps`` timesteps.
+
+        Samples are denoised together, ``batch_size`` at a time (all at once by default).
+        """
+        sampler = DDIMSampler(self, steps=steps, eta=eta)
+        batch_size = batch_size or num_samples
+        chunks = []
+        for start in range(0, num_samples, batch_size):
+            shape = (min(batch_size, num_samples - start), self.image_size)
+            x_noisy = torch.randn(shape, device=self.device, dtype=self.dtype, generator=generator)
+            chunks.append(sampler(x_noisy, generator=generator))
+        return torch.cat(chunks)
+
+    def loss(self, x: Tensor) -> Tensor:
+        # Loss function: predict the noise mixed into x at a random timestep per sample
+        t = torch.randint(0, self.num_steps, (x.size(0),), device=x.device)
+        noise = torch.randn_like(x)
+        return F.mse_loss(self.predict_noise(self.q_sample(x, t, noise), t), noise)
+
+    def training_step(self, batch, batch_idx: int) -> Tensor:
+        x = batch[0] if isinstance(batch, (tuple, list)) else batch
+        loss = self.loss(x.flatten(1))
+        self.log("train_loss", loss)
+        return loss
+
+    def validation_step(self, batch, batch_idx: int) -> None:
+        x = batch[0] if isinstance(batch, (tuple, list)) else batch
+        self.log("val_loss", self.loss(x.flatten(1)))
+
+    def configure_optimizers(self) -> torch.optim.Optimizer:
+        return torch.optim.Adam(self.parameters(), lr=self.lr)
+
 
 # Define the encoder and decoder networks
 class Encoder(torch.nn.Module):
-  def __init__(self, image_size):
-    super(Encoder, self).__init__()
-    self.fc1 = torch.nn.Linear(image_size, 128)
-    self.fc2 = torch.nn.Linear(128, 128)
-    self.fc3 = torch.nn.Linear(128, image_size)
-
-  def forward(self, x):
-    x = torch.relu(self.fc1(x))
-    x = torch.relu(self.fc2(x))
-    x = self.fc3(x)
-    return x
+    def __init__(self, image_size):
+        super(Encoder, self).__init__()
+        self.fc1 = torch.nn.Linear(image_size, 128)
+        self.fc2 = torch.nn.Linear(128, 128)
+        self.fc3 = torch.nn.Linear(128, image_size)
+        # embeds the timestep, scaled to [0, 1), into the first hidden layer
+        self.time_embedding = torch.nn.Linear(1, 128)
+
+    def forward(self, x, t=None):
+        x = self.fc1(x)
+        if t is not None:
+            x = x + self.time_embedding(t.unsqueeze(-1).to(x.dtype))
+        x = torch.relu(x)
+        x = torch.relu(self.fc2(x))
+        x = self.fc3(x)
+        return x
+
 
 class Decoder(torch.nn.Module):
-  def __init__(self, image_size):
-    super(Decoder, self).__init__()
-    self.fc1 = torch.nn.Linear(image_size, 128)
-    self.fc2 = torch.nn.Linear(128, 128)
-    self.fc3 = torch.nn.Linear(128, image_size)
-
-  def forward(self, x):
-    x = torch.relu(self.fc1(x))
-    x = torch.relu(self.fc2(x))
-    x = self.fc3(x)
-    return x
+    def __init__(self, image_size):
+        super(Decoder, self).__init__()
+        self.fc1 = torch.nn.Linear(image_size, 128)
+        self.fc2 = torch.nn.Linear(128, 128)
+        self.fc3 = torch.nn.Linear(128, image_size)
+
+    def forward(self, x):
+        x = torch.relu(self.fc1(x))
+        x = torch.relu(self.fc2(x))
+        x = self.fc3(x)
+        return x
+
+
+class DDIMSampler:
+    """Deterministic (``eta=0``) or stochastic DDIM sampling over a strided subset of the model's timesteps.
+
+    The per-step coefficients only depend on the schedule, so they are computed once per (schedule, num_steps,
+    steps, eta, device) and shared by every sampler built for that combination.
+
+    Args:
+        model: the trained diffusion model.
+        steps: the number of timesteps visited, evenly spaced over ``model.num_steps``.
+        eta: scales the noise injected at every step, from 0 (DDIM) to 1 (DDPM-like).
+    """
+
+    def __init__(self, model: DiffusionModel, steps: int = 50, eta: float = 0.0) -> None:
+        self.model = model
+        self.steps = min(steps, model.num_steps)
+        self.eta = eta
+        if model.schedule is not None:
+            self.table = ddim_coefficients(model.schedule, model.num_steps, self.steps, eta, model.device)
+        else:
+            self.table = _ddim_coefficients(model.alphas_cumprod, self.steps, eta)
+
+    def __call__(self, x_noisy: Tensor, generator: Optional[torch.Generator] = None) -> Tensor:
+        x = x_noisy
+        table = self.table
+        for i in range(len(table["timesteps"])):
+            t = table["timesteps"][i].expand(x.size(0))
+            eps = self.model.predict_noise(x, t)
+            x0 = (x - table["sqrt_one_minus_alpha_bar"][i] * eps) / table["sqrt_alpha_bar"][i]
+            x = table["sqrt_alpha_bar_prev"][i] * x0 + table["eps_coef"][i] * eps
+            if self.eta > 0:
+                noise = torch.randn(x.shape, device=x.device, dtype=x.dtype, generator=generator)
+                x = x + table["sigma"][i] * noise
+        return x
+
+
+@lru_cache(maxsize=32)
+def ddim_coefficients(schedule: str, num_steps: int, steps: int, eta: float, device: torch.device) -> Dict[str, Tensor]:
+    """The DDIM coefficient table of a named schedule, cached per (schedule, num_steps, steps, eta, device)."""
+    alphas_cumprod = torch.cumprod(1 - beta_schedule(num_steps, schedule), dim=0)
+    return {key: value.to(device) for key, value in _ddim_coefficients(alphas_cumprod, steps, eta).items()}
+
+
+def _ddim_coefficients(alphas_cumprod: Tensor, steps: int, eta: float) -> Dict[str, Tensor]:
+    num_steps = len(alphas_cumprod)
+    timesteps = torch.linspace(num_steps - 1, 0, steps, device=alphas_cumprod.device).round().long()
+    alpha_bar = alphas_cumprod[timesteps]
+    # the step after the last one is the clean sample, alpha_bar = 1
+    alpha_bar_prev = torch.cat([alpha_bar[1:], alpha_bar.new_ones(1)])
+    sigma = eta * ((1 - alpha_bar_prev) / (1 - alpha_bar) * (1 - alpha_bar / alpha_bar_prev)).sqrt()
+    return {
+        "timesteps": timesteps,
+        "sqrt_alpha_bar": alpha_bar.sqrt(),
+        "sqrt_one_minus_alpha_bar": (1 - alpha_bar).sqrt(),
+        "sqrt_alpha_bar_prev": alpha_bar_prev.sqrt(),
+        "eps_coef": (1 - alpha_bar_prev - sigma**2).clamp(min=0).sqrt(),
+        "sigma": sigma,
+    }
+
 
 # Define the beta schedule
-def beta_schedule(num_steps):
-  beta = torch.linspace(0.0001, 0.02, num_steps)
-  return beta
+def beta_schedule(num_steps, kind="linear"):
+    """Betas for ``num_steps`` timesteps; ``kind`` is "linear", "quadratic", "sigmoid" or "cosine"."""
+    if kind == "linear":
+        beta = torch.linspace(0.0001, 0.02, num_steps)
+    elif kind == "quadratic":
+        beta = torch.linspace(0.0001**0.5, 0.02**0.5, num_steps) ** 2
+    elif kind == "sigmoid":
+        beta = torch.sigmoid(torch.linspace(-6, 6, num_steps)) * (0.02 - 0.0001) + 0.0001
+    elif kind == "cosine":
+        # Nichol & Dhariwal (2021): alpha_bar follows a squared cosine, offset by s = 0.008
+        steps = torch.arange(num_steps + 1, dtype=torch.float64) / num_steps
+        alphas_cumprod = torch.cos((steps + 0.008) / 1.008 * math.pi / 2) ** 2
+        beta = (1 - alphas_cumprod[1:] / alphas_cumprod[:-1]).clamp(max=0.999).float()
+    else:
+        raise ValueError(f"Unknown beta schedule {kind!r}")
+    return beta
+
+
+def _named_beta_schedule(num_steps, kind):
+    # DiffusionModel's `beta_schedule` argument shadows the function of the same name
+    return beta_schedule(num_steps, kind)
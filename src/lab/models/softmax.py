@@ -0,0 +1,152 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""output heads for language models with large vocabularies: frequency-clustered adaptive softmax and chunked losses"""
+
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch import Tensor, nn
+from torch.utils.checkpoint import checkpoint
+
+
+def frequency_cutoffs(counts: Sequence[int], coverage: Sequence[float] = (0.9, 0.98)) -> List[int]:
+    """Cluster boundaries over frequency ranks: the shortlist and every tail cluster end at these ``coverage``s.
+
+    With the default, the shortlist holds the most frequent tokens that together make up 90% of the corpus, the
+    next cluster those up to 98%, and the last cluster the rare rest. Cutoffs are strictly increasing ranks in
+    ``(0, len(counts))``, as ``nn.AdaptiveLogSoftmaxWithLoss`` expects.
+    """
+    counts = np.sort(np.asarray(counts, dtype=np.float64))[::-1]
+    cumulative = np.cumsum(counts) / max(counts.sum(), 1)
+    cutoffs = []
+    for fraction in coverage:
+        cutoff = int(np.searchsorted(cumulative, fraction)) + 1
+        cutoff = max(cutoff, cutoffs[-1] + 1 if cutoffs else 1)
+        if cutoff >= len(counts):
+            break
+        cutoffs.append(cutoff)
+    if not cutoffs:
+        raise ValueError(f"A vocabulary of {len(counts)} tokens is too small to cluster")
+    return cutoffs
+
+
+class AdaptiveSoftmaxHead(nn.Module):
+    """An adaptive softmax (Grave et al., 2017) over tokens clustered by frequency.
+
+    Tokens are ranked by ``token_counts``, most frequent first, and split at ``cutoffs`` into a shortlist, scored
+    with the cluster logits in a single small matrix product, and tail clusters whose projections shrink by
+    ``div_value`` each. The loss only evaluates the tail clusters of the targets in a batch, and ``topk`` only those
+    that can still hold a top-k token, so the full (N, vocab_size) matrix is computed by ``forward`` alone.
+
+    Token ids are those of the ``Dictionary``; the ranking is kept in buffers, so it travels with the state dict and
+    a head built without counts takes it from a checkpoint.
+
+    Args:
+        in_features: the size of the hidden states.
+        vocab_size: the number of tokens.
+        cutoffs: increasing frequency ranks ending the shortlist and every tail cluster but the last, e.g. from
+            ``frequency_cutoffs``.
+        token_counts: the number of occurrences of every token id, e.g. ``Dictionary.counts``; defaults to treating
+            lower ids as more frequent.
+        div_value: how much smaller the projection of every next tail cluster is.
+    """
+
+    def __init__(
+        self,
+        in_features: int,
+        vocab_size: int,
+        cutoffs: Sequence[int],
+        token_counts: Optional[Sequence[int]] = None,
+        div_value: float = 4.0,
+    ) -> None:
+        super().__init__()
+        self.adaptive = nn.AdaptiveLogSoftmaxWithLoss(in_features, vocab_size, list(cutoffs), div_value=div_value)
+        if token_counts is not None:
+            # a stable sort keeps ties in id order
+            order = torch.from_numpy(np.argsort(-np.asarray(token_counts, dtype=np.int64), kind="stable"))
+        else:
+            order = torch.arange(vocab_size)
+        # token_ids[rank] is the token of a frequency rank, ranks[token_id] its rank
+        self.register_buffer("token_ids", order)
+        self.register_buffer("ranks", torch.empty_like(order).scatter_(0, order, torch.arange(vocab_size)))
+
+    def forward(self, hidden: Tensor) -> Tensor:
+        """The log-probabilities of every token, of shape (..., vocab_size)."""
+        log_probs = self.adaptive.log_prob(hidden.reshape(-1, hidden.size(-1)))
+        return log_probs[:, self.ranks].reshape(*hidden.shape[:-1], -1)
+
+    def loss(self, hidden: Tensor, target: Tensor) -> Tensor:
+        """The mean negative log-likelihood of ``target`` token ids."""
+        return self.adaptive(hidden.reshape(-1, hidden.size(-1)), self.ranks[target.reshape(-1)]).loss
+
+    def topk(self, hidden: Tensor, k: int) -> Tuple[Tensor, Tensor]:
+        """The ``k`` most likely tokens and their log-probabilities, each of shape (..., k), most likely first.
+
+        A tail token's log-probability is that of its cluster plus its log-probability within the cluster, so it
+        can never exceed the cluster's; a tail cluster is only evaluated for the rows where the cluster itself beats
+        the k-th best token found so far. The result is exact.
+        """
+        adaptive = self.adaptive
+        flat = hidden.reshape(-1, hidden.size(-1))
+        head = F.log_softmax(adaptive.head(flat), dim=-1)
+        shortlist = adaptive.shortlist_size
+        values, ranks = head[:, :shortlist].topk(min(k, shortlist), dim=-1)
+        if values.size(1) < k:
+            padding = (0, k - values.size(1))
+            values, ranks = F.pad(values, padding, value=float("-inf")), F.pad(ranks, padding)
+        for cluster, projection in enumerate(adaptive.tail):
+            cluster_log_prob = head[:, shortlist + cluster]
+            rows = (cluster_log_prob > values[:, -1]).nonzero().squeeze(-1)
+            if len(rows) == 0:
+                continue
+            start = adaptive.cutoffs[cluster]
+            tail = F.log_softmax(projection(flat[rows]), dim=-1) + cluster_log_prob[rows, None]
+            tail_ranks = torch.arange(start, start + tail.size(1), device=tail.device).expand_as(tail)
+            best, index = torch.cat([values[rows], tail], dim=1).topk(k, dim=-1)
+            values[rows], ranks[rows] = best, torch.cat([ranks[rows], tail_ranks], dim=1).gather(1, index)
+        shape = (*hidden.shape[:-1], k)
+        return values.reshape(shape), self.token_ids[ranks].reshape(shape)
+
+
+def _linear_cross_entropy(hidden: Tensor, weight: Tensor, bias: Optional[Tensor], target: Tensor) -> Tensor:
+    return F.cross_entropy(F.linear(hidden, weight, bias), target, reduction="sum")
+
+
+def chunked_cross_entropy(hidden: Tensor, decoder: nn.Linear, target: Tensor, chunk_size: int = 4096) -> Tensor:
+    """The mean cross-entropy of ``decoder(hidden)`` against ``target``, ``chunk_size`` rows of logits at a time.
+
+    Every chunk is an activation checkpoint: the forward pass keeps only its loss, and the backward pass recomputes
+    its logits, so at most (chunk_size, vocab_size) logits exist at any time, at the cost of a second decoder
+    matrix product.
+    """
+    hidden, target = hidden.reshape(-1, hidden.size(-1)), target.reshape(-1)
+    total = hidden.new_zeros(())
+    for start in range(0, len(target), chunk_size):
+        end = start + chunk_size
+        if torch.is_grad_enabled():
+            total = total + checkpoint(
+                _linear_cross_entropy,
+                hidden[start:end],
+                decoder.weight,
+                decoder.bias,
+                target[start:end],
+                use_reentrant=False,
+            )
+        else:
+            total = total + _linear_cross_entropy(hidden[start:end], decoder.weight, decoder.bias, target[start:end])
+    return total / len(target)
@@ -1,58 +1,271 @@
 # demo of a selective state space model
 # generated with Meta's Llama 70B Instruct variant using Hugging Chat
 
+import math
+from typing import Optional
+
 import torch
 import torch.nn as nn
 
+
 class StateSpaceModel(nn.Module):
-    def __init__(self, state_dim, obs_dim, 
-                 transition_matrix=None, observation_matrix=None,
-                 process_noise_var=0.1, observation_noise_var=0.5):
+    def __init__(
+        self,
+        state_dim,
+        obs_dim,
+        transition_matrix=None,
+        observation_matrix=None,
+        process_noise_var=0.1,
+        observation_noise_var=0.5,
+    ):
         """
         Initialize the Simple State Space Model.
-        
+
         :param state_dim: Dimension of the state.
         :param obs_dim: Dimension of the observation.
         :param transition_matrix: A (state_dim x state_dim) matrix. If None, defaults to an identity matrix.
-        :param observation_matrix: A (obs_dim x state_dim) matrix. If None, defaults to a matrix that simply selects the first 'obs_dim' states.
+        :param observation_matrix: A (obs_dim x state_dim) matrix. If None, defaults to a matrix that simply selects
+            the first 'obs_dim' states.
         :param process_noise_var: Variance of the process noise.
         :param observation_noise_var: Variance of the observation noise.
         """
         super().__init__()
-        
+
         self.state_dim = state_dim
         self.obs_dim = obs_dim
-        
+
         # Initialize Transition Matrix (A)
-        self.A = nn.Parameter(torch.tensor(transition_matrix) if transition_matrix is not None 
-                               else torch.eye(state_dim), requires_grad=True)
-        
+        self.A = nn.Parameter(
+            torch.tensor(transition_matrix) if transition_matrix is not None else torch.eye(state_dim),
+            requires_grad=True,
+        )
+
         # Initialize Observation Matrix (C)
-        self.C = nn.Parameter(torch.tensor(observation_matrix) if observation_matrix is not None 
-                               else torch.cat([torch.eye(obs_dim), torch.zeros(obs_dim, state_dim-obs_dim)], dim=1), 
-                               requires_grad=True)
-        
+        self.C = nn.Parameter(
+            (
+                torch.tensor(observation_matrix)
+                if observation_matrix is not None
+                else torch.cat([torch.eye(obs_dim), torch.zeros(obs_dim, state_dim - obs_dim)], dim=1)
+            ),
+            requires_grad=True,
+        )
+
         # Initialize Noise Variances
         self.process_noise_var = nn.Parameter(torch.tensor(process_noise_var), requires_grad=False)
         self.observation_noise_var = nn.Parameter(torch.tensor(observation_noise_var), requires_grad=False)
-        
-    def forward(self, initial_state, steps=1):
+
+    def forward(self, initial_state, steps=1, method="sequential", generator: Optional[torch.Generator] = None):
         """
         Generate a sequence of observations from the model.
-        
-        :param initial_state: The initial state (tensor of shape (state_dim,)).
+
+        All process and observation noise is sampled up front. The state recursion x_{t+1} = A x_t + w_t is either
+        unrolled step by step or, with method="scan", evaluated as a log-depth parallel prefix scan, which trades
+        more arithmetic per step for O(log steps) sequential kernel launches.
+
+        :param initial_state: The initial state (tensor of shape (state_dim,) or (batch, state_dim)).
         :param steps: Number of steps to generate.
-        :return: A tensor of shape (steps, obs_dim) containing the generated observations.
+        :param method: "sequential" to loop over time steps, "scan" for the parallel scan.
+        :param generator: Optional random number generator for the noise.
+        :return: A tensor of shape (steps, obs_dim), or (batch, steps, obs_dim) for batched initial states,
+            containing the generated observations.
         """
-        observations = torch.zeros((steps, self.obs_dim))
+        if method not in ("sequential", "scan"):
+            raise ValueError(f"Unknown method {method!r}, expected 'sequential' or 'scan'")
+        unbatched = initial_state.dim() == 1
+        initial_state = initial_state.unsqueeze(0) if unbatched else initial_state
+        batch_size = initial_state.size(0)
+        kwargs = dict(device=self.A.device, dtype=self.A.dtype, generator=generator)
+
+        process_noise = torch.randn(steps, batch_size, self.state_dim, **kwargs) * self.process_noise_var.sqrt()
+        observation_noise = torch.randn(steps, batch_size, self.obs_dim, **kwargs) * self.observation_noise_var.sqrt()
+
+        if method == "scan":
+            states = self._scan_states(initial_state, process_noise)
+        else:
+            states = self._sequential_states(initial_state, process_noise)
+
+        # Generate Observations for every step at once
+        observations = states @ self.C.T + observation_noise
+        return observations.squeeze(1) if unbatched else observations.transpose(0, 1)
+
+    def _sequential_states(self, initial_state, process_noise):
+        """Returns the (steps, batch, state_dim) states x_0 ... x_{steps-1}."""
+        states = process_noise.new_empty(process_noise.shape)
         state = initial_state
-        
-        for t in range(steps):
-            # Generate Observation
-            observation = torch.matmul(self.C, state) + torch.randn(self.obs_dim) * torch.sqrt(self.observation_noise_var)
-            observations[t] = observation
-            
+        for t in range(process_noise.size(0)):
+            states[t] = state
             # Update State
-            state = torch.matmul(self.A, state) + torch.randn(self.state_dim) * torch.sqrt(self.process_noise_var)
-        
-        return observations
\ No newline at end of file
+            state = state @ self.A.T + process_noise[t]
+        return states
+
+    def _scan_states(self, initial_state, process_noise):
+        """Returns the (steps, batch, state_dim) states x_0 ... x_{steps-1} with a parallel prefix scan.
+
+        With u = (x_0, w_0, ..., w_{steps-2}), the states are the inclusive prefix sums x_t = sum_{s<=t} A^{t-s} u_s.
+        """
+        return _prefix_scan(torch.cat([initial_state.unsqueeze(0), process_noise[:-1]], dim=0), self.A)
+
+    def kalman_filter(self, observations, lengths=None, initial_mean=None, initial_cov=None, tol=1e-6):
+        """
+        Filter a batch of observation sequences.
+
+        The state covariances do not depend on the observations, so they are propagated once for the whole batch,
+        with Cholesky solves in place of inverses. Once the predicted covariance stops changing by more than ``tol``
+        the gain is held fixed and the remaining filtered means are computed with a parallel scan.
+
+        :param observations: A tensor of shape (steps, obs_dim) or (batch, steps, obs_dim), padded after each
+            sequence's length.
+        :param lengths: Optional (batch,) tensor with the length of every sequence. Defaults to all steps.
+        :param initial_mean: The prior mean of the first state, of shape (state_dim,) or (batch, state_dim).
+            Defaults to zeros.
+        :param initial_cov: The prior covariance of the first state. Defaults to the identity.
+        :param tol: The covariance change below which the filter switches to its steady-state gain.
+        :return: The filtered means (batch, steps, state_dim), the filtered covariances (steps, state_dim,
+            state_dim) shared by all sequences, and the log-likelihood of every sequence (batch,). The batch
+            dimension is dropped for unbatched observations.
+        """
+        unbatched = observations.dim() == 2
+        filtered = self._filter(
+            observations.unsqueeze(0) if unbatched else observations, initial_mean, initial_cov, tol
+        )
+        means, covs = filtered["filtered_means"], filtered["filtered_covs"]
+        log_likelihood = self._masked_sum(filtered["step_log_likelihood"], lengths)
+        means = means.transpose(0, 1)
+        return (means[0], covs, log_likelihood[0]) if unbatched else (means, covs, log_likelihood)
+
+    def rts_smoother(self, observations, lengths=None, initial_mean=None, initial_cov=None, tol=1e-6):
+        """
+        Smooth a batch of observation sequences with the Rauch-Tung-Striebel smoother.
+
+        Takes the same arguments as ``kalman_filter``. Every sequence is smoothed backwards from its own last step.
+
+        :return: The smoothed means (batch, steps, state_dim) and covariances (batch, steps, state_dim, state_dim).
+            Steps after a sequence's length hold its filtered estimates.
+        """
+        unbatched = observations.dim() == 2
+        observations = observations.unsqueeze(0) if unbatched else observations
+        batch_size, steps, _ = observations.shape
+        filtered = self._filter(observations, initial_mean, initial_cov, tol)
+        means, covs = filtered["filtered_means"], filtered["filtered_covs"]
+        predicted_means, predicted_covs = filtered["predicted_means"], filtered["predicted_covs"]
+        lengths = self._lengths(lengths, batch_size, steps, means.device)
+
+        smoothed_means = [means[-1]]
+        smoothed_covs = [covs[-1].expand(batch_size, -1, -1)]
+        for t in range(steps - 2, -1, -1):
+            # J_t = P_t A^T P_{t+1|t}^{-1}, solved with the Cholesky factor of the predicted covariance
+            gain = torch.cholesky_solve(self.A @ covs[t], torch.linalg.cholesky(predicted_covs[t + 1])).T
+            mean = means[t] + (smoothed_means[0] - predicted_means[t + 1]) @ gain.T
+            cov = covs[t] + gain @ (smoothed_covs[0] - predicted_covs[t + 1]) @ gain.T
+            # sequences that end at step t start their backward pass here
+            inside = (t + 1 < lengths)[:, None]
+            smoothed_means.insert(0, torch.where(inside, mean, means[t]))
+            smoothed_covs.insert(0, torch.where(inside[:, :, None], cov, covs[t]))
+
+        smoothed_means = torch.stack(smoothed_means, dim=1)
+        smoothed_covs = torch.stack(smoothed_covs, dim=1)
+        return (smoothed_means[0], smoothed_covs[0]) if unbatched else (smoothed_means, smoothed_covs)
+
+    def log_likelihood(self, observations, lengths=None, initial_mean=None, initial_cov=None, tol=1e-6):
+        """
+        The differentiable log-likelihood of every observation sequence, of shape (batch,) or a scalar.
+
+        Takes the same arguments as ``kalman_filter``; maximise it to fit A and C to observed data.
+        """
+        return self.kalman_filter(observations, lengths, initial_mean, initial_cov, tol)[2]
+
+    def _filter(self, observations, initial_mean, initial_cov, tol):
+        """Runs the filter on (batch, steps, obs_dim) observations and returns its time-major intermediates."""
+        batch_size, steps, _ = observations.shape
+        observations = observations.transpose(0, 1)
+        Q = self.process_noise_var * torch.eye(self.state_dim, device=self.A.device, dtype=self.A.dtype)
+        R = self.observation_noise_var * torch.eye(self.obs_dim, device=self.A.device, dtype=self.A.dtype)
+        mean = observations.new_zeros(batch_size, self.state_dim) if initial_mean is None else initial_mean
+        mean = mean.expand(batch_size, -1)
+        predicted_cov = torch.eye(self.state_dim, device=self.A.device, dtype=self.A.dtype)
+        predicted_cov = predicted_cov if initial_cov is None else initial_cov
+
+        predicted_means, predicted_covs, means, covs, step_log_likelihood = [], [], [], [], []
+        t = 0
+        while t < steps:
+            # S = C P C^T + R; the gain K = P C^T S^{-1} comes from a Cholesky solve
+            innovation_cov = self.C @ predicted_cov @ self.C.T + R
+            chol = torch.linalg.cholesky(innovation_cov)
+            gain = torch.cholesky_solve(self.C @ predicted_cov, chol).T
+            cov = predicted_cov - gain @ innovation_cov @ gain.T
+            cov = (cov + cov.T) / 2
+            next_predicted_cov = self.A @ cov @ self.A.T + Q
+
+            if t > 0 and (next_predicted_cov - predicted_cov).abs().max() < tol:
+                # steady state: the filtered means follow m_t = (I - K C) A m_{t-1} + K y_t for the remaining steps
+                remaining = steps - t
+                transition = (
+                    torch.eye(self.state_dim, device=self.A.device, dtype=self.A.dtype) - gain @ self.C
+                ) @ self.A
+                inputs = observations[t:] @ gain.T
+                inputs = torch.cat([inputs[:1] + means[-1] @ transition.T, inputs[1:]], dim=0)
+                steady_means = _prefix_scan(inputs, transition)
+                steady_predicted = torch.cat([means[-1].unsqueeze(0), steady_means[:-1]], dim=0) @ self.A.T
+                predicted_means.extend(steady_predicted.unbind(0))
+                means.extend(steady_means.unbind(0))
+                predicted_covs.extend([predicted_cov] * remaining)
+                covs.extend([cov] * remaining)
+                step_log_likelihood.append(_gaussian_log_prob(observations[t:] - steady_predicted @ self.C.T, chol))
+                break
+
+            predicted_means.append(mean)
+            predicted_covs.append(predicted_cov)
+            residual = observations[t] - mean @ self.C.T
+            mean = mean + residual @ gain.T
+            means.append(mean)
+            covs.append(cov)
+            step_log_likelihood.append(_gaussian_log_prob(residual, chol).unsqueeze(0))
+            mean = mean @ self.A.T
+            predicted_cov = next_predicted_cov
+            t += 1
+
+        return {
+            "predicted_means": torch.stack(predicted_means),
+            "predicted_covs": torch.stack(predicted_covs),
+            "filtered_means": torch.stack(means),
+            "filtered_covs": torch.stack(covs),
+            "step_log_likelihood": torch.cat(step_log_likelihood),
+        }
+
+    def _masked_sum(self, step_log_likelihood, lengths):
+        steps, batch_size = step_log_likelihood.shape
+        lengths = self._lengths(lengths, batch_size, steps, step_log_likelihood.device)
+        mask = torch.arange(steps, device=lengths.device)[:, None] < lengths
+        return (step_log_likelihood * mask).sum(dim=0)
+
+    @staticmethod
+    def _lengths(lengths, batch_size, steps, device):
+        # on the device of the estimates they mask, so CUDA models do not compare against a CPU mask
+        if lengths is None:
+            return torch.full((batch_size,), steps, dtype=torch.long, device=device)
+        return torch.as_tensor(lengths, dtype=torch.long, device=device)
+
+
+def _gaussian_log_prob(residual, chol):
+    """log N(residual; 0, S) for S = chol chol^T, over the last dimension of ``residual``."""
+    whitened = torch.linalg.solve_triangular(chol, residual.unsqueeze(-1), upper=False).squeeze(-1)
+    log_det = 2 * chol.diagonal().log().sum()
+    return -0.5 * (residual.size(-1) * math.log(2 * math.pi) + log_det + whitened.pow(2).sum(-1))
+
+
+def _prefix_scan(inputs, transition):
+    """
+    Inclusive prefix scan s_t = sum_{s<=t} F^{t-s} u_s over the first dimension of ``inputs``, i.e. the linear
+    recurrence s_t = F s_{t-1} + u_t, in log2(steps) levels.
+
+    Because F is time invariant, level k adds F^(2^k) applied to the partial sums 2^k steps back, so every level is
+    a single batched matmul (Hillis-Steele).
+    """
+    states = inputs
+    power = transition
+    offset = 1
+    while offset < states.size(0):
+        states = torch.cat([states[:offset], states[offset:] + states[:-offset] @ power.T], dim=0)
+        power = power @ power
+        offset *= 2
+    return states
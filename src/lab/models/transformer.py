@@ -7,23 +7,37 @@ https://github.com/pytorch/examples/blob/main/word_language_model
 
 """
 
+import hashlib
+import json
+import logging
 import math
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
 
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from lightning_utilities.core.imports import RequirementCache
 from torch import Tensor
 from torch.nn.modules import MultiheadAttention
+from torch.utils.checkpoint import checkpoint
 from torch.utils.data import DataLoader, Dataset
 
 from pytorch_lightning import LightningModule
+from pytorch_lightning.callbacks import Callback
+
+from lab.components.io import atomic_write
+from lab.models.softmax import AdaptiveSoftmaxHead, chunked_cross_entropy, frequency_cutoffs
 
 _REQUESTS_AVAILABLE = RequirementCache("requests")
 
+log = logging.getLogger(__name__)
+
 
 if hasattr(MultiheadAttention, "_reset_parameters") and not hasattr(MultiheadAttention, "reset_parameters"):
     # See https://github.com/pytorch/pytorch/issues/107909
@@ -31,6 +45,21 @@ if hasattr(MultiheadAttention, "_reset_parameters") and not hasattr(MultiheadAtt
 
 
 class Transformer(nn.Module):
+    """An encoder-decoder language model over ``nn.Transformer``.
+
+    Two options trade compute for memory on long sequences. ``checkpoint_layers`` keeps only the input of every
+    encoder and decoder layer during training and recomputes the layer's activations in the backward pass.
+    ``attention_dropout`` sets the dropout on attention weights apart from ``dropout``: the fused CPU attention
+    kernel of ``F.scaled_dot_product_attention`` has no dropout, so with ``attention_dropout=0.0`` training stays on
+    it instead of falling back to materializing (T, T) attention matrices for every head.
+
+    The output head is either "dense", a linear layer over the whole vocabulary, or "adaptive", an
+    ``AdaptiveSoftmaxHead`` whose clusters are cut at ``cutoffs`` or, by default, at ``frequency_cutoffs`` of
+    ``token_counts``, e.g. ``WikiText2(...).dictionary.counts``. ``loss`` never builds the (B * T, vocab_size)
+    matrix of ``forward`` with the adaptive head, nor with the dense head given ``loss_chunk_size`` (see
+    ``chunked_cross_entropy``), and ``topk`` ranks the next tokens for inference.
+    """
+
     def __init__(
         self,
         vocab_size: int = 33278,  # default for WikiText2
@@ -39,8 +68,16 @@ class Transformer(nn.Module):
         nhid: int = 200,
         nlayers: int = 2,
         dropout: float = 0.2,
+        attention_dropout: Optional[float] = None,
+        checkpoint_layers: bool = False,
+        head: str = "dense",
+        cutoffs: Optional[Sequence[int]] = None,
+        token_counts: Optional[Sequence[int]] = None,
+        loss_chunk_size: Optional[int] = None,
     ) -> None:
         super().__init__()
+        if head not in ("dense", "adaptive"):
+            raise ValueError(f"Unknown output head {head!r}, expected 'dense' or 'adaptive'")
         self.pos_encoder = PositionalEncoding(ninp, dropout)
         self.embedding = nn.Embedding(vocab_size, ninp)
         self.transformer = nn.Transformer(
@@ -52,28 +89,209 @@ class Transformer(nn.Module):
             dropout=dropout,
             batch_first=True,
         )
-        self.decoder = nn.Linear(ninp, vocab_size)
+        if head == "adaptive":
+            if cutoffs is None and token_counts is None:
+                raise ValueError("The adaptive head needs `cutoffs` or the `token_counts` to derive them from")
+            cutoffs = frequency_cutoffs(token_counts) if cutoffs is None else cutoffs
+            self.decoder = AdaptiveSoftmaxHead(ninp, vocab_size, cutoffs, token_counts)
+        else:
+            self.decoder = nn.Linear(ninp, vocab_size)
+        if attention_dropout is not None:
+            for module in self.transformer.modules():
+                if isinstance(module, MultiheadAttention):
+                    module.dropout = attention_dropout
 
         self.ninp = ninp
+        self.checkpoint_layers = checkpoint_layers
+        self.head = head
+        self.loss_chunk_size = loss_chunk_size
         self.vocab_size = vocab_size
         self.src_mask = None
+        self.causal_masks = TensorCache(_causal_mask)
+
+    def forward(
+        self, inputs: Tensor, target: Tensor, mask: Optional[Tensor] = None, is_causal: Optional[bool] = None
+    ) -> Tensor:
+        """The (B * T, vocab_size) next-token log-probabilities; see ``hidden`` for the arguments."""
+        output = self.hidden(inputs, target, mask, is_causal)
+        if self.head == "adaptive":
+            return self.decoder(output).view(-1, self.vocab_size)
+        output = self.decoder(output)
+        output = F.log_softmax(output, dim=-1)
+        output = output.view(-1, self.vocab_size)
+        return output
 
-    def forward(self, inputs: Tensor, target: Tensor, mask: Optional[Tensor] = None) -> Tensor:
-        _, t = inputs.shape
+    def hidden(
+        self, inputs: Tensor, target: Tensor, mask: Optional[Tensor] = None, is_causal: Optional[bool] = None
+    ) -> Tensor:
+        """The (B, T, ninp) decoder states that the output head maps to tokens.
 
-        # we assume target is already shifted w.r.t. inputs
-        if mask is None:
-            mask = torch.tril(torch.ones(t, t, device=inputs.device)) == 1
-            mask = mask.float().masked_fill(mask == 0, float("-inf")).masked_fill(mask == 1, 0.0)
+        ``is_causal`` declares that ``mask`` is the causal mask, which is implied when no mask is given.
+        """
+        _, t = inputs.shape
 
         src = self.pos_encoder(self.embedding(inputs) * math.sqrt(self.ninp))
         target = self.pos_encoder(self.embedding(target) * math.sqrt(self.ninp))
-        output = self.transformer(src, target, tgt_mask=mask)
-        output = self.decoder(output)
-        output = F.log_softmax(output, dim=-1)
-        output = output.view(-1, self.vocab_size)
+
+        # we assume target is already shifted w.r.t. inputs
+        if mask is None:
+            if torch.compiler.is_compiling():
+                # traced graphs, e.g. for export with a dynamic sequence axis, build the mask from the symbolic length
+                mask = _causal_mask(t, device=src.device, dtype=src.dtype)
+            else:
+                mask = self.causal_masks.get(t, device=src.device, dtype=src.dtype)[:t, :t]
+            is_causal = True
+
+        if self.checkpoint_layers and self.training and torch.is_grad_enabled():
+            output = self._checkpointed_transformer(src, target, mask, bool(is_causal))
+        else:
+            output = self.transformer(src, target, tgt_mask=mask, tgt_is_causal=bool(is_causal))
         return output
 
+    def loss(self, inputs: Tensor, target: Tensor) -> Tensor:
+        """The mean negative log-likelihood of ``target`` under ``forward(inputs, target)``."""
+        hidden = self.hidden(inputs, target)
+        if self.head == "adaptive":
+            return self.decoder.loss(hidden, target)
+        if self.loss_chunk_size is not None:
+            return chunked_cross_entropy(hidden, self.decoder, target, self.loss_chunk_size)
+        return F.cross_entropy(self.decoder(hidden).view(-1, self.vocab_size), target.reshape(-1))
+
+    def scores(self, hidden: Tensor) -> Tensor:
+        """Next-token scores: the logits of the dense head, the log-probabilities of the adaptive head."""
+        return self.decoder(hidden)
+
+    def topk(self, hidden: Tensor, k: int) -> Tuple[Tensor, Tensor]:
+        """The scores and ids of the ``k`` highest scoring next tokens, each of shape (..., k).
+
+        The adaptive head skips the tail clusters that cannot hold any of them (see ``AdaptiveSoftmaxHead.topk``).
+        """
+        if self.head == "adaptive":
+            return self.decoder.topk(hidden, k)
+        return self.decoder(hidden).topk(k, dim=-1)
+
+    def _checkpointed_transformer(self, src: Tensor, target: Tensor, mask: Tensor, is_causal: bool) -> Tensor:
+        """``self.transformer(src, target)`` with every layer run as an activation checkpoint."""
+        encoder, decoder = self.transformer.encoder, self.transformer.decoder
+        memory = src
+        for layer in encoder.layers:
+            memory = checkpoint(layer, memory, use_reentrant=False)
+        if encoder.norm is not None:
+            memory = encoder.norm(memory)
+        output = target
+        for layer in decoder.layers:
+            output = checkpoint(layer, output, memory, tgt_mask=mask, tgt_is_causal=is_causal, use_reentrant=False)
+        return decoder.norm(output) if decoder.norm is not None else output
+
+    def encode(
+        self, inputs: Tensor, padding_mask: Optional[Tensor] = None, positions: Optional[Tensor] = None
+    ) -> Tensor:
+        """Runs the encoder over ``inputs``; ``padding_mask`` is True at padded positions."""
+        src = self.pos_encoder(self.embedding(inputs) * math.sqrt(self.ninp), positions)
+        return self.transformer.encoder(src, src_key_padding_mask=padding_mask)
+
+    def init_cache(self, memory: Tensor, padding_mask: Tensor, max_len: int) -> "DecoderCache":
+        """Allocates the key/value cache for decoding up to ``max_len`` tokens against the encoder ``memory``.
+
+        ``padding_mask`` marks padded prompt positions; they are masked out of both the cross attention over
+        ``memory`` and the decoder self attention over the prompt.
+        """
+        return DecoderCache(self.transformer.decoder.layers, memory, padding_mask, max_len)
+
+    def decode(self, tokens: Tensor, positions: Tensor, cache: "DecoderCache") -> Tensor:
+        """Appends ``tokens`` of shape (B, T) to ``cache`` and returns their next-token ``scores`` of shape (B, T, V).
+
+        Only the new tokens are run through the decoder; attention over earlier tokens and over the encoder memory
+        reads the cached keys and values, so each generated token costs a single incremental step.
+        """
+        return self.scores(self.decode_hidden(tokens, positions, cache))
+
+    def decode_hidden(self, tokens: Tensor, positions: Tensor, cache: "DecoderCache") -> Tensor:
+        """``decode`` without the output head: the (B, T, ninp) decoder states of ``tokens``."""
+        t = tokens.size(1)
+        start, end = cache.length, cache.length + t
+        # query i sees every cached key up to its own position, except padded keys; it always sees itself so that
+        # rows of padded queries stay finite instead of softmaxing over nothing
+        causal = torch.ones(t, end, dtype=torch.bool, device=tokens.device).tril(start)
+        self_mask = causal & ~cache.padding_mask[:, None, None, :end]
+        self_mask[..., torch.arange(t), torch.arange(start, end)] = True
+
+        x = self.pos_encoder(self.embedding(tokens) * math.sqrt(self.ninp), positions)
+        for layer, (keys, values), memory_kv in zip(self.transformer.decoder.layers, cache.self_kv, cache.memory_kv):
+            x = _decoder_layer_step(layer, x, keys, values, start, self_mask, memory_kv, cache.memory_mask)
+        cache.length = end
+
+        if self.transformer.decoder.norm is not None:
+            x = self.transformer.decoder.norm(x)
+        return x
+
+
+class DecoderCache:
+    """Preallocated per-layer decoder self-attention keys/values plus the projected encoder memory."""
+
+    def __init__(self, layers: nn.ModuleList, memory: Tensor, padding_mask: Tensor, max_len: int) -> None:
+        batch_size, prompt_len, _ = memory.shape
+        self.length = 0
+        self.padding_mask = torch.zeros(batch_size, max_len, dtype=torch.bool, device=memory.device)
+        self.padding_mask[:, :prompt_len] = padding_mask
+        self.memory_mask = ~padding_mask[:, None, None, :]
+        self.self_kv: List[Tuple[Tensor, Tensor]] = []
+        self.memory_kv: List[Tuple[Tensor, Tensor]] = []
+        for layer in layers:
+            attn = layer.self_attn
+            shape = (batch_size, attn.num_heads, max_len, attn.embed_dim // attn.num_heads)
+            self.self_kv.append((memory.new_empty(shape), memory.new_empty(shape)))
+            # cross-attention keys and values depend only on the encoder memory, so project them once
+            keys, values = _in_projection(layer.multihead_attn, memory, slice(1, 3))
+            self.memory_kv.append((keys, values))
+
+
+def _in_projection(attn: MultiheadAttention, x: Tensor, parts: slice = slice(0, 3)) -> List[Tensor]:
+    """Projects ``x`` to the (B, heads, T, head_dim) query/key/value selected by ``parts``."""
+    weights = attn.in_proj_weight.chunk(3)[parts]
+    biases = attn.in_proj_bias.chunk(3)[parts] if attn.in_proj_bias is not None else [None] * len(weights)
+    return [F.linear(x, w, b).unflatten(-1, (attn.num_heads, -1)).transpose(1, 2) for w, b in zip(weights, biases)]
+
+
+def _attend(attn: MultiheadAttention, query: Tensor, keys: Tensor, values: Tensor, mask: Tensor) -> Tensor:
+    output = F.scaled_dot_product_attention(query, keys, values, attn_mask=mask)
+    return attn.out_proj(output.transpose(1, 2).flatten(2))
+
+
+def _decoder_layer_step(
+    layer: nn.TransformerDecoderLayer,
+    x: Tensor,
+    keys: Tensor,
+    values: Tensor,
+    start: int,
+    self_mask: Tensor,
+    memory_kv: Tuple[Tensor, Tensor],
+    memory_mask: Tensor,
+) -> Tensor:
+    """Mirrors ``nn.TransformerDecoderLayer.forward`` in inference mode, reading and extending the cache."""
+
+    def self_attention(x: Tensor) -> Tensor:
+        query, key, value = _in_projection(layer.self_attn, x)
+        end = start + x.size(1)
+        keys[:, :, start:end] = key
+        values[:, :, start:end] = value
+        return _attend(layer.self_attn, query, keys[:, :, :end], values[:, :, :end], self_mask)
+
+    def cross_attention(x: Tensor) -> Tensor:
+        (query,) = _in_projection(layer.multihead_attn, x, slice(0, 1))
+        return _attend(layer.multihead_attn, query, *memory_kv, memory_mask)
+
+    def feed_forward(x: Tensor) -> Tensor:
+        return layer.linear2(layer.activation(layer.linear1(x)))
+
+    if layer.norm_first:
+        x = x + self_attention(layer.norm1(x))
+        x = x + cross_attention(layer.norm2(x))
+        return x + feed_forward(layer.norm3(x))
+    x = layer.norm1(x + self_attention(x))
+    x = layer.norm2(x + cross_attention(x))
+    return layer.norm3(x + feed_forward(x))
+
 
 class PositionalEncoding(nn.Module):
     def __init__(self, dim: int, dropout: float = 0.1, max_len: int = 5000) -> None:
@@ -81,37 +299,74 @@ class PositionalEncoding(nn.Module):
         self.dropout = nn.Dropout(p=dropout)
         self.dim = dim
         self.max_len = max_len
-        self.pe: Optional[Tensor] = None
-
-    def forward(self, x: Tensor) -> Tensor:
-        if self.pe is None:
-            # 1) can't use buffer, see https://github.com/pytorch/pytorch/issues/68407
-            # 2) can't use parameter becauses pe gets sliced and DDP requires all params to participate in forward
-            # TODO: Could make this a `nn.Parameter` with `requires_grad=False`
-            self.pe = self._init_pos_encoding(device=x.device)
-
-        x = x + self.pe[: x.size(0), :]
+        # 1) can't use buffer, see https://github.com/pytorch/pytorch/issues/68407
+        # 2) can't use parameter becauses pe gets sliced and DDP requires all params to participate in forward
+        # so the table is cached per device and dtype instead, and follows the inputs rather than `.to()` calls
+        self.pe = TensorCache(self._init_pos_encoding)
+
+    def forward(self, x: Tensor, positions: Optional[Tensor] = None) -> Tensor:
+        pe = self.pe.get(self.max_len, device=x.device, dtype=x.dtype)
+        if positions is not None:
+            # explicit (B, T) position ids, e.g. for left-padded prompts during generation
+            x = x + pe[positions]
+        else:
+            # inputs are batch first, so positions run along dim 1
+            x = x + pe[: x.size(1)]
         return self.dropout(x)
 
-    def _init_pos_encoding(self, device: torch.device) -> Tensor:
-        pe = torch.zeros(self.max_len, self.dim, device=device)
-        position = torch.arange(0, self.max_len, dtype=torch.float, device=device).unsqueeze(1)
+    def _init_pos_encoding(self, length: int, device: torch.device, dtype: torch.dtype) -> Tensor:
+        pe = torch.zeros(length, self.dim, device=device)
+        position = torch.arange(0, length, dtype=torch.float, device=device).unsqueeze(1)
         div_term = torch.exp(torch.arange(0, self.dim, 2, device=device).float() * (-math.log(10000.0) / self.dim))
         pe[:, 0::2] = torch.sin(position * div_term)
         pe[:, 1::2] = torch.cos(position * div_term)
-        pe = pe.unsqueeze(0).transpose(0, 1)
-        return pe
+        return pe.to(dtype)
+
+
+class TensorCache:
+    """Caches a length-indexed tensor per device and dtype.
+
+    ``build(length, device, dtype)`` is called on the first request for a device/dtype pair and again only when a
+    longer tensor is needed; shorter requests share the cached tensor and are sliced by the caller. The cache is a
+    plain attribute rather than a buffer, so it is neither broadcast by DDP nor saved in the state dict.
+    """
+
+    def __init__(self, build: Callable[[int, torch.device, torch.dtype], Tensor]) -> None:
+        self.build = build
+        self.tensors: Dict[Tuple[torch.device, torch.dtype], Tensor] = {}
+
+    def get(self, length: int, device: torch.device, dtype: torch.dtype) -> Tensor:
+        tensor = self.tensors.get((device, dtype))
+        if tensor is None or tensor.size(0) < length:
+            if torch.compiler.is_compiling():
+                # storing a tensor built while tracing would leak a fake tensor out of the trace
+                return self.build(length, device, dtype)
+            # grow geometrically so that slowly increasing lengths don't rebuild on every call
+            length = max(length, 2 * tensor.size(0)) if tensor is not None else length
+            tensor = self.tensors[(device, dtype)] = self.build(length, device, dtype)
+        return tensor
+
+
+def _causal_mask(length: int, device: torch.device, dtype: torch.dtype) -> Tensor:
+    return torch.full((length, length), float("-inf"), device=device, dtype=dtype).triu(diagonal=1)
 
 
 class WikiText2(Dataset):
     """Mini version of WikiText2."""
 
-    def __init__(self, data_dir: Path = Path("./data"), block_size: int = 35, download: bool = True) -> None:
+    def __init__(
+        self,
+        data_dir: Path = Path("./data"),
+        block_size: int = 35,
+        download: bool = True,
+        cache_dir: Optional[Path] = None,
+    ) -> None:
         super().__init__()
         self.path = data_dir / "wikitext-2.txt"
         if download:
             self.download(self.path)
-        self.data, self.dictionary = tokenize(self.path)
+        self.cache_dir = cache_dir if cache_dir is not None else data_dir / "cache"
+        self.data, self.dictionary = load_tokens(self.path, self.cache_dir)
         self.block_size = block_size
 
     @property
@@ -147,6 +402,8 @@ class Dictionary:
     def __init__(self) -> None:
         self.word2idx: Dict[str, int] = {}
         self.idx2word: List[str] = []
+        # occurrences of every word id in the tokenized corpus, filled in by `tokenize`
+        self.counts: List[int] = []
 
     def add_word(self, word: str) -> int:
         if word not in self.word2idx:
@@ -158,50 +415,288 @@ class Dictionary:
         return len(self.idx2word)
 
 
-def tokenize(path: Path) -> Tuple[Tensor, Dictionary]:
-    dictionary = Dictionary()
+def tokenize(
+    path: Path, num_workers: Optional[int] = None, chunk_size: int = 64 * 1024 * 1024
+) -> Tuple[Tensor, Dictionary]:
+    """Tokenizes ``path`` in a single pass over line-aligned chunks of about ``chunk_size`` bytes.
 
+    Chunks are tokenized against local vocabularies in a process pool and merged in file order, so word ids are
+    assigned by first occurrence exactly as a sequential scan would assign them.
+    """
     assert os.path.exists(path)
-    # Add words to the dictionary
-    with open(path, encoding="utf8") as f:
-        for line in f:
-            words = line.split() + ["<eos>"]
-            for word in words:
-                dictionary.add_word(word)
-
-    # Tokenize file content
-    with open(path, encoding="utf8") as f:
-        idss: List[Tensor] = []
-        for line in f:
-            words = line.split() + ["<eos>"]
-            ids: List[int] = []
-            for word in words:
-                ids.append(dictionary.word2idx[word])
-            idss.append(torch.tensor(ids).type(torch.int64))
-
-    return torch.cat(idss), dictionary
+    start_time = time.perf_counter()
+    chunks = _chunk_boundaries(path, chunk_size)
+    num_workers = min(num_workers or os.cpu_count() or 1, len(chunks))
+
+    if num_workers > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            results = list(executor.map(_tokenize_chunk, repeat(path), *zip(*chunks)))
+    else:
+        results = [_tokenize_chunk(path, start, end) for start, end in chunks]
+
+    dictionary = Dictionary()
+    offsets = np.cumsum([0] + [len(ids) for _, ids in results])
+    data = np.empty(offsets[-1], dtype=np.int64)
+    for (vocab, ids), offset in zip(results, offsets):
+        local_to_global = np.fromiter((dictionary.add_word(word) for word in vocab), dtype=np.int64, count=len(vocab))
+        data[offset : offset + len(ids)] = local_to_global[ids]
+    dictionary.counts = np.bincount(data, minlength=len(dictionary)).tolist()
+
+    elapsed = time.perf_counter() - start_time
+    log.info(f"Tokenized {len(data):,} tokens from {path} in {elapsed:.2f}s ({len(data) / elapsed:,.0f} tokens/sec)")
+    return torch.from_numpy(data), dictionary
+
+
+def _chunk_boundaries(path: Path, chunk_size: int) -> List[Tuple[int, int]]:
+    size = os.path.getsize(path)
+    boundaries = [0]
+    with open(path, "rb") as f:
+        while boundaries[-1] < size:
+            f.seek(min(boundaries[-1] + chunk_size, size))
+            # move to the start of the next line so no line, and no multi-byte character, straddles two chunks
+            f.readline()
+            boundaries.append(f.tell())
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def _tokenize_chunk(path: Path, start: int, end: int) -> Tuple[List[str], np.ndarray]:
+    with open(path, "rb") as f:
+        f.seek(start)
+        text = f.read(end - start).decode("utf8")
+
+    # mirror text-mode iteration: universal newlines, and no empty trailing line after a final newline
+    lines = text.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    if lines[-1] == "":
+        lines.pop()
+
+    word2idx: Dict[str, int] = {}
+    ids: List[int] = []
+    for line in lines:
+        for word in line.split() + ["<eos>"]:
+            ids.append(word2idx.setdefault(word, len(word2idx)))
+    return list(word2idx), np.array(ids, dtype=np.int32)
+
+
+def load_tokens(path: Path, cache_dir: Path) -> Tuple[Tensor, Dictionary]:
+    """Returns the token ids and vocabulary of ``path``, tokenizing it only on a cache miss.
+
+    The ids are stored as a raw int64 file, the vocabulary as one word per line and the word counts as a raw int64
+    file, all keyed by a hash of the source text. On a cache hit the ids are memory-mapped copy-on-write, so every
+    process that opens the same corpus shares the page cache instead of holding its own copy.
+
+    The hash is memoised next to the cache against the file's size, modification and change times and inode, so it is
+    only recomputed when one of them changes. Copies that preserve the modification time, like ``cp -p``, still get
+    a new change time and inode, so the memo cannot vouch for content it has not hashed.
+    """
+    key = _fingerprint(path, cache_dir)
+    ids_path = Path(cache_dir) / f"{Path(path).stem}-{key}.ids"
+    vocab_path = Path(cache_dir) / f"{Path(path).stem}-{key}.vocab"
+    counts_path = Path(cache_dir) / f"{Path(path).stem}-{key}.counts"
+
+    if not (ids_path.exists() and vocab_path.exists()):
+        data, dictionary = tokenize(path)
+        os.makedirs(cache_dir, exist_ok=True)
+        atomic_write(ids_path, data.numpy().tofile, fsync=False)
+        atomic_write(vocab_path, lambda f: f.write("\n".join(dictionary.idx2word).encode("utf8")), fsync=False)
+        atomic_write(counts_path, np.asarray(dictionary.counts, dtype=np.int64).tofile, fsync=False)
+
+    dictionary = Dictionary()
+    with open(vocab_path, encoding="utf8") as f:
+        words = f.read()
+    dictionary.idx2word = words.split("\n") if words else []
+    dictionary.word2idx = {word: idx for idx, word in enumerate(dictionary.idx2word)}
+
+    if os.path.getsize(ids_path):
+        # mode="c" maps the file copy-on-write: pages are shared until written to, and the array stays writable
+        data = torch.from_numpy(np.memmap(ids_path, dtype=np.int64, mode="c"))
+    else:
+        # an empty file cannot be memory-mapped
+        data = torch.empty(0, dtype=torch.int64)
+    if not counts_path.exists():
+        # caches written before counts were kept
+        counts = np.bincount(data.numpy(), minlength=len(dictionary)).astype(np.int64)
+        atomic_write(counts_path, counts.tofile, fsync=False)
+    dictionary.counts = np.fromfile(counts_path, dtype=np.int64).tolist()
+    return data, dictionary
+
+
+def _fingerprint(path: Path, cache_dir: Path, chunk_size: int = 1 << 20) -> str:
+    stat = os.stat(path)
+    signature = [os.path.abspath(path), stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns, stat.st_ino]
+    memo_path = Path(cache_dir) / f"{Path(path).stem}.digest"
+    try:
+        with open(memo_path) as f:
+            memo = json.load(f)
+        if memo["signature"] == signature:
+            return memo["digest"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    key = digest.hexdigest()[:16]
+    os.makedirs(cache_dir, exist_ok=True)
+    memo = json.dumps({"signature": signature, "digest": key}).encode()
+    atomic_write(memo_path, lambda f: f.write(memo), fsync=False)
+    return key
 
 
 class LightningTransformer(LightningModule):
-    def __init__(self, vocab_size: int = 33278) -> None:
+    """Trains ``Transformer`` on WikiText2 blocks of ``block_size`` tokens.
+
+    For long blocks, ``checkpoint_layers`` and ``attention_dropout=0.0`` reduce the memory of a training step (see
+    ``Transformer``), and ``tokens_per_update`` accumulates gradients over enough batches that every optimizer step
+    sees about that many tokens, however short the blocks or small the batches that fit in memory. For large
+    vocabularies, ``head="adaptive"`` replaces the dense output layer with an adaptive softmax clustered by
+    ``token_counts``, and ``loss_chunk_size`` computes the dense head's loss without the full logits.
+
+    Args:
+        vocab_size: the size of the vocabulary.
+        block_size: tokens per training sample.
+        batch_size: samples per batch of ``train_dataloader``.
+        optimizer: "sgd" or "adamw".
+        lr: the learning rate.
+        weight_decay: decoupled weight decay for "adamw", L2 penalty for "sgd".
+        tokens_per_update: accumulate gradients to this many tokens per optimizer step (see ``TokensPerUpdate``).
+        checkpoint_layers: recompute every layer's activations in the backward pass instead of storing them.
+        attention_dropout: dropout on attention weights; defaults to the model's dropout.
+        head: the output head, "dense" or "adaptive" (see ``Transformer``).
+        cutoffs: the adaptive head's cluster boundaries over frequency ranks; derived from ``token_counts`` and saved
+            with the hyperparameters when not given.
+        token_counts: the corpus count of every token id, e.g. ``WikiText2().dictionary.counts``, which orders the
+            adaptive head's clusters; the order is saved in the model's state, so it is not needed to load one.
+        loss_chunk_size: compute the dense head's loss this many positions at a time.
+    """
+
+    def __init__(
+        self,
+        vocab_size: int = 33278,
+        block_size: int = 35,
+        batch_size: int = 1,
+        optimizer: str = "sgd",
+        lr: float = 0.1,
+        weight_decay: float = 0.0,
+        tokens_per_update: Optional[int] = None,
+        checkpoint_layers: bool = False,
+        attention_dropout: Optional[float] = None,
+        head: str = "dense",
+        cutoffs: Optional[Sequence[int]] = None,
+        token_counts: Optional[Sequence[int]] = None,
+        loss_chunk_size: Optional[int] = None,
+    ) -> None:
         super().__init__()
-        self.model = Transformer(vocab_size=vocab_size)
+        if optimizer not in ("sgd", "adamw"):
+            raise ValueError(f"Unknown optimizer {optimizer!r}, expected 'sgd' or 'adamw'")
+        if head == "adaptive" and cutoffs is None and token_counts is not None:
+            cutoffs = frequency_cutoffs(token_counts)
+        self.save_hyperparameters(ignore=["token_counts"])
+        self.hparams.cutoffs = cutoffs
+        self.model = Transformer(
+            vocab_size=vocab_size,
+            attention_dropout=attention_dropout,
+            checkpoint_layers=checkpoint_layers,
+            head=head,
+            cutoffs=cutoffs,
+            token_counts=token_counts,
+            loss_chunk_size=loss_chunk_size,
+        )
 
     def forward(self, inputs: Tensor, target: Tensor) -> Tensor:
         return self.model(inputs, target)
 
+    @torch.no_grad()
+    def generate(
+        self,
+        prompts: Union[Tensor, Sequence[Tensor]],
+        max_new_tokens: int,
+        strategy: str = "greedy",
+        top_k: int = 50,
+        top_p: float = 0.9,
+        temperature: float = 1.0,
+        generator: Optional[torch.Generator] = None,
+    ) -> Tensor:
+        """Generates ``max_new_tokens`` tokens for each prompt and returns them as a (B, max_new_tokens) tensor.
+
+        ``prompts`` is either a (B, T) tensor or a sequence of 1-D tensors of different lengths, which are left-padded
+        and masked. The encoder runs once over the prompts and every new token is a single cached decoder step.
+        ``strategy`` is one of "greedy", "top_k" or "top_p". Call ``eval()`` first to disable dropout.
+        """
+        if strategy not in ("greedy", "top_k", "top_p"):
+            raise ValueError(f"Unknown sampling strategy {strategy!r}, expected 'greedy', 'top_k' or 'top_p'")
+        if isinstance(prompts, Tensor):
+            prompts = list(prompts)
+        lengths = torch.tensor([len(prompt) for prompt in prompts], device=self.device)
+        prompt_len = int(lengths.max())
+        inputs = torch.zeros(len(prompts), prompt_len, dtype=torch.long, device=self.device)
+        for row, prompt in enumerate(prompts):
+            inputs[row, prompt_len - len(prompt) :] = prompt
+        offsets = torch.arange(prompt_len, device=self.device) - (prompt_len - lengths)[:, None]
+        padding_mask = offsets < 0
+        positions = offsets.clamp(min=0)
+
+        memory = self.model.encode(inputs, padding_mask, positions)
+        cache = self.model.init_cache(memory, padding_mask, prompt_len + max_new_tokens)
+        hidden = self.model.decode_hidden(inputs, positions, cache)[:, -1]
+        tokens = []
+        for step in range(max_new_tokens):
+            tokens.append(self._next_token(hidden, strategy, top_k, top_p, temperature, generator))
+            if step < max_new_tokens - 1:
+                positions = positions[:, -1:] + 1
+                hidden = self.model.decode_hidden(tokens[-1][:, None], positions, cache)[:, -1]
+        return torch.stack(tokens, dim=1)
+
+    def _next_token(
+        self,
+        hidden: Tensor,
+        strategy: str,
+        top_k: int,
+        top_p: float,
+        temperature: float,
+        generator: Optional[torch.Generator] = None,
+    ) -> Tensor:
+        if strategy == "top_p":
+            return _sample_top_p(self.model.scores(hidden), top_p, temperature, generator)
+        # greedy and top-k sampling only need the k best tokens, which the adaptive head finds without scoring them all
+        scores, ids = self.model.topk(hidden, 1 if strategy == "greedy" else min(top_k, self.model.vocab_size))
+        if strategy == "greedy":
+            return ids[:, 0]
+        choice = torch.multinomial((scores / temperature).softmax(dim=-1), num_samples=1, generator=generator)
+        return ids.gather(1, choice).squeeze(-1)
+
     def training_step(self, batch: Tuple[Tensor, Tensor], batch_idx: int) -> Tensor:
         inputs, target = batch
-        output = self(inputs, target)
-        loss = torch.nn.functional.nll_loss(output, target.view(-1))
-        return loss
+        return self.model.loss(inputs, target)
 
     def configure_optimizers(self) -> torch.optim.Optimizer:
-        return torch.optim.SGD(self.model.parameters(), lr=0.1)
+        hparams = self.hparams
+        if hparams.optimizer == "adamw":
+            return torch.optim.AdamW(self.model.parameters(), lr=hparams.lr, weight_decay=hparams.weight_decay)
+        return torch.optim.SGD(self.model.parameters(), lr=hparams.lr, weight_decay=hparams.weight_decay)
+
+    def configure_callbacks(self) -> List[Callback]:
+        if self.hparams.tokens_per_update is None:
+            return []
+        from lab.components.callbacks.accumulation import TokensPerUpdate
+
+        return [TokensPerUpdate(self.hparams.tokens_per_update)]
 
     def prepare_data(self) -> None:
         WikiText2(download=True)
 
     def train_dataloader(self) -> DataLoader:
-        dataset = WikiText2()
-        return DataLoader(dataset)
\ No newline at end of file
+        dataset = WikiText2(block_size=self.hparams.block_size)
+        return DataLoader(dataset, batch_size=self.hparams.batch_size)
+
+
+def _sample_top_p(
+    logits: Tensor, top_p: float, temperature: float, generator: Optional[torch.Generator] = None
+) -> Tensor:
+    logits = logits / temperature
+    sorted_logits, sorted_idx = logits.sort(dim=-1, descending=True)
+    # drop a token once the tokens ranked above it already cover top_p; the most likely token always stays
+    mass_above = sorted_logits.softmax(dim=-1).cumsum(dim=-1) - sorted_logits.softmax(dim=-1)
+    sorted_logits = sorted_logits.masked_fill(mass_above > top_p, float("-inf"))
+    logits = torch.full_like(logits, float("-inf")).scatter(-1, sorted_idx, sorted_logits)
+    return torch.multinomial(logits.softmax(dim=-1), num_samples=1, generator=generator).squeeze(-1)
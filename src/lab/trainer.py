@@ -12,41 +12,202 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
+import json
+import os
+from itertools import islice
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
+import numpy as np
 import pytorch_lightning as pl
-import torch
 from pytorch_lightning import seed_everything
 from pytorch_lightning.callbacks import ModelCheckpoint
 from pytorch_lightning.loggers import Logger, TensorBoardLogger
-from pytorch_lightning.profilers import Profiler, PyTorchProfiler
+from pytorch_lightning.plugins import CheckpointIO
+from pytorch_lightning.profilers import Profiler
+from pytorch_lightning.strategies import DDPStrategy
+from torch.utils.data import Subset
 
 from lab import config
+from lab.components.callbacks.affinity import CPUAffinity
+from lab.components.callbacks.checkpoint import AsyncCheckpointIO, FrozenParameters, load_module
+from lab.components.callbacks.compile import CompileModules
+from lab.components.callbacks.instrumentation import StepInstrumentation, window_profiler
+from lab.components.callbacks.predictions import ShardedPredictionWriter
+from lab.components.data.cache import cache_key
+from lab.components.data.splits import dataset_fingerprint
+from lab.components.execution import modes
 
 
 class LabTrainer(pl.Trainer):
     def __init__(
         self,
-        logger: Optional[Logger] = None,
+        logger: Optional[Union[Logger, bool]] = None,
         profiler: Optional[Profiler] = None,
         callbacks: Optional[List] = [],
         plugins: Optional[List] = [],
         set_seed: bool = True,
-        **trainer_init_kwargs: Dict[str, Any]
+        checkpoints_dir: Union[str, Path] = config.CHKPTSPATH,
+        instrument: bool = True,
+        profile_steps: Optional[Tuple[int, int]] = None,
+        save_top_k: int = 1,
+        monitor: Optional[str] = None,
+        async_checkpointing: bool = False,
+        incremental_checkpoints: bool = False,
+        cpu_processes: Optional[int] = None,
+        execution_mode: str = "eager",
+        compile_backend: str = "inductor",
+        **trainer_init_kwargs: Dict[str, Any],
     ) -> None:
+        """A ``pl.Trainer`` with the lab's logging, checkpointing and instrumentation defaults.
+
+        Args:
+            instrument: time the dataloader wait, forward, backward and optimizer phases of every training step, and
+                log them with throughput and memory (see ``StepInstrumentation``).
+            profile_steps: run the PyTorch profiler over this (start, end) window of training steps, e.g. (100, 120),
+                when no ``profiler`` is passed.
+            save_top_k: keep the ``save_top_k`` best checkpoints by ``monitor``, or the latest one without a monitor,
+                as ``model-epoch=<e>-step=<s>.ckpt`` in ``checkpoints_dir``.
+            monitor: the logged metric that ranks checkpoints, lower is better.
+            async_checkpointing: write checkpoints on a background thread, so training only waits for a copy of the
+                state in host memory (see ``AsyncCheckpointIO``); ignored when ``plugins`` has a checkpoint IO. A
+                checkpoint may then not be on disk yet when ``save_checkpoint`` returns: call
+                ``trainer.strategy.checkpoint_io.wait()`` before reading it.
+            incremental_checkpoints: with ``async_checkpointing``, write frozen parameters once instead of in every
+                checkpoint; load such checkpoints with ``lab.components.callbacks.checkpoint.load_module``.
+            cpu_processes: train on CPUs with this many gloo-backed DDP processes on this node, each pinned with its
+                dataloader workers to its own cores (see ``CPUAffinity``); pass ``strategy`` to change how they are
+                launched, e.g. ``DDPStrategy(process_group_backend="gloo", start_method="spawn")``.
+            execution_mode: "eager", "bf16" for bf16 autocast (``precision="bf16-mixed"``), "compile" to compile the
+                model's networks with ``torch.compile`` (see ``CompileModules``), or "compile-bf16" for both.
+                Compiled graphs are cached under ``data/cache/inductor`` and reused by later runs.
+            compile_backend: the ``torch.compile`` backend of the compile modes, e.g. "inductor" or "aot_eager".
+        """
         # SET SEED
         if set_seed:
             seed_everything(config.GLOBALSEED, workers=True)
+        if cpu_processes is not None:
+            trainer_init_kwargs.setdefault("accelerator", "cpu")
+            trainer_init_kwargs.setdefault("devices", cpu_processes)
+            if cpu_processes > 1:
+                trainer_init_kwargs.setdefault("strategy", DDPStrategy(process_group_backend="gloo"))
+            callbacks = callbacks + [CPUAffinity()]
+        if modes.uses_bf16(execution_mode):
+            trainer_init_kwargs.setdefault("precision", modes.trainer_precision(execution_mode))
+        if modes.uses_compile(execution_mode):
+            callbacks = callbacks + [CompileModules(compile_backend)]
+        if incremental_checkpoints and not async_checkpointing:
+            raise ValueError("`incremental_checkpoints` needs `async_checkpointing=True`")
+        checkpoint = ModelCheckpoint(
+            dirpath=checkpoints_dir, filename="model-{epoch}-{step}", monitor=monitor, save_top_k=save_top_k
+        )
+        if async_checkpointing and not any(isinstance(plugin, CheckpointIO) for plugin in plugins or []):
+            plugins = (plugins or []) + [AsyncCheckpointIO(incremental=incremental_checkpoints)]
+            if incremental_checkpoints:
+                callbacks = callbacks + [FrozenParameters()]
         super().__init__(
-            logger=logger or TensorBoardLogger(config.LOGSPATH, name="tensorboard"),
-            profiler=profiler or PyTorchProfiler(dirpath=config.TORCHPROFILERPATH, filename="profiler"),
-            callbacks=callbacks + [ModelCheckpoint(dirpath=config.CHKPTSPATH, filename="model")],
+            logger=logger if logger is not None else TensorBoardLogger(config.LOGSPATH, name="tensorboard"),
+            profiler=profiler or (window_profiler(*profile_steps) if profile_steps is not None else None),
+            callbacks=callbacks + ([StepInstrumentation()] if instrument else []) + [checkpoint],
             plugins=plugins,
-            **trainer_init_kwargs
+            **trainer_init_kwargs,
         )
 
-    def persist_predictions(self, predictions_dir: Optional[Union[str, Path]] = config.PREDSPATH) -> None:
+    def persist_predictions(self, predictions_dir: Optional[Union[str, Path]] = None) -> str:
+        """Tests the best checkpoint, then streams predictions on the validation set to sharded ``.npy`` files.
+
+        Predictions are written batch by batch with a ``ShardedPredictionWriter``, so memory does not grow with the
+        dataset, and are read back lazily with ``PredictionReader(predictions_dir)``. By default every trial writes to
+        its own directory, ``data/predictions/<key>``, where the key addresses the data and the model hyperparameters
+        (see ``predictions_key``). Returns the directory.
+        """
         self.test(ckpt_path="best", datamodule=self.datamodule)
-        predictions = self.predict(self.model, self.datamodule.val_dataloader())
-        torch.save(predictions, predictions_dir)
+        if predictions_dir is None:
+            predictions_dir = os.path.join(config.PREDICTIONSPATH, self.predictions_key())
+        writer = ShardedPredictionWriter(predictions_dir)
+        self.callbacks.append(writer)
+        try:
+            self.predict(self.model, self.datamodule.val_dataloader(), return_predictions=False)
+        finally:
+            self.callbacks.remove(writer)
+        return str(predictions_dir)
+
+    def export_production_model(
+        self,
+        input_sample: Optional[Any] = None,
+        path: str = config.MODELPATH,
+        dynamic_axes: Optional[Dict[str, Dict[int, str]]] = None,
+        check: bool = True,
+    ) -> str:
+        """Exports the best checkpoint to ONNX at ``path``, the production model, and returns the path.
+
+        ``input_sample`` defaults to the model's ``example_input_array``. Axis 0 of every input is a dynamic batch axis
+        unless ``dynamic_axes`` says otherwise, e.g. ``{"input0": {0: "batch", 1: "sequence"}}`` for token inputs (see
+        ``lab.components.inference.export.export_onnx``). With ``check``, the exported model is run once and compared
+        against the checkpoint in PyTorch.
+        """
+        from lab.components.inference.export import check_parity, export_onnx
+        from lab.components.inference.runtime import load_session
+
+        model = self._best_model()
+        input_sample = model.example_input_array if input_sample is None else input_sample
+        if input_sample is None:
+            raise ValueError("Pass an `input_sample` or set `example_input_array` on the model to export it")
+        inputs = tuple(input_sample) if isinstance(input_sample, (tuple, list)) else (input_sample,)
+        export_onnx(model.eval(), inputs, path, dynamic_axes=dynamic_axes)
+        if check:
+            check_parity(model, load_session(path), inputs)
+        return path
+
+    def quantize_production_model(
+        self,
+        mode: str = "dynamic",
+        path: Optional[str] = None,
+        submodules: Optional[List[str]] = None,
+        forward_fn: Optional[Callable[[Any, Any], Any]] = None,
+        num_batches: int = 32,
+    ) -> str:
+        """Quantizes the best checkpoint to int8 and saves it next to the production model; returns the path.
+
+        ``mode`` is "dynamic", which quantizes weights only, or "static", which also calibrates activation ranges on
+        ``num_batches`` batches of the datamodule's validation set (see ``lab.components.inference.quantize``). An
+        fp32 against int8 report of accuracy, latency and weight size on the same batches is written beside it, with a
+        ``.json`` suffix. ``forward_fn(model, batch)`` runs a batch, calling the model on it by default.
+        """
+        from lab.components.inference import quantize
+
+        if mode not in ("dynamic", "static"):
+            raise ValueError(f"Unknown quantization mode {mode!r}, expected 'dynamic' or 'static'")
+        forward_fn = forward_fn or quantize.default_forward
+        model = self._best_model().eval()
+        batches = list(islice(self.datamodule.val_dataloader(), num_batches))
+        if mode == "dynamic":
+            quantized = quantize.quantize(model)
+        else:
+            quantized = quantize.quantize_static(model, batches, submodules, forward_fn, num_batches)
+        path = quantize.save_quantized(quantized, path, mode)
+        report = quantize.quantization_report(model, quantized, batches[:8], forward_fn)
+        with open(f"{os.path.splitext(path)[0]}.json", "w") as f:
+            json.dump(report, f, indent=2)
+        return path
+
+    def _best_model(self) -> pl.LightningModule:
+        best = self.checkpoint_callback.best_model_path if self.checkpoint_callback is not None else ""
+        if not best:
+            return self.lightning_module
+        if isinstance(self.strategy.checkpoint_io, AsyncCheckpointIO):
+            self.strategy.checkpoint_io.wait()
+        return load_module(type(self.lightning_module), best)
+
+    def predictions_key(self) -> str:
+        """The content address of this run's predictions: the validation data and the model hyperparameters."""
+        val_data = getattr(self.datamodule, "val_data", None)
+        if isinstance(val_data, Subset):
+            indices = hashlib.sha256(np.asarray(val_data.indices, dtype=np.int64).tobytes()).hexdigest()
+            data = [dataset_fingerprint(val_data.dataset), indices]
+        else:
+            data = dataset_fingerprint(val_data) if val_data is not None else None
+        # under DDP `self.model` is the DistributedDataParallel wrapper, which has neither the name nor the hparams
+        module = self.lightning_module
+        return cache_key(data, type(module).__qualname__, dict(module.hparams))
@@ -0,0 +1,80 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+from functools import partial
+from types import SimpleNamespace
+
+import pytest
+import torch
+from pytorch_lightning.strategies import DDPStrategy
+from torch.utils.data import DataLoader, Dataset
+
+from lab.components.callbacks.affinity import CPUAffinity, available_cpus, core_sets, pin_worker
+from lab.datamodule import LabDataModule
+from lab.trainer import LabTrainer
+
+needs_affinity = pytest.mark.skipif(not hasattr(os, "sched_setaffinity"), reason="CPU affinity is Linux only")
+
+
+class AffinityDataset(Dataset):
+    def __len__(self):
+        return 4
+
+    def __getitem__(self, index):
+        return torch.tensor(sorted(os.sched_getaffinity(0)))
+
+
+def test_core_sets_are_disjoint():
+    sets = core_sets(3, workers_per_rank=2, cpus=range(16))
+    assert sets == [([0, 1, 2, 3], [4, 5]), ([6, 7, 8], [9, 10]), ([11, 12, 13], [14, 15])]
+    # workers never take more than half of a rank's cores, and ranks share CPUs only when there are too few
+    assert core_sets(2, workers_per_rank=8, cpus=range(4)) == [([0], [1]), ([2], [3])]
+    assert core_sets(3, cpus=[0, 1]) == [([0], []), ([1], []), ([0], [])]
+
+
+def test_workers_are_divided_between_ranks():
+    datamodule = LabDataModule(num_workers=8)
+    assert datamodule.workers_per_rank() == 8
+    datamodule.trainer = SimpleNamespace(num_devices=3)
+    assert datamodule.workers_per_rank() == 2
+
+
+@needs_affinity
+def test_workers_are_pinned():
+    cpu = available_cpus()[-1]
+    loader = DataLoader(AffinityDataset(), num_workers=2, worker_init_fn=partial(pin_worker, cpus=[cpu]))
+    assert all(batch.tolist() == [[cpu]] for batch in loader)
+
+
+@needs_affinity
+def test_cpu_affinity_pins_the_rank():
+    cpus, threads = available_cpus(), torch.get_num_threads()
+    datamodule = LabDataModule(num_workers=2)
+    trainer = SimpleNamespace(num_devices=1, local_rank=0, datamodule=datamodule)
+    try:
+        CPUAffinity(cpus=cpus[:1]).setup(trainer, None, "fit")
+        assert sorted(os.sched_getaffinity(0)) == cpus[:1]
+        assert torch.get_num_threads() == 1
+    finally:
+        os.sched_setaffinity(0, cpus)
+        torch.set_num_threads(threads)
+
+
+def test_cpu_ddp_preset(tmp_path):
+    trainer = LabTrainer(cpu_processes=2, logger=False, checkpoints_dir=tmp_path)
+    assert isinstance(trainer.strategy, DDPStrategy)
+    assert trainer.strategy._process_group_backend == "gloo"
+    assert trainer.num_devices == 2 and trainer.accelerator.__class__.__name__ == "CPUAccelerator"
+    assert any(isinstance(callback, CPUAffinity) for callback in trainer.callbacks)
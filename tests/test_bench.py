@@ -0,0 +1,39 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from lab.components.bench.results import compare, load_results, save_results
+from lab.components.bench.suite import BENCHMARKS, run_suite
+
+
+def test_suite_saves_results_with_metadata(tmp_path):
+    results = run_suite(["statespace_forward", "diffusion_sampling"], quick=True, repeats=1)
+    path = save_results(results, str(tmp_path / "bench.json"))
+    loaded = load_results(path)
+    assert loaded["metadata"]["torch"] and loaded["metadata"]["cpu_count"]
+    assert set(loaded["results"]) == {"statespace_forward", "diffusion_sampling"}
+    stats = loaded["results"]["diffusion_sampling"]["num_samples=16,steps=10"]
+    assert 0 < stats["min_seconds"] <= stats["seconds"] and stats["samples_per_sec"] > 0
+
+
+def test_every_benchmark_has_quick_cases():
+    assert {"tokenize", "wikitext2_getitem", "datamodule_loader", "transformer_training_step"} <= set(BENCHMARKS)
+    assert all(quick for _, _, quick in BENCHMARKS.values())
+
+
+def test_compare_flags_regressions():
+    baseline = {"results": {"a": {"n=1": {"seconds": 1.0, "min_seconds": 1.0}, "n=2": {"seconds": 1.0}}}}
+    current = {"results": {"a": {"n=1": {"seconds": 1.5, "min_seconds": 1.05}, "n=3": {"seconds": 9.0}}}}
+    (row,) = compare(current, baseline, threshold=0.1)
+    assert row["case"] == "n=1" and not row["regression"]
+    assert compare(current, baseline, threshold=0.1, metric="seconds")[0]["regression"]
@@ -0,0 +1,111 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+import pytest
+import torch
+from pytorch_lightning import LightningModule
+from pytorch_lightning.loggers import CSVLogger
+from torch.utils.data import DataLoader, TensorDataset
+
+from lab.components.callbacks.checkpoint import AsyncCheckpointIO, load_module
+from lab.trainer import LabTrainer
+
+
+class Regressor(LightningModule):
+    def __init__(self, val_losses=(3.0, 1.0, 2.0, 0.5), freeze_embedding=False):
+        super().__init__()
+        self.save_hyperparameters()
+        self.embedding = torch.nn.Embedding(10, 4).requires_grad_(not freeze_embedding)
+        self.head = torch.nn.Linear(4, 1)
+
+    def training_step(self, batch, batch_idx):
+        inputs, target = batch
+        return (self.head(self.embedding(inputs)).squeeze(-1) - target).pow(2).mean()
+
+    def validation_step(self, batch, batch_idx):
+        self.log("val_loss", self.hparams.val_losses[self.current_epoch])
+
+    def configure_optimizers(self):
+        return torch.optim.SGD(self.parameters(), lr=0.1)
+
+
+def fit(tmp_path, model, **kwargs):
+    data = DataLoader(TensorDataset(torch.randint(0, 10, (32,)), torch.randn(32)), batch_size=8)
+    trainer = LabTrainer(
+        logger=CSVLogger(tmp_path / "logs"),
+        checkpoints_dir=tmp_path / "checkpoints",
+        max_epochs=4,
+        enable_progress_bar=False,
+        enable_model_summary=False,
+        **kwargs,
+    )
+    trainer.fit(model, data, data)
+    return trainer, sorted(os.listdir(tmp_path / "checkpoints"))
+
+
+def test_keeps_the_latest_checkpoint(tmp_path):
+    trainer, files = fit(tmp_path, Regressor())
+    assert not isinstance(trainer.strategy.checkpoint_io, AsyncCheckpointIO)
+    assert files == ["model-epoch=3-step=16.ckpt"]
+
+
+def test_checkpoints_asynchronously_when_asked(tmp_path):
+    trainer, files = fit(tmp_path, Regressor(), async_checkpointing=True)
+    assert isinstance(trainer.strategy.checkpoint_io, AsyncCheckpointIO)
+    assert files == ["model-epoch=3-step=16.ckpt"]
+
+
+def test_rotates_the_top_k_checkpoints(tmp_path):
+    trainer, files = fit(tmp_path, Regressor(), monitor="val_loss", save_top_k=2)
+    assert files == ["model-epoch=1-step=8.ckpt", "model-epoch=3-step=16.ckpt"]
+    best = load_module(Regressor, trainer.checkpoint_callback.best_model_path)
+    assert torch.equal(best.head.weight, trainer.lightning_module.head.weight)
+
+
+def test_saves_a_snapshot_of_the_state(tmp_path):
+    io = AsyncCheckpointIO()
+    weights = torch.ones(1000)
+    io.save_checkpoint({"state_dict": {"w": weights}}, tmp_path / "a.ckpt")
+    weights.zero_()
+    assert torch.equal(io.load_checkpoint(tmp_path / "a.ckpt")["state_dict"]["w"], torch.ones(1000))
+    io.remove_checkpoint(tmp_path / "a.ckpt")
+    io.teardown()
+    assert os.listdir(tmp_path) == []
+
+
+def test_surfaces_write_errors(tmp_path):
+    (tmp_path / "file").write_text("")
+    io = AsyncCheckpointIO()
+    io.save_checkpoint({"state_dict": {}}, tmp_path / "file" / "a.ckpt")
+    with pytest.raises(OSError):
+        io.wait()
+
+
+def test_incremental_checkpoints_skip_frozen_parameters(tmp_path):
+    model = Regressor(freeze_embedding=True)
+    trainer, files = fit(tmp_path, model, save_top_k=-1, async_checkpointing=True, incremental_checkpoints=True)
+    checkpoints = [name for name in files if name.endswith(".ckpt")]
+    assert len(checkpoints) == 4
+    directory = tmp_path / "checkpoints"
+    # every checkpoint links the same copy of the frozen embedding
+    assert len({os.stat(directory / f"{name}.frozen").st_ino for name in checkpoints}) == 1
+    last = directory / checkpoints[-1]
+    assert "embedding.weight" not in torch.load(last, weights_only=False)["state_dict"]
+    restored = load_module(Regressor, str(last))
+    assert torch.equal(restored.embedding.weight, model.embedding.weight)
+    assert torch.equal(restored.head.weight, model.head.weight)
+    state_dict = trainer.strategy.checkpoint_io.load_checkpoint(last)["state_dict"]
+    assert torch.equal(state_dict["embedding.weight"], model.embedding.weight)
@@ -0,0 +1,275 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import shutil
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+from torch.utils.data import DataLoader, Dataset, SequentialSampler, TensorDataset
+
+from lab.components.data.cache import ArtifactCache, CachedDataset, cache_key
+from lab.components.data.collate import PackingCollate
+from lab.components.data.sampler import BucketBatchSampler
+from lab.components.data.splits import load_or_create_split
+from lab.datamodule import LabDataModule
+from lab.dataset import LabStreamingDataset
+
+
+class SequenceDataset(Dataset):
+    def __init__(self, data_dir=None, train=True, transform=None, download=False):
+        generator = torch.Generator().manual_seed(0)
+        self.lengths = torch.randint(1, 20, (97,), generator=generator).tolist()
+
+    def __len__(self):
+        return len(self.lengths)
+
+    @property
+    def targets(self):
+        return [length % 3 for length in self.lengths]
+
+    def __getitem__(self, index):
+        sequence = torch.arange(1, self.lengths[index] + 1)
+        return sequence, sequence + 1
+
+
+def test_bucket_batch_sampler():
+    dataset = SequenceDataset()
+    sampler = BucketBatchSampler(SequentialSampler(dataset), batch_size=8, lengths=dataset.lengths, bucket_size=4)
+    batches = list(sampler)
+    assert len(batches) == len(sampler)
+    assert sorted(i for batch in batches for i in batch) == list(range(len(dataset)))
+    # batches are cut from length-sorted windows, so each one spans a narrow range of lengths
+    spread = sum(max(dataset.lengths[i] for i in b) - min(dataset.lengths[i] for i in b) for b in batches)
+    assert spread < sum(max(dataset.lengths[i : i + 8]) - min(dataset.lengths[i : i + 8]) for i in range(0, 97, 8))
+
+
+def test_packing_collate():
+    dataset = SequenceDataset()
+    samples = [dataset[i] for i in range(16)]
+    inputs, targets, segment_ids = PackingCollate(max_tokens=32)(samples)
+    assert inputs.size(1) <= 32
+    assert int((segment_ids > 0).sum()) == sum(len(x) for x, _ in samples)
+    assert torch.equal(targets[segment_ids > 0], inputs[segment_ids > 0] + 1)
+    assert inputs.size(0) < len(samples)
+
+    padded, _, segment_ids = PackingCollate()(samples)
+    assert padded.size(0) == len(samples)
+    assert int(segment_ids.max()) == 1
+
+
+def test_persisted_splits(tmp_path):
+    dataset = SequenceDataset()
+    train, val = load_or_create_split(dataset, 0.8, seed=1, splits_dir=tmp_path)
+    assert isinstance(train, np.memmap)
+    assert sorted(np.concatenate([train, val])) == list(range(len(dataset)))
+    again, _ = load_or_create_split(dataset, 0.8, seed=1, splits_dir=tmp_path)
+    assert np.array_equal(train, again)
+    assert len(list(tmp_path.iterdir())) == 2
+
+    train, val = load_or_create_split(dataset, 0.8, seed=1, splits_dir=tmp_path, stratify=True)
+    targets = np.asarray(dataset.targets)
+    for label in range(3):
+        assert abs((targets[train] == label).mean() - (targets == label).mean()) < 0.05
+
+    folds = [load_or_create_split(dataset, 0.8, splits_dir=tmp_path, num_folds=5, fold=k)[1] for k in range(5)]
+    assert sorted(np.concatenate(folds)) == list(range(len(dataset)))
+    with pytest.raises(ValueError, match="num_folds"):
+        load_or_create_split(dataset, 0.8, splits_dir=tmp_path, num_folds=1)
+
+
+def test_packed_dataloader(tmp_path):
+    datamodule = LabDataModule(
+        dataset=SequenceDataset, num_workers=0, batch_size=8, bucket_size=4, max_tokens=24, splits_dir=tmp_path
+    )
+    datamodule.setup("fit")
+    batches = list(datamodule.train_dataloader())
+    assert sum(int(segment_ids.max(dim=1).values.sum()) for *_, segment_ids in batches) == len(datamodule.train_data)
+
+
+def test_artifact_cache_evicts_least_recently_used(tmp_path):
+    cache = ArtifactCache(tmp_path, max_bytes=2 * 8 * 1000 + 1000)
+    for key in ("a", "b"):
+        cache.put(key, {"x": np.zeros(1000)})
+    assert cache.get("a") is not None  # "a" is now more recent than "b"
+    cache.put("c", {"x": np.zeros(1000)})
+    assert "a" in cache and "b" not in cache and "c" in cache
+    assert cache_key("data", {"lr": 0.1, "depth": 2}) == cache_key("data", {"depth": 2, "lr": 0.1})
+
+
+def test_put_survives_a_concurrent_eviction(tmp_path, monkeypatch):
+    cache = ArtifactCache(tmp_path)
+    # another process evicts the entry right after it is renamed into place
+    monkeypatch.setattr(cache, "evict", lambda keep=None: shutil.rmtree(cache.path(keep)))
+    arrays = cache.put("a", {"x": np.arange(10)})
+    assert "a" not in cache
+    assert np.array_equal(arrays["x"], np.arange(10))
+
+
+def test_cached_dataset_is_built_once(tmp_path):
+    cache = ArtifactCache(tmp_path)
+    dataset = SequenceDataset()
+    cached = CachedDataset(dataset, "sequences", cache)
+    assert len(cached) == len(dataset)
+    assert list(cached.lengths) == dataset.lengths
+    for i in (0, 50, 96):
+        assert all(torch.equal(a, b) for a, b in zip(cached[i], dataset[i]))
+
+    def build():
+        raise AssertionError("a cached dataset is not rebuilt")
+
+    assert torch.equal(CachedDataset(build, "sequences", cache)[3][0], dataset[3][0])
+
+
+def test_datamodule_shares_preprocessed_cache(tmp_path):
+    built = []
+
+    class CountingDataset(SequenceDataset):
+        def __init__(self, *args, **kwargs):
+            built.append(kwargs.get("train"))
+            super().__init__()
+
+    for _ in range(2):
+        datamodule = LabDataModule(
+            dataset=CountingDataset, num_workers=0, splits_dir=tmp_path, cache_preprocessed=True, cache_dir=tmp_path
+        )
+        datamodule.prepare_data()
+        datamodule.setup()
+        assert len(datamodule.train_data) + len(datamodule.val_data) == 97
+    assert built == [None, True, False]
+
+
+def test_preprocessed_cache_key_follows_the_data(tmp_path):
+    raw = tmp_path / "raw" / "cache"
+    raw.mkdir(parents=True)
+    (raw / "data.bin").write_bytes(b"a")
+    datamodule = LabDataModule(
+        dataset=SequenceDataset, data_dir=str(tmp_path / "raw"), cache_preprocessed=True, cache_dir=raw / "artifacts"
+    )
+    key = datamodule._cache_key(train=True)
+    datamodule.cache.put(key, {"x": np.zeros(3)})  # entries under data_dir do not change the key
+    assert datamodule._cache_key(train=True) == key
+    (raw / "data.bin").write_bytes(b"ab")
+    assert datamodule._cache_key(train=True) != key
+
+    with pytest.raises(ValueError, match="preprocessing_config"):
+        LabDataModule(dataset=SequenceDataset, transforms=lambda x: x, cache_preprocessed=True, cache_dir=tmp_path)
+    LabDataModule(
+        dataset=SequenceDataset,
+        transforms=lambda x: x,
+        cache_preprocessed=True,
+        cache_dir=tmp_path,
+        preprocessing_config={"transform": "identity"},
+    )
+
+
+def make_shards(root, num_shards=3, rows=10):
+    split_dir = root / "train"
+    split_dir.mkdir(parents=True)
+    for shard in range(num_shards):
+        ids = np.arange(shard * rows, (shard + 1) * rows, dtype=np.float32)
+        np.save(split_dir / f"shard-{shard}.npy", np.stack([ids, ids * 2], axis=1))
+
+
+def test_streaming_dataset_shards_without_overlap(tmp_path):
+    make_shards(tmp_path)
+    for num_workers in (0, 2, 4):
+        dataset = LabStreamingDataset(tmp_path, label_columns=[1], chunk_size=4, shuffle_buffer=8)
+        samples = list(DataLoader(dataset, batch_size=None, num_workers=num_workers))
+        assert sorted(int(x) for x, _ in samples) == list(range(30))
+        assert all(float(y) == 2 * float(x) for x, y in samples)
+
+
+def test_streaming_dataset_resumes_from_cursor(tmp_path):
+    make_shards(tmp_path)
+    full = LabStreamingDataset(tmp_path, shuffle_buffer=8)
+    full.set_epoch(1)
+    expected = [int(x[0]) for x in full][12:]
+    resumed = LabStreamingDataset(tmp_path, shuffle_buffer=8)
+    resumed.load_state_dict({"epoch": 1, "samples_seen": 12, "batch_size": 4})
+    assert [int(x[0]) for x in resumed] == expected
+    assert resumed.epoch == 2
+
+    # with workers, each one skips the batches it had already handed out
+    full.set_epoch(3)
+    batches = [b[:, 0].tolist() for b in DataLoader(full, batch_size=4, num_workers=2)]
+    resumed.load_state_dict({"epoch": 3, "samples_seen": 12, "batch_size": 4})
+    remaining = [b[:, 0].tolist() for b in DataLoader(resumed, batch_size=4, num_workers=2)]
+    assert sorted(map(sorted, remaining)) == sorted(map(sorted, batches[3:]))
+
+
+class LabeledStream(LabStreamingDataset):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, label_columns=[1], **kwargs)
+
+
+def test_streaming_with_buckets_yields_unpacked_batches(tmp_path):
+    make_shards(tmp_path / "cache")
+    datamodule = LabDataModule(
+        dataset=LabeledStream, data_dir=str(tmp_path), num_workers=0, batch_size=4, bucket_size=2
+    )
+    datamodule.setup("fit")
+    # streams are never bucketed, so without max_tokens batches stay (inputs, labels) pairs
+    loader = datamodule.train_dataloader()
+    datamodule.trainer = SimpleNamespace(training=True, current_epoch=0, logger=None, global_step=0)
+    for batch in loader:
+        datamodule.on_after_batch_transfer(batch, 0)
+    assert datamodule.state_dict()["stream"]["samples_seen"] == 30
+
+
+def test_streaming_ranks_yield_equal_counts(tmp_path):
+    # three shards over two ranks leave one rank with twice the rows of the other
+    make_shards(tmp_path)
+    for num_workers, expected in ((0, 10), (2, 12)):
+        counts, seen = [], []
+        for rank in range(2):
+            dataset = LabStreamingDataset(tmp_path, shuffle_buffer=4)
+            dataset.rank, dataset.world_size = rank, 2
+            samples = [int(x[0]) for x in DataLoader(dataset, batch_size=None, num_workers=num_workers)]
+            counts.append(len(samples))
+            seen.extend(samples)
+        assert counts == [expected, expected]
+        assert len(set(seen)) == len(seen)
+
+
+def test_dict_batches_pass_through_the_sample_count():
+    datamodule = LabDataModule(num_workers=0, log_throughput=False)
+    datamodule.train_data = TensorDataset(torch.ones(8, 3))
+    datamodule.trainer = SimpleNamespace(training=True, current_epoch=0)
+    batch = {"input_ids": torch.ones(4, 3, dtype=torch.long), "labels": torch.zeros(4)}
+    assert datamodule.on_after_batch_transfer(batch, 0) is batch
+    assert datamodule.on_after_batch_transfer({"text": ["a", "b"]}, 0)["text"] == ["a", "b"]
+    assert datamodule._samples_seen == 4
+
+
+class ShuffledStream(LabStreamingDataset):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, shuffle_buffer=8, **kwargs)
+
+
+def test_stream_order_follows_the_trainer_epoch_with_workers(tmp_path):
+    make_shards(tmp_path / "cache")
+    datamodule = LabDataModule(
+        dataset=ShuffledStream, data_dir=str(tmp_path), num_workers=1, batch_size=None, persistent_workers=False
+    )
+    datamodule.setup("fit")
+    loader = datamodule.train_dataloader()
+    datamodule.trainer = SimpleNamespace(current_epoch=0)
+    # the worker's copy of the dataset advances its own epoch and is then thrown away
+    first = [int(x[0]) for x in loader]
+    assert [int(x[0]) for x in loader] == first
+    datamodule.trainer.current_epoch = 1
+    second = [int(x[0]) for x in loader]
+    assert sorted(second) == sorted(first) and second != first
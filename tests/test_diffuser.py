@@ -0,0 +1,72 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import torch
+
+from lab.models.diffuser import DiffusionModel
+
+
+def test_closed_form_noising():
+    model = DiffusionModel(num_steps=50, image_size=16)
+    x, noise = torch.randn(4, 16), torch.randn(4, 16)
+    t = torch.tensor([0, 10, 25, 49])
+    alpha_bar = torch.cumprod(1 - model.betas, dim=0)[t, None]
+    assert torch.allclose(model.q_sample(x, t, noise), alpha_bar.sqrt() * x + (1 - alpha_bar).sqrt() * noise)
+
+
+def test_training_step_is_one_network_call():
+    calls = []
+    for num_steps in (10, 1000):
+        model = DiffusionModel(num_steps=num_steps, image_size=16)
+        model.encoder.register_forward_hook(lambda *args: calls.append(num_steps))
+        loss = model.training_step(torch.randn(8, 16), 0)
+        loss.backward()
+        assert torch.isfinite(loss)
+    assert calls == [10, 1000]
+    assert isinstance(model.configure_optimizers(), torch.optim.Adam)
+
+
+def test_beta_schedules():
+    for kind in ("linear", "quadratic", "sigmoid", "cosine"):
+        model = DiffusionModel(num_steps=100, image_size=16, schedule=kind)
+        assert ((model.betas > 0) & (model.betas < 1)).all()
+        assert (model.alphas_cumprod.diff() < 0).all()
+
+
+def test_ddim_recovers_data_with_an_exact_noise_predictor():
+    # every sample is x0, so the exact noise at x_t is known in closed form
+    x0 = torch.linspace(-1, 1, 16, dtype=torch.double)
+    for kind in ("linear", "cosine"):
+        model = DiffusionModel(num_steps=1000, image_size=16, schedule=kind).double()
+        alpha_bar = model.alphas_cumprod
+
+        def exact_noise(x_noisy, t):
+            return (x_noisy - alpha_bar[t, None].sqrt() * x0) / (1 - alpha_bar[t, None]).sqrt()
+
+        model.predict_noise = exact_noise
+        for steps in (1, 10, 100):
+            samples = model.sample(8, steps=steps, generator=torch.Generator().manual_seed(0))
+            assert torch.allclose(samples, x0.expand(8, -1), atol=1e-4)
+
+
+def test_batched_sampling():
+    model = DiffusionModel(num_steps=100, image_size=16)
+    samples = model.sample(10, steps=5, generator=torch.Generator().manual_seed(0))
+    chunked = model.sample(10, steps=5, batch_size=4, generator=torch.Generator().manual_seed(0))
+    assert samples.shape == (10, 16)
+    assert torch.allclose(samples, chunked, atol=1e-6)
+    calls = []
+    model.encoder.register_forward_hook(lambda *args: calls.append(args[1][0].size(0)))
+    model.sample(10, steps=5, eta=1.0)
+    assert calls == [10] * 5
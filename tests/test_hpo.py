@@ -0,0 +1,87 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+
+import optuna
+import pytest
+import torch
+
+from lab.components.hpo.run import run_sweep
+from lab.components.hpo.sweep import PRUNERS, load_study, make_pruner
+
+
+def objective(trial):
+    x = trial.suggest_float("x", -10, 10)
+    for step in range(10):
+        loss = (x - 2) ** 2 + 10 / (step + 1)
+        trial.report(loss, step)
+        if trial.should_prune():
+            raise optuna.TrialPruned()
+    return loss
+
+
+def thread_objective(trial):
+    trial.set_user_attr("threads", (torch.get_num_threads(), torch.get_num_interop_threads()))
+    return trial.suggest_float("x", -10, 10) ** 2
+
+
+def finished(study):
+    return [t for t in study.trials if t.state in (optuna.trial.TrialState.COMPLETE, optuna.trial.TrialState.PRUNED)]
+
+
+def test_make_pruner():
+    for name in PRUNERS:
+        assert isinstance(make_pruner(name), optuna.pruners.BasePruner)
+    with pytest.raises(ValueError):
+        make_pruner("random")
+
+
+def test_sweep_runs_concurrently_and_resumes(tmp_path):
+    study = run_sweep(objective, "quadratic", n_trials=6, concurrent_trials=2, storage_dir=tmp_path, seed=0)
+    assert len(finished(study)) >= 6
+    assert (tmp_path / "quadratic.db").exists()
+
+    # a finished sweep is not rerun, and a longer one only runs the missing trials
+    assert len(run_sweep(objective, "quadratic", n_trials=6, concurrent_trials=1, storage_dir=tmp_path).trials) == len(
+        study.trials
+    )
+    study = run_sweep(objective, "quadratic", n_trials=20, concurrent_trials=1, storage_dir=tmp_path, seed=1)
+    assert len(finished(study)) == 20
+    assert load_study("quadratic", storage_dir=tmp_path).best_value < 20
+
+
+def test_sweep_prunes_bad_trials(tmp_path):
+    study = run_sweep(
+        objective, "pruned", n_trials=30, concurrent_trials=1, pruner="hyperband", storage_dir=tmp_path, seed=0
+    )
+    assert any(t.state == optuna.trial.TrialState.PRUNED for t in study.trials)
+
+
+def test_sequential_sweep_restores_threads(tmp_path, monkeypatch):
+    monkeypatch.delenv("OMP_NUM_THREADS", raising=False)
+    monkeypatch.setenv("MKL_NUM_THREADS", "3")
+    threads = torch.get_num_threads()
+    run_sweep(objective, "threads", n_trials=2, concurrent_trials=1, threads_per_trial=2, storage_dir=tmp_path)
+    assert "OMP_NUM_THREADS" not in os.environ
+    assert os.environ["MKL_NUM_THREADS"] == "3"
+    assert torch.get_num_threads() == threads
+
+
+def test_concurrent_trials_run_with_their_thread_budget(tmp_path):
+    study = run_sweep(
+        thread_objective, "budget", n_trials=2, concurrent_trials=2, threads_per_trial=3, storage_dir=tmp_path
+    )
+    assert study.trials and all(tuple(t.user_attrs["threads"]) == (3, 3) for t in study.trials)
@@ -0,0 +1,66 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+import subprocess
+import sys
+
+import pytest
+
+# what a `lab` command may cost to import before it does any work, measured with `python -X importtime`
+IMPORT_BUDGET_MS = {
+    "lab.cli": 300,
+    "lab.config": 50,
+    "lab.components.bench.results": 100,
+    "lab.components.inference.server": 500,
+}
+TOP_LEVEL = re.compile(r"^import time:\s+\d+ \|\s+(\d+) \| (\S+)$", re.MULTILINE)
+HEAVY_MODULES = (
+    "torch",
+    "pytorch_lightning",
+    "lightning",
+    "transformers",
+    "datasets",
+    "wandb",
+    "optuna",
+    "onnxruntime",
+)
+
+
+def run(code):
+    """Runs ``code`` in a fresh interpreter and returns the import times in ms and the modules it loaded."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"{code}\nimport sys\nprint(' '.join(sys.modules))"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    # nested imports are indented, so only the top-level entries are matched
+    times = {name: int(cumulative) / 1000 for cumulative, name in TOP_LEVEL.findall(result.stderr)}
+    return times, set(result.stdout.split())
+
+
+@pytest.mark.parametrize("module", list(IMPORT_BUDGET_MS))
+def test_import_time_budget(module):
+    times, modules = run(f"import {module}")
+    assert not modules & set(HEAVY_MODULES)
+    # a submodule imports its parent packages first, as separate top-level entries
+    elapsed = sum(ms for name, ms in times.items() if name == "lab" or name.startswith("lab."))
+    assert elapsed < IMPORT_BUDGET_MS[module], f"importing {module} took {elapsed:.0f}ms"
+
+
+def test_cli_help_does_not_import_heavy_dependencies():
+    code = "from lab.cli import app\ntry:\n    app(['bench', 'run', '--help'])\nexcept SystemExit:\n    pass"
+    _, modules = run(code)
+    assert not modules & set(HEAVY_MODULES)
@@ -0,0 +1,83 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import pytest
+import torch
+from pytorch_lightning import LightningModule
+from pytorch_lightning.loggers import CSVLogger
+from torch.utils.data import DataLoader
+
+from lab.components.inference.export import (
+    StateSpaceExport,
+    TransformerExport,
+    check_parity,
+    export_statespace,
+    export_transformer,
+)
+from lab.components.inference.runtime import OnnxSession, TorchSession, load_session
+from lab.models.statespace import StateSpaceModel
+from lab.models.transformer import Transformer
+from lab.trainer import LabTrainer
+
+pytest.importorskip("onnxruntime")
+pytest.importorskip("onnxscript")
+
+
+def test_transformer_export_has_dynamic_batch_and_sequence(tmp_path):
+    model = Transformer(vocab_size=100, ninp=16, nhid=16).eval()
+    path, _ = export_transformer(model, str(tmp_path / "transformer.onnx"), seq_len=7)
+    assert not model.causal_masks.tensors  # tracing leaves the eager caches alone
+    for batch_size, seq_len in ((1, 3), (5, 40)):
+        inputs = tuple(torch.randint(0, 100, (batch_size, seq_len)) for _ in range(2))
+        for session in (OnnxSession(path), OnnxSession(path, io_binding=False), TorchSession(path)):
+            assert check_parity(TransformerExport(model), session, inputs) < 1e-4
+            assert session(*inputs)[0].shape == (batch_size, seq_len, 100)
+
+
+def test_statespace_export_loops_over_steps(tmp_path):
+    model = StateSpaceModel(4, 2)
+    path, _ = export_statespace(model, str(tmp_path / "statespace.onnx"), steps=5)
+    inputs = (torch.randn(3, 4), torch.randn(3, 50, 4), torch.randn(3, 50, 2))
+    for session in (load_session(path), TorchSession(path)):
+        assert check_parity(StateSpaceExport(model), session, inputs) < 1e-5
+
+
+class Regressor(LightningModule):
+    def __init__(self):
+        super().__init__()
+        self.layer = torch.nn.Linear(8, 2)
+        self.example_input_array = torch.randn(4, 8)
+
+    def forward(self, x):
+        return self.layer(x)
+
+    def training_step(self, batch, batch_idx):
+        return self(batch).pow(2).mean()
+
+    def configure_optimizers(self):
+        return torch.optim.SGD(self.parameters(), lr=0.1)
+
+
+def test_export_production_model(tmp_path):
+    trainer = LabTrainer(
+        logger=CSVLogger(tmp_path),
+        profiler="simple",
+        checkpoints_dir=tmp_path,
+        max_epochs=1,
+        enable_progress_bar=False,
+    )
+    trainer.fit(Regressor(), DataLoader(torch.randn(32, 8), batch_size=8))
+    path = trainer.export_production_model(path=str(tmp_path / "production" / "model.onnx"))
+    assert load_session(path)(torch.randn(16, 8))[0].shape == (16, 2)
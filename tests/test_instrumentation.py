@@ -0,0 +1,90 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import csv
+import os
+import subprocess
+import sys
+
+import pytest
+import torch
+from pytorch_lightning import LightningModule, Trainer
+from pytorch_lightning.loggers import CSVLogger
+from torch.utils.data import DataLoader, TensorDataset
+
+from lab.components.callbacks.instrumentation import StepInstrumentation, peak_rss_mb, window_profiler
+
+
+class TokenModel(LightningModule):
+    def __init__(self):
+        super().__init__()
+        self.embedding = torch.nn.Embedding(50, 8)
+
+    def training_step(self, batch, batch_idx):
+        inputs, target = batch
+        return (self.embedding(inputs).sum(-1) - target).pow(2).mean()
+
+    def configure_optimizers(self):
+        return torch.optim.SGD(self.parameters(), lr=0.01)
+
+
+def fit(tmp_path, num_workers):
+    data = TensorDataset(torch.randint(0, 50, (64, 12)), torch.randn(64, 12))
+    trainer = Trainer(
+        max_epochs=1,
+        callbacks=[StepInstrumentation()],
+        logger=CSVLogger(tmp_path, name="perf"),
+        log_every_n_steps=4,
+        enable_progress_bar=False,
+        enable_model_summary=False,
+        enable_checkpointing=False,
+    )
+    trainer.fit(TokenModel(), DataLoader(data, batch_size=8, num_workers=num_workers))
+    with open(f"{trainer.logger.log_dir}/metrics.csv") as f:
+        return [row for row in csv.DictReader(f) if row.get("perf/step_ms")]
+
+
+def test_step_phases_are_logged(tmp_path):
+    rows = fit(tmp_path, num_workers=0)
+    assert [int(row["step"]) for row in rows] == [3, 7]
+    for row in rows:
+        phases = sum(float(row[f"perf/{phase}_ms"]) for phase in ("data_wait", "forward", "backward", "optimizer"))
+        assert 0 < phases <= float(row["perf/step_ms"]) + 1e-6
+        assert float(row["perf/tokens_per_sec"]) == pytest.approx(12 * float(row["perf/samples_per_sec"]))
+        assert float(row["perf/peak_rss_mb"]) > 0
+        assert "perf/worker_queue_depth" not in row
+
+
+def test_worker_queue_depth(tmp_path):
+    rows = fit(tmp_path, num_workers=2)
+    assert all(0 <= float(row["perf/worker_queue_depth"]) <= 4 for row in rows)
+
+
+def test_window_profiler_schedule(tmp_path):
+    profiler = window_profiler(5, 8, dirpath=tmp_path)
+    schedule = profiler._schedule._schedule
+    recorded = [step for step in range(20) if schedule(step).name.startswith("RECORD")]
+    assert recorded == [5, 6, 7]
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/task"), reason="reads live children from /proc")
+def test_peak_rss_counts_live_children():
+    # a child still running has not been waited for, so only /proc sees its memory
+    script = "import sys; b = b'x' * 2**29; print('ready', flush=True); sys.stdin.read()"
+    child = subprocess.Popen([sys.executable, "-c", script], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    try:
+        child.stdout.readline()
+        assert peak_rss_mb()["perf/peak_rss_children_mb"] >= 512
+    finally:
+        child.communicate()
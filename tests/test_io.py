@@ -0,0 +1,70 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import threading
+
+import pytest
+
+from lab.components.io import atomic_write
+
+
+@pytest.mark.parametrize("fsync", [True, False])
+def test_atomic_write_replaces_the_file(tmp_path, fsync):
+    path = tmp_path / "file.bin"
+    path.write_bytes(b"old")
+    atomic_write(path, lambda f: f.write(b"new"), fsync=fsync)
+    assert path.read_bytes() == b"new"
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_atomic_write_keeps_the_old_file_when_the_writer_fails(tmp_path):
+    path = tmp_path / "file.bin"
+    path.write_bytes(b"old")
+
+    def writer(f):
+        f.write(b"partial")
+        raise RuntimeError("disk full")
+
+    with pytest.raises(RuntimeError):
+        atomic_write(path, writer)
+    assert path.read_bytes() == b"old"
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_threads_writing_the_same_file_do_not_share_a_temporary_file(tmp_path):
+    path = tmp_path / "file.bin"
+    # both threads have started writing before either finishes
+    both_writing = threading.Barrier(2)
+    errors = []
+
+    def write(payload):
+        def writer(f):
+            f.write(payload[:1])
+            both_writing.wait()
+            f.write(payload[1:])
+
+        try:
+            atomic_write(path, writer)
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=write, args=(bytes([i]) * 1024,)) for i in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    assert path.read_bytes() in (b"\x00" * 1024, b"\x01" * 1024)
+    assert list(tmp_path.iterdir()) == [path]
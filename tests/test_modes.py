@@ -0,0 +1,104 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import numpy as np
+import pytest
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+from lab.components.bench.modes import recommend
+from lab.components.callbacks.compile import CompileModules
+from lab.components.execution import modes
+from lab.components.inference.server import load_model
+from lab.models.diffuser import DiffusionModel
+from lab.models.statespace import StateSpaceModel
+from lab.trainer import LabTrainer
+
+
+def test_compile_keeps_parameter_names():
+    model = DiffusionModel(image_size=16)
+    keys = list(model.state_dict())
+    assert modes.compile_module(model, backend="eager") == ["encoder", "decoder"]
+    compiled = model.encoder._compiled_call_impl
+    modes.compile_module(model, backend="eager")
+    assert model.encoder._compiled_call_impl is compiled
+    assert list(model.state_dict()) == keys
+    assert modes.compile_module(StateSpaceModel(4, 2), backend="eager") == [""]
+
+
+def test_bf16_outputs_are_float32_and_close():
+    torch.manual_seed(0)
+    model = DiffusionModel(image_size=16)
+    x, t = torch.rand(8, 16), torch.randint(0, 1000, (8,))
+    expected = model.predict_noise(x, t).detach()
+    run = modes.apply_mode(model.encoder, "bf16")
+    outputs = run(x, t.float() / model.num_steps)
+    assert outputs.dtype == torch.float32
+    assert torch.allclose(outputs, expected, atol=0.05)
+    assert not outputs.requires_grad
+    with pytest.raises(ValueError, match="Unknown execution mode"):
+        modes.apply_mode(model, "fp8")
+
+
+def test_graph_break_report():
+    def fn(x):
+        x = x.sin()
+        print("breaks the graph")
+        return x.cos()
+
+    report = modes.graph_break_report(fn, torch.randn(4))
+    assert report["graphs"] == 2 and report["graph_breaks"] == 1
+    assert "print" in report["reasons"][0]["reason"]
+    assert modes.graph_break_report(torch.nn.Linear(4, 4), torch.randn(2, 4))["graph_breaks"] == 0
+
+
+def test_trainer_compiles_and_trains_in_bf16(tmp_path):
+    trainer = LabTrainer(
+        logger=False,
+        checkpoints_dir=tmp_path,
+        execution_mode="compile-bf16",
+        compile_backend="eager",
+        max_steps=4,
+        enable_progress_bar=False,
+        enable_model_summary=False,
+    )
+    assert trainer.precision == "bf16-mixed"
+    callback = next(callback for callback in trainer.callbacks if isinstance(callback, CompileModules))
+    trainer.fit(DiffusionModel(image_size=16), DataLoader(TensorDataset(torch.rand(32, 16)), batch_size=8))
+    assert callback.compiled == ["encoder", "decoder"]
+    assert callback.report["graph_breaks"] == 0 and callback.report["graphs"] >= 1
+    assert trainer.lightning_module.encoder._compiled_call_impl is not None
+
+    # checkpoints of compiled modules load into eager ones, and serve in any mode
+    trainer.save_checkpoint(tmp_path / "model.ckpt")
+    run = load_model(str(tmp_path / "model.ckpt"), "lab.models.diffuser:DiffusionModel", mode="bf16")
+    (outputs,) = run(np.random.rand(2, 16).astype(np.float32))
+    assert outputs.shape == (2, 16) and outputs.dtype == torch.float32
+
+
+def test_recommends_the_fastest_accurate_mode():
+    table = {
+        "a": {
+            "eager": {"train_samples_per_sec": 10.0, "max_error": 0.0},
+            "bf16": {"train_samples_per_sec": 30.0, "max_error": 0.2},
+            "compile": {"train_samples_per_sec": 20.0, "max_error": 1e-6},
+        },
+        "b": {
+            "eager": {"infer_samples_per_sec": 10.0, "max_error": 0.0},
+            "bf16": {"infer_samples_per_sec": 5.0, "max_error": 0.0},
+        },
+    }
+    assert recommend(table) == {"a": "compile", "b": "eager"}
+    assert recommend(table, tolerance=0.5) == {"a": "bf16", "b": "eager"}
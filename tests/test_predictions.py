@@ -0,0 +1,78 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import numpy as np
+import pytest
+import torch
+from pytorch_lightning import LightningModule, Trainer
+from torch.utils.data import DataLoader
+
+from lab.components.callbacks.predictions import PredictionReader, ShardedPredictionWriter
+from lab.trainer import LabTrainer
+
+
+class Doubler(LightningModule):
+    def predict_step(self, batch, batch_idx):
+        return {"double": 2 * batch, "sum": batch.sum(dim=1)}
+
+
+def predict(tmp_path, background):
+    data = torch.arange(103 * 3, dtype=torch.float32).reshape(103, 3)
+    writer = ShardedPredictionWriter(tmp_path, shard_size=25, background=background)
+    trainer = Trainer(callbacks=[writer], logger=False, enable_progress_bar=False, enable_model_summary=False)
+    assert trainer.predict(Doubler(), DataLoader(data, batch_size=10), return_predictions=False) is None
+    return data.numpy(), PredictionReader(tmp_path)
+
+
+@pytest.mark.parametrize("background", [False, True])
+def test_sharded_predictions(tmp_path, background):
+    data, reader = predict(tmp_path, background)
+    assert len(reader) == 103
+    assert [shard["rows"] for shard in reader.shards] == [25, 25, 25, 25, 3]
+    assert np.array_equal(reader.read()["double"], 2 * data)
+    # slices only map the shards they cover, and may straddle shard boundaries
+    assert np.array_equal(reader[20:60]["sum"], data[20:60].sum(axis=1))
+    assert np.array_equal(reader[10:90:7]["double"], 2 * data[10:90:7])
+    assert np.array_equal(reader[-1]["double"], 2 * data[-1])
+    assert isinstance(reader.shard(0)["double"], np.memmap)
+
+
+def test_rerun_replaces_previous_shards(tmp_path):
+    predict(tmp_path, background=True)
+    _, reader = predict(tmp_path, background=False)
+    assert len(reader) == 103
+
+
+class Scaled(LightningModule):
+    def __init__(self, scale: float = 2.0):
+        super().__init__()
+        self.save_hyperparameters()
+
+
+class Wrapper(torch.nn.Module):
+    # stands in for DistributedDataParallel, which hides the LightningModule and its hparams
+    def __init__(self, module):
+        super().__init__()
+        self.module = module
+
+
+def test_predictions_key_names_the_wrapped_module(tmp_path):
+    trainer = LabTrainer(logger=False, checkpoints_dir=tmp_path)
+    trainer.strategy.connect(Scaled())
+    key = trainer.predictions_key()
+    trainer.strategy.model = Wrapper(trainer.lightning_module)
+    assert trainer.predictions_key() == key
+    trainer.strategy.connect(Scaled(scale=3.0))
+    assert trainer.predictions_key() != key
@@ -0,0 +1,69 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+
+import torch
+from torch import nn
+from torch.utils.data import DataLoader, TensorDataset
+
+from lab.components.inference.quantize import (
+    load_quantized,
+    quantizable_layers,
+    quantization_report,
+    quantize,
+    quantize_static,
+    save_quantized,
+)
+from lab.models.diffuser import DiffusionModel
+from lab.models.transformer import Transformer
+
+
+def test_dynamic_quantization_skips_fused_transformer_layers(tmp_path):
+    model = Transformer(vocab_size=1000, ninp=32, nhead=2, nhid=64, nlayers=1).eval()
+    assert set(quantizable_layers(model)) == {"embedding", "decoder"}
+    quantized = quantize(model)
+    assert type(model.decoder) is nn.Linear  # the original is left untouched
+    inputs = torch.randint(0, 1000, (4, 12))
+    with torch.no_grad():
+        expected, actual = model(inputs, inputs), quantized(inputs, inputs)
+    assert (expected.argmax(-1) == actual.argmax(-1)).float().mean() > 0.9
+
+    path = save_quantized(quantized, str(tmp_path / "model.int8-dynamic.pt"))
+    with torch.no_grad():
+        assert torch.equal(load_quantized(path)(inputs, inputs), actual)
+
+
+def test_static_quantization_of_a_traceable_submodule():
+    model = DiffusionModel(num_steps=10, image_size=16).eval()
+    loader = DataLoader(TensorDataset(torch.rand(64, 16)), batch_size=16)
+    quantized = quantize_static(model, loader, ["encoder"], forward_fn=lambda m, batch: m.loss(batch[0]))
+    assert type(model.encoder.fc1) is nn.Linear
+    assert "quantized" in type(quantized.encoder.fc1).__module__
+
+    batches = [(x, torch.randint(0, 10, (16,))) for (x,) in loader]
+    report = quantization_report(model, quantized, batches, lambda m, batch: m.predict_noise(*batch), repeats=1)
+    assert report["int8"]["weights_mb"] < report["fp32"]["weights_mb"]
+    assert report["int8"]["mean_abs_error"] < 0.1
+    assert json.loads(json.dumps(report)) == report
+
+
+def test_whole_model_static_quantization(tmp_path):
+    model = nn.Sequential(nn.Linear(8, 16), nn.ReLU(), nn.Linear(16, 4)).eval()
+    calibration = [torch.randn(32, 8) for _ in range(4)]
+    quantized = quantize_static(model, calibration)
+    with torch.no_grad():
+        assert (model(calibration[0]) - quantized(calibration[0])).abs().max() < 0.1
+    assert os.path.exists(save_quantized(quantized, str(tmp_path / "nested" / "model.pt")))
@@ -0,0 +1,87 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import threading
+
+import numpy as np
+import pytest
+
+from lab.components.inference.server import MicroBatcher, connect, load_test, make_server, predict, request
+
+
+def doubler(batches):
+    def run(x):
+        batches.append(len(x))
+        return [2 * x]
+
+    return run
+
+
+def test_micro_batcher_merges_concurrent_requests():
+    batches = []
+    batcher = MicroBatcher(doubler(batches), max_batch_size=4, max_latency_ms=200)
+    futures = [batcher.submit(np.full((1, 3), i)) for i in range(10)]
+    results = [future.result(timeout=5) for future in futures]
+    batcher.close()
+    assert all(np.array_equal(output, np.full((1, 3), 2 * i)) for i, (output,) in enumerate(results))
+    assert batches == [4, 4, 2]
+    metrics = batcher.metrics.snapshot()
+    assert metrics["requests"] == 10 and metrics["batches"] == 3
+    assert metrics["batch_fill"] == pytest.approx(10 / 12)
+
+
+def test_micro_batcher_keeps_shapes_apart_and_reports_errors():
+    batches = []
+    batcher = MicroBatcher(doubler(batches), max_batch_size=8, max_latency_ms=100)
+    futures = [batcher.submit(np.zeros((1, 3 + i % 2))) for i in range(6)]
+    assert [future.result(timeout=5)[0].shape for future in futures] == [(1, 3), (1, 4)] * 3
+    assert sorted(batches) == [3, 3]
+    batcher.close()
+
+    def fail(x):
+        raise RuntimeError("boom")
+
+    batcher = MicroBatcher(fail, max_latency_ms=1)
+    with pytest.raises(RuntimeError, match="boom"):
+        batcher.submit(np.zeros((1, 3))).result(timeout=5)
+    assert batcher.metrics.snapshot()["errors"] == 1
+    batcher.close()
+
+
+@pytest.mark.parametrize("unix", [False, True])
+def test_server_round_trip(tmp_path, unix):
+    batcher = MicroBatcher(lambda x, y: [x + y], max_batch_size=16, max_latency_ms=2)
+    unix_socket = str(tmp_path / "serve.sock") if unix else None
+    server = make_server(batcher, port=0, unix_socket=unix_socket)
+    port = 0 if unix else server.server_address[1]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        connection = connect(port=port, unix_socket=unix_socket)
+        (output,) = predict(connection, np.ones((2, 3), dtype=np.float32), np.ones((2, 3), dtype=np.float32))
+        assert np.array_equal(output, np.full((2, 3), 2.0))
+        reply = request(connection, "POST", "/predict", {"inputs": [[[1, 2]], [[3, 4]]]})
+        assert reply["outputs"] == [[[4, 6]]]
+        assert request(connection, "GET", "/health") == {"status": "ok"}
+        connection.close()
+
+        stats = load_test(
+            lambda: [np.ones((1, 3))] * 2, num_requests=50, concurrency=8, port=port, unix_socket=unix_socket
+        )
+        assert stats["server_requests"] == 52 and stats["server_errors"] == 0
+        assert stats["server_requests_per_batch"] > 1
+    finally:
+        server.shutdown()
+        server.server_close()
+        batcher.close()
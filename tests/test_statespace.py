@@ -0,0 +1,100 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+import torch
+
+from lab.models.statespace import StateSpaceModel
+
+
+def make_model():
+    torch.manual_seed(0)
+    transition = (0.9 * torch.eye(4) + 0.05 * torch.randn(4, 4)).tolist()
+    return StateSpaceModel(4, 2, transition_matrix=transition)
+
+
+def test_forward_shapes():
+    model = make_model()
+    assert model(torch.zeros(4), steps=7).shape == (7, 2)
+    assert model(torch.zeros(3, 4), steps=7).shape == (3, 7, 2)
+
+
+def test_scan_matches_sequential():
+    model = make_model()
+    initial_state = torch.randn(5, 4)
+    sequential = model(initial_state, steps=37, generator=torch.Generator().manual_seed(1))
+    scan = model(initial_state, steps=37, method="scan", generator=torch.Generator().manual_seed(1))
+    assert torch.allclose(sequential, scan, atol=1e-5)
+
+
+def naive_kalman(model, observations):
+    """One sequence at a time with explicit inverses, as a reference."""
+    A, C = model.A.detach(), model.C.detach()
+    Q = model.process_noise_var.detach() * torch.eye(4, dtype=A.dtype)
+    R = model.observation_noise_var.detach() * torch.eye(2, dtype=A.dtype)
+    mean, cov = torch.zeros(4, dtype=A.dtype), torch.eye(4, dtype=A.dtype)
+    means, covs, log_likelihood = [], [], 0.0
+    for y in observations:
+        S = C @ cov @ C.T + R
+        K = cov @ C.T @ torch.linalg.inv(S)
+        log_likelihood += torch.distributions.MultivariateNormal(C @ mean, S).log_prob(y)
+        mean, cov = mean + K @ (y - C @ mean), cov - K @ C @ cov
+        means.append(mean)
+        covs.append(cov)
+        mean, cov = A @ mean, A @ cov @ A.T + Q
+    return torch.stack(means), torch.stack(covs), log_likelihood
+
+
+def test_kalman_filter_matches_reference():
+    model = make_model().double()
+    observations = model(torch.randn(3, 4, dtype=torch.float64), steps=200).detach()
+    lengths = torch.tensor([200, 141, 7])
+    for tol in (0.0, 1e-8):
+        means, covs, log_likelihood = model.kalman_filter(observations, lengths, tol=tol)
+        for b, length in enumerate(lengths):
+            ref_means, ref_covs, ref_log_likelihood = naive_kalman(model, observations[b, :length])
+            assert torch.allclose(means[b, :length], ref_means, atol=1e-6)
+            assert torch.allclose(covs[:length], ref_covs, atol=1e-6)
+            assert torch.allclose(log_likelihood[b], ref_log_likelihood, atol=1e-6)
+
+
+def test_rts_smoother_and_gradients():
+    model = make_model().double()
+    observations = model(torch.randn(2, 4, dtype=torch.float64), steps=30).detach()
+    lengths = torch.tensor([30, 12])
+    means, covs = model.rts_smoother(observations, lengths)
+    filtered, _, _ = model.kalman_filter(observations, lengths)
+    # the last step of every sequence has seen all of its data already
+    assert torch.allclose(means[0, 29], filtered[0, 29]) and torch.allclose(means[1, 11], filtered[1, 11])
+    short, _ = model.rts_smoother(observations[1, :12])
+    assert torch.allclose(means[1, :12], short)
+
+    model.log_likelihood(observations, lengths).sum().backward()
+    assert model.A.grad is not None and model.C.grad is not None
+
+
+def test_lengths_follow_the_estimates_device():
+    # a CPU mask against CUDA estimates raises, so lengths are built where the estimates live
+    for lengths in (None, [3, 2], torch.tensor([3.0, 2.0])):
+        mask = StateSpaceModel._lengths(lengths, 2, 3, torch.device("meta"))
+        assert mask.device.type == "meta" and mask.dtype == torch.long
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="needs a GPU")
+def test_rts_smoother_on_cuda():
+    model = make_model().double().cuda()
+    observations = model(torch.randn(2, 4, dtype=torch.float64, device="cuda"), steps=10).detach()
+    means, _ = model.rts_smoother(observations, [10, 4])
+    assert means.is_cuda
+    assert model.log_likelihood(observations).isfinite().all()
@@ -0,0 +1,277 @@
+# Copyright Justin R. Goheen.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+import os
+from types import SimpleNamespace
+
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+from lab.components.callbacks.accumulation import TokensPerUpdate, count_tokens
+from lab.models import transformer
+from lab.models.softmax import AdaptiveSoftmaxHead, chunked_cross_entropy, frequency_cutoffs
+from lab.models.transformer import LightningTransformer, PositionalEncoding, Transformer, WikiText2, tokenize
+from lab.trainer import LabTrainer
+
+TEXT = "the quick brown fox\n\njumps over the lazy dog\r\n = heading = \nthe café end\rfox"
+
+
+def make_corpus(tmp_path):
+    path = tmp_path / "wikitext-2.txt"
+    path.write_text(TEXT, encoding="utf8")
+    return path
+
+
+def test_token_cache(tmp_path, monkeypatch):
+    path = make_corpus(tmp_path)
+    data, dictionary = tokenize(path)
+
+    dataset = WikiText2(data_dir=tmp_path, block_size=4, download=False)
+    assert torch.equal(dataset.data, data)
+    assert dataset.dictionary.idx2word == dictionary.idx2word
+    # ids, vocabulary, counts and the memoised corpus digest
+    assert len(os.listdir(tmp_path / "cache")) == 4
+    assert sum(dictionary.counts) == len(data)
+    assert dictionary.counts[dictionary.word2idx["fox"]] == 2
+
+    def fail(path):
+        raise AssertionError("tokenize should not run on a cache hit")
+
+    monkeypatch.setattr(transformer, "tokenize", fail)
+    cached = WikiText2(data_dir=tmp_path, block_size=4, download=False)
+    assert torch.equal(cached.data, data)
+    assert cached.dictionary.word2idx == dictionary.word2idx
+    assert cached.dictionary.counts == dictionary.counts
+    assert cached[0][0].dtype == torch.int64
+
+
+def test_tokenize_matches_sequential(tmp_path):
+    path = make_corpus(tmp_path)
+    # the original two-pass, line-by-line tokenizer
+    word2idx = {}
+    ids = []
+    with open(path, encoding="utf8") as f:
+        for line in f:
+            for word in line.split() + ["<eos>"]:
+                ids.append(word2idx.setdefault(word, len(word2idx)))
+
+    for num_workers, chunk_size in [(1, 1 << 20), (1, 8), (2, 8)]:
+        data, dictionary = tokenize(path, num_workers=num_workers, chunk_size=chunk_size)
+        assert dictionary.word2idx == word2idx
+        assert data.dtype == torch.int64
+        assert data.tolist() == ids
+
+
+def test_generate_matches_full_decoding():
+    torch.manual_seed(0)
+    model = LightningTransformer(vocab_size=50).eval()
+    prompts = torch.randint(0, 50, (3, 6))
+    tokens = model.generate(prompts, max_new_tokens=5)
+
+    # recompute the whole decoder over the growing sequence at every step
+    net = model.model
+    positions = torch.arange(11).expand(3, -1)
+    memory = net.encode(prompts, torch.zeros(3, 6, dtype=torch.bool), positions[:, :6])
+    sequence = prompts
+    for _ in range(5):
+        t = sequence.size(1)
+        mask = net.transformer.generate_square_subsequent_mask(t)
+        tgt = net.pos_encoder(net.embedding(sequence) * math.sqrt(net.ninp), positions[:, :t])
+        logits = net.decoder(net.transformer.decoder(tgt, memory, tgt_mask=mask))
+        sequence = torch.cat([sequence, logits[:, -1].argmax(-1, keepdim=True)], dim=1)
+    assert torch.equal(tokens, sequence[:, 6:])
+
+
+def test_generate_batched_prompts():
+    torch.manual_seed(0)
+    model = LightningTransformer(vocab_size=50).eval()
+    prompts = [torch.randint(0, 50, (n,)) for n in (3, 7, 5)]
+    batched = model.generate(prompts, max_new_tokens=4)
+    assert batched.shape == (3, 4)
+    for prompt, tokens in zip(prompts, batched):
+        assert torch.equal(model.generate([prompt], max_new_tokens=4)[0], tokens)
+
+    sampled = model.generate(prompts, max_new_tokens=4, strategy="top_p", generator=torch.Generator().manual_seed(0))
+    assert sampled.shape == (3, 4) and int(sampled.max()) < 50
+
+
+def test_cached_masks_and_encodings():
+    model = Transformer(vocab_size=50, ninp=8)
+    mask = model.causal_masks.get(4, device=torch.device("cpu"), dtype=torch.float32)[:4, :4]
+    assert torch.equal(mask, model.transformer.generate_square_subsequent_mask(4))
+    assert model.causal_masks.get(3, device=torch.device("cpu"), dtype=torch.float32).size(0) == 4
+    assert model.causal_masks.get(16, device=torch.device("cpu"), dtype=torch.bfloat16).dtype == torch.bfloat16
+
+    encoder = PositionalEncoding(8, dropout=0.0)
+    x = torch.zeros(2, 5, 8)
+    encoded = encoder(x)
+    # every sequence in the batch gets the same encoding per time step
+    assert torch.equal(encoded[0], encoded[1])
+    assert not torch.equal(encoded[0, 0], encoded[0, 1])
+
+
+def test_checkpointed_layers_match():
+    torch.manual_seed(0)
+    model = Transformer(vocab_size=50, ninp=8, nhid=16, dropout=0.1)
+    checkpointed = Transformer(vocab_size=50, ninp=8, nhid=16, dropout=0.1, checkpoint_layers=True)
+    checkpointed.load_state_dict(model.state_dict())
+    inputs, target = torch.randint(0, 50, (2, 2, 12))
+    losses = []
+    for net in (model, checkpointed):
+        # recomputation replays the dropout masks of the forward pass
+        torch.manual_seed(1)
+        losses.append(net(inputs, target).sum())
+        losses[-1].backward()
+    assert torch.allclose(*losses)
+    for param, other in zip(model.parameters(), checkpointed.parameters()):
+        assert torch.allclose(param.grad, other.grad, atol=1e-6)
+
+
+def test_attention_dropout_selects_the_fused_kernel():
+    model = Transformer(vocab_size=50, ninp=8, nhid=16, attention_dropout=0.0)
+    assert model.transformer.encoder.layers[0].self_attn.dropout == 0.0
+    assert model.transformer.encoder.layers[0].dropout.p == 0.2
+    with torch.profiler.profile() as prof:
+        model(*torch.randint(0, 50, (2, 2, 12))).sum().backward()
+    assert any("flash_attention" in event.name for event in prof.events())
+
+
+def test_tokens_per_update_agrees_across_ranks():
+    # two ranks with packed batches of 10 and 30 tokens both sum the global 40 tokens
+    for local_tokens in (10, 30):
+        strategy = SimpleNamespace(reduce=lambda tensor, reduce_op: tensor + (40 - local_tokens))
+        trainer = SimpleNamespace(strategy=strategy, accumulate_grad_batches=1)
+        callback = TokensPerUpdate(100)
+        batch = torch.zeros(1, 64), torch.zeros(1, 64), (torch.arange(64) < local_tokens).long()[None]
+        callback.on_train_batch_start(trainer, SimpleNamespace(device=torch.device("cpu")), batch, 0)
+        assert trainer.accumulate_grad_batches == 3
+
+
+def test_tokens_per_update_sets_accumulation(tmp_path):
+    assert count_tokens(torch.zeros(2, 8)) == 16
+    assert count_tokens((torch.zeros(2, 8), torch.zeros(2, 8), torch.tensor([[1, 1, 2, 0]]))) == 3
+
+    model = LightningTransformer(vocab_size=50, tokens_per_update=60, optimizer="adamw", lr=1e-3)
+    model.prepare_data = lambda: None  # train on random tokens instead of WikiText2
+    data = DataLoader(TensorDataset(*torch.randint(0, 50, (2, 32, 8))), batch_size=2)
+    trainer = LabTrainer(
+        logger=False,
+        checkpoints_dir=tmp_path,
+        max_steps=2,
+        enable_progress_bar=False,
+        enable_model_summary=False,
+    )
+    trainer.fit(model, data)
+    callback = next(callback for callback in trainer.callbacks if isinstance(callback, TokensPerUpdate))
+    # 16 tokens per batch, rounded up to 64 tokens per update
+    assert callback.accumulate_grad_batches == trainer.accumulate_grad_batches == 4
+    assert trainer.global_step == 2 and trainer.fit_loop.epoch_loop.batch_progress.total.completed == 8
+    assert isinstance(trainer.optimizers[0], torch.optim.AdamW)
+
+
+def zipf_counts(vocab_size, seed=0):
+    # frequencies falling off with rank, shuffled so that ids are not in frequency order
+    counts = [1000 // (rank + 1) + 1 for rank in range(vocab_size)]
+    return [counts[i] for i in torch.randperm(vocab_size, generator=torch.Generator().manual_seed(seed))]
+
+
+def test_adaptive_head():
+    torch.manual_seed(0)
+    counts = zipf_counts(300)
+    cutoffs = frequency_cutoffs(counts)
+    assert 0 < cutoffs[0] < cutoffs[-1] < 300
+    head = AdaptiveSoftmaxHead(16, 300, cutoffs, counts)
+    # the most frequent token is in the shortlist
+    assert head.ranks[counts.index(max(counts))] == 0
+
+    hidden, target = torch.randn(4, 10, 16), torch.randint(0, 300, (4, 10))
+    log_probs = head(hidden)
+    assert log_probs.shape == (4, 10, 300)
+    assert torch.allclose(log_probs.logsumexp(dim=-1), torch.zeros(4, 10), atol=1e-5)
+    assert torch.allclose(head.loss(hidden, target), -log_probs.gather(-1, target[..., None]).mean(), atol=1e-5)
+    with torch.no_grad():
+        for k in (1, 7, 200):
+            values, ids = head.topk(hidden, k)
+            assert torch.allclose(values, log_probs.topk(k).values, atol=1e-5)
+            assert torch.equal(log_probs.gather(-1, ids), values)
+
+
+def test_chunked_cross_entropy_matches_the_full_loss():
+    decoder = torch.nn.Linear(8, 50)
+    hidden, target = torch.randn(3, 11, 8, requires_grad=True), torch.randint(0, 50, (3, 11))
+    losses, grads = [], []
+    for loss_fn in (
+        lambda: torch.nn.functional.cross_entropy(decoder(hidden).view(-1, 50), target.view(-1)),
+        lambda: chunked_cross_entropy(hidden, decoder, target, chunk_size=4),
+    ):
+        hidden.grad = decoder.weight.grad = None
+        losses.append(loss_fn())
+        losses[-1].backward()
+        grads.append((hidden.grad, decoder.weight.grad))
+    assert torch.allclose(*losses)
+    assert all(torch.allclose(a, b, atol=1e-6) for a, b in zip(*grads))
+
+
+def test_adaptive_transformer_trains_generates_and_reloads():
+    torch.manual_seed(0)
+    counts = zipf_counts(120)
+    model = LightningTransformer(vocab_size=120, head="adaptive", token_counts=counts)
+    assert model.hparams.cutoffs == frequency_cutoffs(counts) and "token_counts" not in model.hparams
+    loss = model.training_step(tuple(torch.randint(0, 120, (2, 2, 9))), 0)
+    loss.backward()
+    assert loss.item() > 0
+
+    model.eval()
+    prompts = torch.randint(0, 120, (3, 5))
+    greedy = model.generate(prompts, max_new_tokens=4)
+    memory = model.model.encode(prompts)
+    cache = model.model.init_cache(memory, torch.zeros(3, 5, dtype=torch.bool), 9)
+    assert torch.equal(
+        greedy[:, 0], model.model.decode(prompts, torch.arange(5).expand(3, -1), cache)[:, -1].argmax(-1)
+    )
+    sampled = model.generate(prompts, max_new_tokens=4, strategy="top_k", top_k=5, generator=torch.Generator())
+    assert sampled.shape == (3, 4)
+
+    # the frequency order is part of the state, so the saved hyperparameters rebuild the model without the counts
+    reloaded = LightningTransformer(**model.hparams).eval()
+    reloaded.load_state_dict(model.state_dict())
+    assert torch.equal(reloaded.generate(prompts, max_new_tokens=4), greedy)
+
+
+def test_token_cache_follows_the_corpus(tmp_path):
+    path = make_corpus(tmp_path)
+    WikiText2(data_dir=tmp_path, block_size=4, download=False)
+    stat = os.stat(path)
+    # same size and modification time, as an edit within the mtime granularity or `cp -p` of another corpus leaves it
+    path.write_text(TEXT.replace("fox", "cat"), encoding="utf8")
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    dataset = WikiText2(data_dir=tmp_path, block_size=4, download=False)
+    assert "cat" in dataset.dictionary.word2idx and "fox" not in dataset.dictionary.word2idx
+    assert len(os.listdir(tmp_path / "cache")) == 7
+
+
+def test_corpus_digest_is_memoised(tmp_path):
+    path = make_corpus(tmp_path)
+    key = transformer._fingerprint(path, tmp_path / "cache")
+    memo_path = tmp_path / "cache" / "wikitext-2.digest"
+    memo_path.write_text(memo_path.read_text().replace(key, "memoised"))
+    assert transformer._fingerprint(path, tmp_path / "cache") == "memoised"
+
+
+def test_empty_corpus(tmp_path):
+    (tmp_path / "empty.txt").write_text("", encoding="utf8")
+    for _ in range(2):
+        data, dictionary = transformer.load_tokens(tmp_path / "empty.txt", tmp_path / "cache")
+        assert len(data) == 0 and dictionary.idx2word == [] and dictionary.counts == []